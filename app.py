@@ -1,22 +1,48 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, initialize_app
-from flask import Flask, request, render_template
-from requests_futures.sessions import FuturesSession
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, copy_current_request_context, request, render_template
+from flask_socketio import SocketIO, emit, join_room
 from dotenv import load_dotenv
 from google.cloud import storage
+from cachetools import LRUCache, TTLCache
+import aiohttp
+import asyncio
+import atexit
+import bisect
+import hashlib
 import json
+import msgspec
+import mmap
+import multiprocessing
+import numpy as np
 import os
+import redis
 import uuid
 import requests
-import copy
 from datetime import datetime, timedelta, timezone
+import sys
 import threading
 import time
 import tempfile
+import socket
+import sqlite3
+import zlib
+from array import array
+from collections import namedtuple
+from itertools import groupby
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from openings import (ArchiveGameSplitter, GameFacts, MonthBucket, classify_month, classify_opening,
+                      month_bucket_counts, opening_display_roots, opening_node_lines, opening_node_names,
+                      opening_node_parents, opening_rollup_levels, opening_roots, opening_tree_version,
+                      project_archive_games)
 
 app = Flask(__name__)
 
+# When this file is run as a script, the classify workers import it again as __mp_main__. They only use the openings
+# module, so they skip the startup: the session store, the background threads, the game store and the classify pool
+in_classify_worker = __name__ == '__mp_main__'
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -26,1137 +52,1565 @@ if not secret_key and app.config['ENV'] == 'production':
     raise ValueError("No FLASK_SECRET_KEY set for Flask application")
 app.secret_key = secret_key or 'default_secret_key'  # Use default for development
 
-# Initialize Firebase Admin SDK
-google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-if not google_credentials_json:
-    raise ValueError("No GOOGLE_CREDENTIALS_JSON set for Flask application")
+# Analysis progress is pushed over Socket.IO, SOCKETIO_MESSAGE_QUEUE lets every worker emit to every client
+socketio_message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+socketio = SocketIO(app, message_queue=socketio_message_queue)
 
-# Write the credentials JSON to a temporary file
-with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix='.json') as temp_file:
-    temp_file.write(google_credentials_json)
-    temp_cred_file_path = temp_file.name
 
-# Set the environment variable to the path of the temporary file
-os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = temp_cred_file_path
+def set_field_path(data, field_path, value):
+    # Applies a Firestore style dotted field path to a plain dict
+    *parents, field = field_path.split('.')
+    for key in parents:
+        data = data.setdefault(key, {})
+    data[field] = value
 
-# Initialize Firebase Admin SDK with the temporary credentials file
-credentials = credentials.Certificate(temp_cred_file_path)
-initialize_app(credentials)
-db = firestore.client()
 
+class GoogleSessionStore:
+    # Session documents in Firestore, stats blobs in a public GCS bucket referenced by their url
+    bucket_name = 'prep-mate-stats-bucket'
 
-def generate_session_id(data):
-    session_id = str(uuid.uuid4())
+    def __init__(self):
+        # Initialize Firebase Admin SDK
+        google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+        if not google_credentials_json:
+            raise ValueError("No GOOGLE_CREDENTIALS_JSON set for Flask application")
+
+        # Write the credentials JSON to a temporary file
+        with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix='.json') as temp_file:
+            temp_file.write(google_credentials_json)
+            temp_cred_file_path = temp_file.name
+
+        # Set the environment variable to the path of the temporary file
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = temp_cred_file_path
+
+        # Initialize Firebase Admin SDK with the temporary credentials file
+        initialize_app(credentials.Certificate(temp_cred_file_path))
+        self.db = firestore.client()
+        self.sessions = self.db.collection('sessions')
+
+        # The storage client is created on first use so forked workers don't share its connections
+        self.storage_client = None
+        self.storage_client_lock = threading.Lock()
+
+    def bucket(self):
+        with self.storage_client_lock:
+            if self.storage_client is None:
+                self.storage_client = storage.Client()
+        return self.storage_client.bucket(self.bucket_name)
+
+    def save_blob(self, name, data):
+        blob = self.bucket().blob(name)
+        blob.upload_from_string(data)
+        return blob.public_url
+
+    @contextmanager
+    def open_blob(self, ref):
+        yield requests.get(ref).content
+
+    def delete_blobs(self, refs):
+        # Missing files count as deleted
+        bucket = self.bucket()
+        bucket.delete_blobs([bucket.blob(ref.split('/')[-1]) for ref in refs], on_error=lambda blob: None)
+
+    def save_session(self, session_id, data):
+        self.sessions.document(session_id).set(data)
+
+    def load_session(self, session_id):
+        doc = self.sessions.document(session_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def update_session(self, session_id, fields):
+        self.sessions.document(session_id).update(fields)
+
+    def touch_sessions(self, touches):
+        for start in range(0, len(touches), 500):  # Firestore's limit of writes per batch
+            chunk = touches[start:start + 500]
+            batch = self.db.batch()
+            for session_id, last_activity in chunk:
+                batch.update(self.sessions.document(session_id), {'last_activity': last_activity})
+            try:
+                batch.commit()
+            except Exception:
+                # A session deleted since it was touched fails the whole batch, the others are written one by one
+                for session_id, last_activity in chunk:
+                    try:
+                        self.update_session(session_id, {'last_activity': last_activity})
+                    except Exception:
+                        pass
+
+    def inactive_sessions(self, cutoff, limit, cursor=None):
+        # Pages of (session id, data) by last activity, the cursor continues after the previous page
+        query = self.sessions.where('last_activity', '<', cutoff).order_by('last_activity')
+        if cursor is not None:
+            query = query.start_after(cursor)
+        page = list(query.limit(limit).stream())
+        return [(session.id, session.to_dict()) for session in page], page[-1] if page else None
+
+    def delete_sessions(self, session_ids):
+        for start in range(0, len(session_ids), 500):
+            batch = self.db.batch()
+            for session_id in session_ids[start:start + 500]:
+                batch.delete(self.sessions.document(session_id))
+            batch.commit()
+
+    def acquire_lease(self, name, holder, duration):
+        # The holder renews its lease, anyone else gets it once it has expired
+        lease_ref = self.db.collection('leases').document(name)
+
+        @firestore.transactional
+        def acquire(transaction):
+            now = datetime.now(timezone.utc)
+            lease = lease_ref.get(transaction=transaction).to_dict()
+            if lease and lease['holder'] != holder and lease['expires_at'] > now.isoformat():
+                return False
+            transaction.set(lease_ref, {'holder': holder, 'expires_at': (now + duration).isoformat()})
+            return True
+
+        return acquire(self.db.transaction())
+
+
+class LocalSessionStore:
+    # Session documents in SQLite and stats blobs as memory-mapped files, for single node deployments
+    def __init__(self, directory):
+        self.blob_dir = os.path.join(directory, 'stats')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.db_path = os.path.join(directory, 'sessions.sqlite3')
+        with closing(self.connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                                id TEXT PRIMARY KEY,
+                                data TEXT NOT NULL,
+                                last_activity TEXT NOT NULL
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_by_activity ON sessions (last_activity, id)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                                name TEXT PRIMARY KEY,
+                                holder TEXT NOT NULL,
+                                expires_at TEXT NOT NULL
+                            )''')
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level='IMMEDIATE')
+
+    def save_blob(self, name, data):
+        # Written aside and renamed, readers never map a partial file
+        path = os.path.join(self.blob_dir, name)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.tmp', path)
+        return name
+
+    @contextmanager
+    def open_blob(self, ref):
+        with open(os.path.join(self.blob_dir, ref), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+            yield blob
+
+    def delete_blobs(self, refs):
+        for ref in refs:
+            try:
+                os.remove(os.path.join(self.blob_dir, ref))
+            except FileNotFoundError:
+                pass
+
+    def save_session(self, session_id, data):
+        with closing(self.connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, last_activity) VALUES (?, ?, ?)',
+                         (session_id, json.dumps(data), data['last_activity']))
+
+    def load_session(self, session_id):
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT data, last_activity FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        return {**json.loads(row[0]), 'last_activity': row[1]} if row else None
+
+    def update_session(self, session_id, fields):
+        with closing(self.connect()) as conn, conn:
+            # The write lock is taken before the read, a concurrent update can't be lost in between
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM sessions WHERE id = ?', (session_id,)).fetchone()
+            if row is None:
+                raise KeyError(session_id)
+            data = json.loads(row[0])
+            for field_path, value in fields.items():
+                set_field_path(data, field_path, value)
+            conn.execute('UPDATE sessions SET data = ? WHERE id = ?', (json.dumps(data), session_id))
+
+    def touch_sessions(self, touches):
+        with closing(self.connect()) as conn, conn:
+            conn.executemany('UPDATE sessions SET last_activity = ? WHERE id = ?',
+                             [(last_activity, session_id) for session_id, last_activity in touches])
+
+    def inactive_sessions(self, cutoff, limit, cursor=None):
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT id, data, last_activity FROM sessions '
+                                'WHERE last_activity < ? AND (last_activity, id) > (?, ?) '
+                                'ORDER BY last_activity, id LIMIT ?', (cutoff, *(cursor or ('', '')), limit)).fetchall()
+        cursor = (rows[-1][2], rows[-1][0]) if rows else None
+        return [(session_id, json.loads(data)) for session_id, data, _ in rows], cursor
+
+    def delete_sessions(self, session_ids):
+        with closing(self.connect()) as conn, conn:
+            conn.executemany('DELETE FROM sessions WHERE id = ?', [(session_id,) for session_id in session_ids])
+
+    def acquire_lease(self, name, holder, duration):
+        now = datetime.now(timezone.utc)
+        with closing(self.connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            lease = conn.execute('SELECT holder, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if lease and lease[0] != holder and lease[1] > now.isoformat():
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)',
+                         (name, holder, (now + duration).isoformat()))
+            return True
+
+
+class RedisSessionStore:
+    # Session documents and stats blobs as Redis strings, last activity in a sorted set for the cleanup
+    activity_key = 'sessions:last_activity'
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def save_blob(self, name, data):
+        self.client.set(f'blob:{name}', data)
+        return name
+
+    @contextmanager
+    def open_blob(self, ref):
+        blob = self.client.get(f'blob:{ref}')
+        if blob is None:
+            raise KeyError(ref)
+        yield blob
+
+    def delete_blobs(self, refs):
+        if refs:
+            self.client.delete(*(f'blob:{ref}' for ref in refs))
+
+    def save_session(self, session_id, data):
+        with self.client.pipeline() as pipe:
+            pipe.set(f'session:{session_id}', json.dumps(data))
+            pipe.zadd(self.activity_key, {session_id: datetime.fromisoformat(data['last_activity']).timestamp()})
+            pipe.execute()
+
+    def load_session(self, session_id):
+        data = self.client.get(f'session:{session_id}')
+        return json.loads(data) if data else None
+
+    def update_session(self, session_id, fields):
+        key = f'session:{session_id}'
+
+        def update(pipe):
+            data = pipe.get(key)
+            if data is None:
+                raise KeyError(session_id)
+            data = json.loads(data)
+            for field_path, value in fields.items():
+                set_field_path(data, field_path, value)
+            pipe.multi()
+            pipe.set(key, json.dumps(data))
+
+        self.client.transaction(update, key)
+
+    def touch_sessions(self, touches):
+        # Only the sorted set is touched, xx keeps deleted sessions from coming back
+        if touches:
+            self.client.zadd(self.activity_key, {session_id: datetime.fromisoformat(last_activity).timestamp()
+                                                 for session_id, last_activity in touches}, xx=True)
+
+    def inactive_sessions(self, cutoff, limit, cursor=None):
+        # The cursor holds the last score and the members already seen with it, so ties across pages aren't skipped
+        low, seen = cursor or ('-inf', set())
+        page = self.client.zrangebyscore(self.activity_key, low, f'({datetime.fromisoformat(cutoff).timestamp()}',
+                                         start=0, num=limit + len(seen), withscores=True)
+        page = [(session_id, score) for session_id, score in page if session_id not in seen][:limit]
+        if not page:
+            return [], None
+
+        last_score = page[-1][1]
+        seen = (seen if last_score == low else set()) | {session_id for session_id, score in page
+                                                         if score == last_score}
+        documents = self.client.mget([f'session:{session_id.decode()}' for session_id, _ in page])
+        return ([(session_id.decode(), json.loads(data) if data else {})
+                 for (session_id, _), data in zip(page, documents)], (last_score, seen))
+
+    def delete_sessions(self, session_ids):
+        if session_ids:
+            with self.client.pipeline() as pipe:
+                pipe.delete(*(f'session:{session_id}' for session_id in session_ids))
+                pipe.zrem(self.activity_key, *session_ids)
+                pipe.execute()
+
+    def acquire_lease(self, name, holder, duration):
+        key = f'lease:{name}'
+        milliseconds = int(duration.total_seconds() * 1000)
+        if self.client.set(key, holder, nx=True, px=milliseconds):
+            return True
+        if self.client.get(key) == holder.encode():
+            return bool(self.client.pexpire(key, milliseconds))
+        return False
+
+
+# SESSION_STORE picks where sessions live: google (default), local or redis
+session_store_backend = os.environ.get('SESSION_STORE', 'google')
+if in_classify_worker:
+    session_store = None
+elif session_store_backend == 'google':
+    session_store = GoogleSessionStore()
+elif session_store_backend == 'local':
+    session_store = LocalSessionStore(os.environ.get('SESSION_STORE_DIR',
+                                                     os.path.join(tempfile.gettempdir(), 'prep-mate-sessions')))
+elif session_store_backend == 'redis':
+    session_store = RedisSessionStore(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+else:
+    raise ValueError(f"Unknown SESSION_STORE {session_store_backend}")
+
+# Decoded stats blobs by their url, a blob is written once per session and never changes afterwards
+session_stats_cache_ttl = int(os.environ.get('SESSION_STATS_CACHE_TTL', 600))
+session_stats_cache_bytes = int(os.environ.get('SESSION_STATS_CACHE_BYTES', 256 * 1024 * 1024))
+session_stats_cache = TTLCache(maxsize=session_stats_cache_bytes, ttl=session_stats_cache_ttl,
+                               getsizeof=lambda entry: entry[1])
+session_stats_cache_lock = threading.Lock()
+
+
+def cache_session_stats(stats_url, stats, size):
+    # Sized by the uncompressed encoding, the decoded objects are shared read-only between requests
+    if size <= session_stats_cache_bytes:
+        with session_stats_cache_lock:
+            session_stats_cache[stats_url] = (stats, size)
+
+
+def cached_session_stats(stats_url):
+    with session_stats_cache_lock:
+        entry = session_stats_cache.get(stats_url)
+    return entry[0] if entry else None
+
+
+# Stats blobs are msgpack compressed with zlib behind a magic and format version, older sessions hold plain JSON
+session_stats_magic = b'PMST'
+session_stats_format = 2
+session_stats_encoder = msgspec.msgpack.Encoder()
+session_stats_decoder = msgspec.msgpack.Decoder()
+
+
+def encode_session_stats(stats):
+    payload = session_stats_encoder.encode(stats)
+    blob = session_stats_magic + bytes([session_stats_format]) + zlib.compress(payload, 6)
+    return blob, len(payload)
+
+
+def decode_session_stats(blob):
+    # Returns the stats and the size of their uncompressed encoding, which the session cache is bounded by
+    # The blob can be any buffer, memory-mapped files are decompressed without a copy
+    if blob[:len(session_stats_magic)] != session_stats_magic:
+        return json.loads(bytes(blob)), len(blob)
+
+    version = blob[len(session_stats_magic)]
+    if version != session_stats_format:
+        raise ValueError(f"Unknown stats format {version}")
+    payload = zlib.decompress(memoryview(blob)[len(session_stats_magic) + 1:])
+    return session_stats_decoder.decode(payload), len(payload)
+
+
+def summarize_lines(lines, variations=True):
+    # The overview only needs to know whether a line has variations, not the variations themselves
+    return [{**line, 'variations': variations and bool(line['variations']),
+             'sub_lines': summarize_lines(line['sub_lines'], variations)}
+            for line in lines]
+
+
+def shard_opening(opening, games):
+    # An opening's subtree with only the games its variations refer to, renumbered from 0
+    rows = []
+
+    def renumber(line):
+        variations = {}
+        for line_name, variation in line['variations'].items():
+            start = len(rows)
+            rows.extend(variation['games'])
+            variations[line_name] = {**variation, 'games': list(range(start, len(rows)))}
+        return {**line, 'variations': variations, 'sub_lines': [renumber(sub_line) for sub_line in line['sub_lines']]}
+
+    opening = renumber(opening)
+    return {'opening': opening, 'games': games.take(rows).to_dict()}
+
+
+def session_shard_name(filename, color, opening_id):
+    stem, _, extension = filename.rpartition('.')
+    return f'{stem}_{color}_{opening_id}.{extension}'
+
+
+def session_stats_refs(data):
+    # The index blob and every shard of a session
+    return [data['stats_url']] + [session_shard_name(data['stats_url'], color, opening_id)
+                                  for color, count in data.get('stats_shards', {}).items()
+                                  for opening_id in range(count)]
+
+
+# Sessions are persisted behind the response, reads of a session this process is still writing wait for it
+session_write_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SESSION_WRITE_WORKERS', 4)))
+stats_upload_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('STATS_UPLOAD_WORKERS', 8)))
+pending_session_writes = {}
+pending_session_writes_lock = threading.Lock()
+
+# Work concurrent requests would repeat runs once per key, later callers wait for the first one's result.
+# With SINGLE_FLIGHT_REDIS_URL a key is also held across workers, a worker finding it held waits for the holder
+# to finish and then runs the work itself against what the holder stored
+single_flight_timeout = int(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 300))
+single_flight_poll_interval = 0.1
+single_flight_redis_url = os.environ.get('SINGLE_FLIGHT_REDIS_URL')
+single_flight_redis = redis.Redis.from_url(single_flight_redis_url) if single_flight_redis_url else None
+in_flight = {}
+in_flight_lock = threading.Lock()
 
-    # Split large data
-    stats = data['stats']
-    del data['stats']
 
-    # Upload large data to GCS
-    bucket_name = 'prep-mate-stats-bucket'
-    filename = f'{session_id}_stats.json'
-    data_url = upload_to_gcs(bucket_name, json.dumps(stats), filename)
+def single_flight(key, work, across_workers=True):
+    with in_flight_lock:
+        future = in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = in_flight[key] = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        if across_workers:
+            with worker_flight(key):
+                result = work()
+        else:
+            result = work()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with in_flight_lock:
+            in_flight.pop(key, None)
+
+
+def in_flight_future(key):
+    with in_flight_lock:
+        return in_flight.get(key)
+
 
-    # Save reference to Firestore
-    data['stats_url'] = data_url
-    data['last_activity'] = datetime.now(timezone.utc).isoformat()
+@contextmanager
+def worker_flight(key):
+    if single_flight_redis is None:
+        yield
+        return
+
+    flight_key = f'flight:{key}'
+    token = uuid.uuid4().hex
+    holder = False
+    try:
+        holder = single_flight_redis.set(flight_key, token, nx=True, px=single_flight_timeout * 1000)
+        deadline = time.monotonic() + single_flight_timeout
+        while not holder and single_flight_redis.get(flight_key) is not None and time.monotonic() < deadline:
+            time.sleep(single_flight_poll_interval)
+    except redis.RedisError as e:
+        # Coalescing across workers is best effort, the work still runs without it
+        print(f"Single flight for {key} unavailable: {e}")
+
+    try:
+        yield
+    finally:
+        if holder:
+            release_worker_flight(flight_key, token)
+
+
+def release_worker_flight(flight_key, token):
+    # Only the holder's own token is deleted, a flight that outlived its timeout may belong to someone else by now
+    def release(pipe):
+        if pipe.get(flight_key) == token.encode():
+            pipe.multi()
+            pipe.delete(flight_key)
+
+    try:
+        single_flight_redis.transaction(release, flight_key)
+    except redis.RedisError as e:
+        print(f"Failed to release single flight {flight_key}: {e}")
+
+
+def generate_session_id(data, analysis_key):
+    session_id = str(uuid.uuid4())
 
-    db.collection('sessions').document(session_id).set(data)
+    # Split large data, None when the analysis is already stored
+    build_stats = data['build_stats']
+    del data['build_stats']
+
+    # A placeholder is stored first, so a worker asked for the session while its stats are still being written
+    # waits for them instead of reporting the session missing
+    session_store.save_session(session_id, {**data, 'pending': True,
+                                            'last_activity': datetime.now(timezone.utc).isoformat()})
+    future = session_write_executor.submit(persist_session, session_id, data, build_stats, analysis_key)
+    with pending_session_writes_lock:
+        pending_session_writes[session_id] = future
+    future.add_done_callback(lambda _: forget_session_write(session_id))
     return session_id
 
 
+def forget_session_write(session_id):
+    with pending_session_writes_lock:
+        pending_session_writes.pop(session_id, None)
+
+
+def wait_for_session_write(session_id):
+    # False if this process failed to persist the session
+    with pending_session_writes_lock:
+        future = pending_session_writes.get(session_id)
+    if future is None:
+        return True
+    try:
+        future.result()
+        return True
+    except Exception:
+        return False
+
+
+def analysis_record_id(analysis_key):
+    return f'analysis-{analysis_key}'
+
+
+def load_analysis(analysis_key):
+    # An analysis this process is still storing counts as stored once the write finishes
+    future = in_flight_future(f'store-analysis:{analysis_key}')
+    if future is not None:
+        try:
+            return future.result()
+        except Exception:
+            return None
+    return session_store.load_session(analysis_record_id(analysis_key))
+
+
+def persist_analysis(analysis_key, build_stats):
+    # Only one write per analysis runs at a time, concurrent identical sessions wait for it and reuse what it stored
+    return single_flight(f'store-analysis:{analysis_key}',
+                         lambda: session_store.load_session(analysis_record_id(analysis_key))
+                         or store_analysis(analysis_key, build_stats()))
+
+
+def store_analysis(analysis_key, stats):
+    # Store large data as blobs, an index for the overview and a shard per color and opening for the details
+    filename = f'{analysis_key}_stats.msgpack'
+    shards = {session_shard_name(filename, color, opening_id): shard_opening(opening, stats['games'])
+              for color in opening_colors for opening_id, opening in enumerate(stats[color])}
+
+    def upload(name, value):
+        encoded, size = encode_session_stats(value)
+        ref = session_store.save_blob(name, encoded)
+        cache_session_stats(ref, value, size)
+        return ref
+
+    # The index goes last, an index that exists means all of its shards do too
+    list(stats_upload_executor.map(upload, shards.keys(), shards.values()))
+    data_url = upload(filename, {color: summarize_lines(stats[color]) for color in opening_colors})
+
+    # The analysis is kept alive by the activity of the sessions pointing at it and cleaned up like a session
+    record = {'stats_url': data_url,
+              'stats_shards': {color: len(stats[color]) for color in opening_colors},
+              'last_activity': datetime.now(timezone.utc).isoformat()}
+    session_store.save_session(analysis_record_id(analysis_key), record)
+    return record
+
+
+def persist_session(session_id, data, build_stats, analysis_key):
+    try:
+        analysis = load_analysis(analysis_key) if build_stats is None else persist_analysis(analysis_key, build_stats)
+        if analysis is None:
+            raise KeyError(f"Analysis {analysis_key} is gone")
+
+        # Save the reference, the session only becomes visible once all of its stats are stored
+        data['analysis'] = analysis_record_id(analysis_key)
+        data['stats_url'] = analysis['stats_url']
+        data['stats_shards'] = analysis['stats_shards']
+        data['last_activity'] = datetime.now(timezone.utc).isoformat()
+
+        session_store.touch_sessions([(data['analysis'], data['last_activity'])])
+        session_store.save_session(session_id, data)
+    except Exception as e:
+        print(f"Failed to persist session {session_id}: {e}")
+        # Readers waiting on the placeholder give up once it's gone
+        try:
+            session_store.delete_sessions([session_id])
+        except Exception as delete_error:
+            print(f"Failed to delete placeholder of session {session_id}: {delete_error}")
+        raise
+
+
+# Seconds a read waits for a session another worker is still writing
+session_write_timeout = int(os.environ.get('SESSION_WRITE_TIMEOUT', 60))
+session_write_poll_interval = 0.2
+
+
+def load_written_session(session_id):
+    # None if the session doesn't exist or its write didn't finish in time
+    deadline = time.monotonic() + session_write_timeout
+    data = session_store.load_session(session_id)
+    while data and data.get('pending') and time.monotonic() < deadline:
+        time.sleep(session_write_poll_interval)
+        data = session_store.load_session(session_id)
+    return None if data and data.get('pending') else data
+
+
 def get_session_data(session_id):
-    doc = db.collection('sessions').document(session_id).get()
-    data = doc.to_dict() if doc.exists else None
+    if not wait_for_session_write(session_id):
+        return None
 
-    if data and 'stats_url' in data:
-        response = requests.get(data['stats_url'])
-        data['stats'] = response.json()
+    data = load_written_session(session_id)
+    if data and 'player_info' not in data:
+        # Analysis records share the store but aren't sessions
+        return None
 
-        # Update last activity timestamp
-        db.collection('sessions').document(session_id).update({
-            'last_activity': datetime.now(timezone.utc).isoformat()
-        })
+    if data and 'stats_url' in data:
+        # Update last activity timestamp, an analysis lives as long as a session using it
+        touch_session(session_id)
+        if 'analysis' in data:
+            touch_session(data['analysis'])
 
     return data
 
 
-def upload_to_gcs(bucket_name, data, filename):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(filename)
-    blob.upload_from_string(data)
-    return blob.public_url
+# Activity touches are buffered and written in batches, so last_activity lags by up to one flush interval
+activity_flush_interval = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 60))
+pending_activity = {}
+pending_activity_lock = threading.Lock()
 
 
-# Cleanup Inactive Sessions Periodically
-def cleanup_inactive_sessions(max_inactive_duration):
+def touch_session(session_id):
+    with pending_activity_lock:
+        pending_activity[session_id] = datetime.now(timezone.utc).isoformat()
+
+
+def flush_session_activity():
+    with pending_activity_lock:
+        touches = list(pending_activity.items())
+        pending_activity.clear()
+
+    session_store.touch_sessions(touches)
+
+
+def flush_session_activity_periodically():
     while True:
-        now = datetime.now(timezone.utc)
-        cutoff_time = now - timedelta(seconds=max_inactive_duration)
+        time.sleep(activity_flush_interval)
+        try:
+            flush_session_activity()
+        except Exception as e:
+            print(f"Failed to flush session activity: {e}")
 
-        sessions_ref = db.collection('sessions')
-        inactive_sessions = sessions_ref.where('last_activity', '<', cutoff_time.isoformat()).stream()
 
-        for session in inactive_sessions:
-            session_id = session.id
-            session_data = session.to_dict()
+def load_session_blob(ref):
+    stats = cached_session_stats(ref)
+    if stats is None:
+        with session_store.open_blob(ref) as blob:
+            stats, size = decode_session_stats(blob)
+        cache_session_stats(ref, stats, size)
+    return stats
 
-            # Delete the session document
-            sessions_ref.document(session_id).delete()
 
-            # Delete the corresponding stats file from GCS
-            if 'stats_url' in session_data:
-                filename = session_data['stats_url'].split('/')[-1]
-                delete_from_gcs('prep-mate-stats-bucket', filename)
+def session_overview(data, color):
+    # Sessions written before sharding hold the full stats in one blob, their lines work for the overview too
+    return load_session_blob(data['stats_url'])[color]
 
-        time.sleep(max_inactive_duration)  # Wait for the specified duration before checking again
+
+def session_opening(data, color, opening_id):
+    # The subtree of one opening and the table of the games its variations refer to
+    # Sessions written before the game table have no table, their variations hold the game dicts themselves
+    if 'stats_shards' in data:
+        shard_url = session_shard_name(data['stats_url'], color, opening_id)
+        shard = load_session_blob(shard_url)
+        return shard['opening'], shard['games']
+    stats = load_session_blob(data['stats_url'])
+    return stats[color][opening_id], stats.get('games')
 
 
-def delete_from_gcs(bucket_name, filename):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(filename)
-    blob.delete()
+# Cleanup Inactive Sessions Periodically
+# Every worker runs the loop, but only the holder of the cleanup lease sweeps
+cleanup_instance_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+cleanup_page_size = 500
+cleanup_blob_batch_size = 100
+cleanup_delete_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('CLEANUP_DELETE_WORKERS', 4)))
+cleanup_metrics = {'last_run': None, 'sessions': 0, 'files': 0, 'seconds': 0.0}
+
+
+def sweep_inactive_sessions(max_inactive_duration):
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    # Stored activity can be a flush interval behind, touches from other workers included
+    cutoff_time = now - timedelta(seconds=max_inactive_duration + activity_flush_interval)
+
+    reclaimed_sessions = reclaimed_files = 0
+    cursor = None
+    while True:
+        page, cursor = session_store.inactive_sessions(cutoff_time.isoformat(), cleanup_page_size, cursor)
+        if not page:
+            break
+
+        # Touched here since the last flush
+        with pending_activity_lock:
+            page = [(session_id, session_data) for session_id, session_data in page
+                    if session_id not in pending_activity]
+
+        # Files go first, a session whose files failed to delete is still listed for the next sweep
+        # Sessions pointing at an analysis don't own its files, the analysis record does
+        refs = []
+        for session_id, session_data in page:
+            if 'stats_url' in session_data and 'analysis' not in session_data:
+                refs.extend(session_stats_refs(session_data))
+        with session_stats_cache_lock:
+            for ref in refs:
+                session_stats_cache.pop(ref, None)
+        chunks = [refs[start:start + cleanup_blob_batch_size] for start in range(0, len(refs), cleanup_blob_batch_size)]
+        list(cleanup_delete_executor.map(session_store.delete_blobs, chunks))
+
+        session_store.delete_sessions([session_id for session_id, _ in page])
+
+        reclaimed_sessions += len(page)
+        reclaimed_files += len(refs)
+
+    elapsed = time.monotonic() - started
+    cleanup_metrics.update({'last_run': now.isoformat(), 'sessions': reclaimed_sessions, 'files': reclaimed_files,
+                            'seconds': elapsed})
+    print(f"Session cleanup reclaimed {reclaimed_sessions} sessions and {reclaimed_files} files in {elapsed:.1f}s")
+
+
+def cleanup_inactive_sessions(max_inactive_duration):
+    while True:
+        try:
+            # The lease is renewed on every sweep, another instance takes over once its holder stops renewing it
+            if session_store.acquire_lease('session-cleanup', cleanup_instance_id,
+                                           timedelta(seconds=2 * max_inactive_duration)):
+                sweep_inactive_sessions(max_inactive_duration)
+        except Exception as e:
+            print(f"Session cleanup failed: {e}")
+
+        time.sleep(max_inactive_duration)  # Wait for the specified duration before checking again
 
 
 # Start the cleanup thread
 max_inactive_duration = 3600  # 1 hour (you can change this value)
-cleanup_thread = threading.Thread(target=cleanup_inactive_sessions, args=(max_inactive_duration,))
-cleanup_thread.daemon = True
-cleanup_thread.start()
+if not in_classify_worker:
+    cleanup_thread = threading.Thread(target=cleanup_inactive_sessions, args=(max_inactive_duration,))
+    cleanup_thread.daemon = True
+    cleanup_thread.start()
+
+    activity_thread = threading.Thread(target=flush_session_activity_periodically)
+    activity_thread.daemon = True
+    activity_thread.start()
+    atexit.register(flush_session_activity)
 
 # Register the function as a template global
 app.jinja_env.globals.update(generate_session_id=generate_session_id)
 
-# Initialize FuturesSession
-futures_session = FuturesSession(executor=ThreadPoolExecutor(max_workers=10))
-
-# Grouping openings by ECO and name
-eco_details = {
-    'A00': {
-        'displayName': 'Uncommon Openings',
-        'lines': {
-            'Grob': ('Grob Opening', {
-                'Grob-Gambit': ('Grob Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Kings-F': ('King\'s Fianchetto Opening', {
-                'Symmetrical': ('Symmetrical Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Polish': ('Polish Opening', {
-                'Kuchark': ('Kucharkowski-Meybohm Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'A01': {
-        'displayName': 'Nimzowitsch-Larsen Attack',
-        'lines': {
-            'Classical': ('Classical Variation', None),
-            'English': ('English Variation', None),
-            'Indian': ('Indian Variation', None),
-            'Modern': ('Modern Variation', None),
-            'Symmetrical': ('Symmetrical Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'A02-A03': {
-        'displayName': 'Bird\'s Opening',
-        'lines': {
-            'Froms': ('From\'s Gambit', None),
-            'Dutch': ('Dutch Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'A04-A06, A09': {
-        'displayName': 'Reti Opening',
-        'lines': {
-            'Dutch': ('Dutch Variation', None),
-            'Kingside': ('Kingside Fianchetto Variation', None),
-            'Queenside': ('Queenside Fianchetto Variation', None),
-            'Quiet': ('Quiet System', None),
-            'Nimzo': ('Nimzo-Larsen Variations', None),
-            'Kings-Indian': ('King\'s Indian Attack Variations', None),
-            'Reti-Gambit': ('Reti Gambit', {
-                'Accept': ('Accepted', None),
-                'Decline': ('Declined', None),
-                'Other': ('Other', None)
-            }),
-            'Tennison': ('Tennison Gambit', None),
-            'Sicilian': ('Sicilian Invitation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'A07-A08': {
-        'displayName': 'King\'s Indian Attack',
-        'lines': {
-            'Double': ('Double Fianchetto Variation', None),
-            'French': ('French Variation', None),
-            'Sicilian': ('Sicilian Variation', None),
-            'Yugoslav': ('Yugoslav Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'A10-A39': {
-        'displayName': 'English Opening',
-        'lines': {
-            'Great-S': ('Great Snake Variation', None),
-            'Caro': ('Caro-Kann Defensive System', None),
-            'Anglo-Indian': ('Anglo-Indian Variation', None),
-            'Anglo-Scandi': ('Anglo-Scandinavian Variation', None),
-            'Agincourt': ('Agincourt Defense', None),
-            'Kings-Eng': ('King\'s English Variation', None),
-            'Reversed-S': ('Reversed Sicilian Variation', None),
-            'Carls-B': ('Carls-Bremen System', None),
-            'Mikenas': ('Mikenas-Carls Variation', None),
-            'Symmetrical': ('Symmetrical Variation', None),
-            'ning-Four-K': ('Four Knights Variation', None),
-            'ning-Two-K': ('Two Knights Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'd4': {
-        'displayName': 'Uncommon d4 Openings',
-        'lines': {
-            'Englund': ('Englund Gambit', {
-                'Decline': ('Declined', None),
-                'Other': ('Other', None)
-            }),
-            'Modern-D': ('Modern Defense (1. d4)', {
-                'Ptero': ('Pterodactyl Defense', None),
-                'Averbak': ('Averbakh-Kotov Variation', None),
-                'Other': ('Other', None)
-            }),
-            'English': ('English Defense', None),
-            'Tartakower': ('Tartakower Variation', None),
-            'Benoni': ('Benoni Defense', {
-                'Old-B': ('Old Benoni Defense', None),
-                'Modern': ('Modern Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Budapest': ('Budapest Gambit', None),
-            'Benko': ('Benko Gambit', {
-                'Decline': ('Declined', None),
-                'Half': ('Half-Accepted', None),
-                'Full': ('Fully-Accepted', None),
-                'Other': ('Other', None)
-            }),
-            'Tromp': ('Trompowsky Attack', {
-                'Classical': ('Classical Variation', None),
-                'Poison': ('Poisoned-Pawn Variation', None),
-                'Other': ('Other', None)
-            }),
-            'ti-Nimzo': ('Anti-Nimzo-Indian Variation', None),
-            'Blumen': ('Blumenfeld Countergambit', None),
-            'Torre': ('Torre Attack', None),
-            'London': ('London System', {
-                'Accel': ('Accelerated London System', {
-                    'Steinitz': ('Steinitz Countergambit', None),
-                    'Other': ('Other', None)
-                }),
-                'Indian': ('Indian Game Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Indian': ('Indian Game', {
-                'East-I': ('East Indian Variation', None),
-                'Old-I': ('Old Indian Defense', None),
-                'Bogo-I': ('Bogo-Indian Defense', {
-                    'Exchange': ('Exchange Variation', None),
-                    'Grunfeld': ('Grunfeld Variation', None),
-                    'Nimzo': ('Nimzowitsch Variation', None),
-                    'Vitolins': ('Vitolins Variation', None),
-                    'Wade-S': ('Wade-Smyslov Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Polish': ('Polish Variation', None),
-                'Spielmann': ('Spielmann Indian Variation', None),
-                'Yusupov': ('Yusupov-Rubinstein System', None),
-                'Accel': ('Accelerated Variation', None),
-                'Knights': ('Knights Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Rossolimo': ('Rossolimo Variation', None),
-            'Horwitz': ('Horwitz Defense', None),
-            'Zuker': ('Zukertort Variation', None),
-            'Chigorin': ('Chigorin Variation', None),
-            'Levitsky': ('Levitsky Attack', None),
-            'Stonewall': ('Stonewall Attack', None),
-            'Blackmar': ('Blackmar Gambit', None),
-            'Colle': ('Colle System', None),
-            'Symmetrical': ('Symmetrical Variation', None),
-            'Krause': ('Krause Variation', None),
-            'Pseudo': ('Pseudo Catalan Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'A80-A99': {
-        'displayName': 'Dutch Defense',
-        'lines': {
-            'Fianchetto': ('Fianchetto Variation', {
-                'Lenin': ('Leningrad Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Staunton': ('Staunton Gambit', {
-                'Accept': ('Accepted', None),
-                'Other': ('Other', None)
-            }),
-            'Lenin': ('Leningrad Variation', None),
-            'Classic': ('Classical Variation', None),
-            'Normal': ('Normal Variation', None),
-            'Queen': ('Queen\'s Knight Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'e4': {
-        'displayName': 'Uncommon e4 Openings',
-        'lines': {
-            'Nimzo': ('Nimzowitsch Defense', {
-                'Decline': ('Declined', None),
-                'Kennedy': ('Kennedy Variation', None),
-                'Scandi': ('Scandinavian Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Ponzi': ('Ponziani Opening', {
-                'Jaenisch': ('Jaenisch Counterattack', None),
-                'Steinitz': ('Steinitz Variation', None),
-                'Counter': ('Ponziani Countergambit', None),
-                'Spanish': ('Spanish Variation', None),
-                'Kings-P': ('Weird Anti-Ponziani Lines', None),
-                'Other': ('Other', None)
-            }),
-            'Owen': ('Owen\'s Defense', None),
-            'Wayward': ('Wayward Queen Attack', None),
-            'Center': ('Center Game', None),
-            'Danish': ('Danish Gambit', None),
-            'Kings-K': ('King\'s Knight Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B01': {
-        'displayName': 'Scandinavian Defense',
-        'lines': {
-            'Mieses': ('Mieses-Kotrc Variation', {
-                'Main-L': ('Main Line', None),
-                'Gubinsky': ('Gubinsky-Melts Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Closed': ('Closed Variation', None),
-            'Modern': ('Modern Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B02-B05': {
-        'displayName': 'Alekhine\'s Defense',
-        'lines': {
-            'Two-P': ('Two Pawns Attack', {
-                'Lasker': ('Lasker Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Scandi': ('Scandinavian Variation', None),
-            'Four-P': ('Four Pawns Attack', None),
-            'Modern': ('Modern Variation', None),
-            'Normal': ('Normal Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B06': {
-        'displayName': 'Modern Defense',
-        'lines': {
-            'Standard': ('Standard Line', {
-                'Ptero': ('Pterodactyl Variation', None),
-                'Two-K': ('Two Knights Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Ptero': ('Pterodactyl Variations', None),
-            'Mongred': ('Mongredien Defense', None),
-            'Three-P': ('Three Pawns Attack', None),
-            'Gurgen': ('Gurgenidze Variation', None),
-            'Bishop-A': ('Bishop Attack', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B07-B09': {
-        'displayName': 'Pirc Defense',
-        'lines': {
-            'Main': ('Main Line', {
-                'Austrian': ('Austrian Attack', None),
-                'Other': ('Other', None)
-            }),
-            'Geller': ('Geller System', None),
-            'Classic': ('Classical Variations', None),
-            'Czech': ('Czech Defense', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B10-B19': {
-        'displayName': 'Caro-Kann Defense',
-        'lines': {
-            'Accelerated-P': ('Accelerated Panov Attack', None),
-            'Two-K': ('Two Knights Attack', {
-                'Mindeno': ('Mindeno Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Advance': ('Advance Variation', {
-                'Tal-': ('Tal Variation', None),
-                'Botvin': ('Botvinnik-Carls Defense', None),
-                'Short': ('Short Variation', None),
-                'Van-': ('Van der Wiel Attack', None),
-                'Bronst': ('Bronstein Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Exchange': ('Exchange Variation', None),
-            'se-Panov': ('Panov Attack', None),
-            'Gurgen': ('Gurgenidze System', None),
-            'Main-L': ('Main Line', None),
-            'Tartakower': ('Tartakower Variation', None),
-            'stein-L': ('Bronstein-Larsen Variation', None),
-            'Karpov': ('Karpov Variation', None),
-            'Classic': ('Classical Variation', None),
-            'Breyer': ('Breyer Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'B20-B99': {
-        'displayName': 'Sicilian Defense',
-        'lines': {
-            'Smith-Mor': ('Smith-Morra Gambit', {
-                'Accept': ('Accepted', None),
-                'Decline': ('Declined', {
-                    'Center': ('Center Formation', None),
-                    'Push': ('Push Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Morphy': ('Morphy Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Alapin': ('Alapin Variation', {
-                'Delay': ('Delayed Alapin Variation', None),
-                'Barmen': ('Barmen Defense', None),
-                'Stoltz': ('Stoltz Attack', None),
-                'Other': ('Other', None)
-            }),
-            'Closed-S': ('Closed Sicilian', {
-                'Grand-P': ('Grand Prix Attack', None),
-                'Magnus': ('Magnus Sicilian', None),
-                'Traditional': ('Traditional Variation', None),
-                'Fianchetto': ('Fianchetto Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Hyperaccel': ('Hyperaccelerated Dragon', None),
-            'OKelly': ('O\'Kelly Variation', {
-                'Maroczy': ('Maroczy Bind Variation', None),
-                'Normal': ('Normal System', None),
-                'Venice': ('Venice System', None),
-                'Yerevan': ('Yerevan System', None),
-                'Other': ('Other', None)
-            }),
-            'Open': ('Open Sicilian', {
-                'Lowenth': ('Lowenthal Variation', None),
-                'Pelikan': ('Pelikan and Sveshnikov Variations', None),
-                'Accel': ('Accelerated Dragon', {
-                    'Maroczy': ('Maroczy Bind Formation', None),
-                    'Modern': ('Modern Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'en-Classic': ('Classical Variation', None),
-                'n-Dragon': ('Dragon Variation', None),
-                'Scheven': ('Scheveningen Variation', {
-                    'Sozin': ('Sozin Attack', None),
-                    'Other': ('Other', None)
-                }),
-                'Najdorf': ('Najdorf Variation', {
-                    'Adam': ('Adam\'s Attack', None),
-                    'English': ('English Attack', None),
-                    'Freak': ('Freak Attack', None),
-                    'Lipnit': ('Lipnitsky Attack', None),
-                    'Opocensky': ('Opocensky Variation', None),
-                    'Zagreb': ('Zagreb Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Other': ('Other', None)
-            }),
-            'e-Kan': ('Kan Variation', {
-                'Maroczy': ('Maroczy Bind Formation', None),
-                'Modern': ('Modern Variation', None),
-                'Knight': ('Knight Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Chekhover': ('Chekhover Variation', None),
-            'Canal': ('Canal Attack', None),
-            'Taimanov': ('Taimanov Variation', None),
-            'Four-K': ('Four Knights Variation', None),
-            'Nimzowitsch': ('Nimzowitsch Variation', None),
-            'Nyezhmet': ('Nyezhmetdinov-Rossolimo Attack', None),
-            'Snyder': ('Snyder Variation', None),
-            'Staunton-Coch': ('Staunton-Cochrane Variation', None),
-            'Bowdler': ('Bowdler Attack', None),
-            'Lasker-D': ('Lasker-Dunne Atack', None),
-            'Wing-G': ('Wing Gambit', None),
-            'McDonn': ('McDonnell Attack', None),
-            'Mengarini': ('Mengarini Variation', None),
-            'Pin-V': ('Pin Variation', None),
-            'Tartakower': ('Tartakower Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C00-C19': {
-        'displayName': 'French Defense',
-        'lines': {
-            'Tarrasch': ('Tarrasch Variation', {
-                'Open': ('Open Variation', None),
-                'Close': ('Closed Variation', None),
-                'Guimard': ('Guimard Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Classic': ('Classical Variation', {
-                'Steinitz': ('Steinitz Variation', None),
-                'MacCutch': ('MacCutcheon Variation', None),
-                'Burn': ('Burn Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Winawer': ('Winawer Variation', {
-                'Advance': ('Advance Variation', None),
-                'Delay': ('Delayed Exchange Variation', None),
-                'Alekhine': ('Alekhine-Maroczy Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Advance': ('Advance Variation', {
-                'Paulsen': ('Paulsen Attack', None),
-                'Nimzo': ('Nimzowitsch System', None),
-                'Wade': ('Wade Variation', None),
-                'Other': ('Other', None)
-            }),
-            'e-Exchange': ('Exchange Variation', None),
-            'Rubinstein': ('Rubinstein Variation', None),
-            'Kings-I': ('King\'s Indian Attack', None),
-            'Two-K': ('Two Knights Variation', None),
-            'e-Normal': ('Normal Variation', None),
-            'Queens-K': ('Queen\'s Knight Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C23-C29': {
-        'displayName': 'Vienna Game',
-        'lines': {
-            'Max-L': ('Max Lange Defense', {
-                'Steinitz': ('Steinitz Gambit', None),
-                'Meitner': ('Meitner-Mieses Gambit', None),
-                'Paulsen': ('Paulsen Variation', None),
-                'nna-Gambit': ('Vienna Gambit', {
-                    'Knight': ('Knight Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Other': ('Other', None)
-            }),
-            'Falkbeer': ('Falkbeer Variation', {
-                'Mieses': ('Mieses Variation', None),
-                'Stanley': ('Stanley Variation', None),
-                'nna-Gambit': ('Vienna Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Main-L': ('Main Line', {
-                'Paulsen': ('Paulsen Attack', None),
-                'Other': ('Other', None)
-            }),
-            'Anderssen': ('Anderssen Defense', None),
-            'Zhura': ('Zhuravlev Countergambit', None),
-            'Bishops': ('Bishop\'s Opening', {
-                'Berlin': ('Berlin Variation', {
-                    'Spiel': ('Spielmann Attack', None),
-                    'Vienna': ('Vienna Hybrid Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'C30-C39': {
-        'displayName': 'King\'s Gambit',
-        'lines': {
-            'Traditional': ('Traditional Variation', None),
-            'Bishops': ('Bishop\'s Gambit', None),
-            'Kieser': ('Kieseritzky Gambit', None),
-            'Decline': ('Declined', {
-                'Classic': ('Classical Variation', None),
-                'Queens-K': ('Queen\'s Knight Defense', None),
-                'Falkbeer': ('Falkbeer Countergambit', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'C40-C41': {
-        'displayName': 'Philidor Defense',
-        'lines': {
-            'Exchange': ('Exchange Variation', None),
-            'Hanham': ('Hanham Variation', None),
-            'Nimzo': ('Nimzowitsch Variation', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C42-C43': {
-        'displayName': 'Petrov\'s Defense',
-        'lines': {
-            'Stafford': ('Stafford Gambit', None),
-            'Classic': ('Classical Attack', {
-                'Marshall': ('Marshall Variation', None),
-                'Cozio': ('Cozio Attack', None),
-                'Damiano': ('Damiano Variation', None),
-                'Karklin': ('Karklins-Martinovsky Variation', None),
-                'Millenni': ('Millennium Attack', None),
-                'Nimzo': ('Nimzowitsch Attack', None),
-                'Paulsen': ('Paulsen Attack', None),
-                'Other': ('Other', None)
-            }),
-            'Three-K': ('Three Knights Game', None),
-            'Steinitz': ('Steinitz Attack', None),
-            'Urusov': ('Urusov Gambit', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C45': {
-        'displayName': 'Scotch Game',
-        'lines': {
-            'Classic': ('Classical Variation', {
-                'Inter': ('Intermezzo Variation', None),
-                'Potter': ('Potter Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Schmidt': ('Schmidt Variation', {
-                'Mieses': ('Mieses Variation', None),
-                'Tarta': ('Tartakower Variation', None),
-                'Other': ('Other', None)
-            }),
-            'tch-Gambit': ('Scotch Gambit', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C46': {
-        'displayName': 'Three Knights Opening',
-        'lines': {
-            'Steinitz': ('Steinitz Defense', None),
-            'Winawer': ('Winawer Defense', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C47-C49': {
-        'displayName': 'Four Knights Game',
-        'lines': {
-            'Gunsberg': ('Gunsberg Variation', None),
-            'Italian': ('Italian Variation', None),
-            'Scotch': ('Scotch Variation', None),
-            'Spanish': ('Spanish Variation', {
-                'Classic': ('Classical Variation', None),
-                'Rubin': ('Rubinstein Countergambit', None),
-                'Double': ('Double Spanish Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'C50-C59': {
-        'displayName': 'Italian Game',
-        'lines': {
-            'Giuoco': ('Giuoco Piano Game', {
-                'Pianissimo': ('Pianissimo Variation', {
-                    'Four-K': ('Four Knights Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Evans': ('Evans Gambit', {
-                    'Bronstein': ('Bronstein Defense', None),
-                    'Pierce': ('Pierce Defense', None),
-                    'Anderssen': ('Anderssen Variation', None),
-                    'Stone': ('Stone-Ware Variation', None),
-                    'Slow': ('Slow Variation', None),
-                    'Decline': ('Declined', None),
-                    'Other': ('Other', None)
-                }),
-                'Center': ('Center Attack', None),
-                'Main': ('Main Line', {
-                    'Albin': ('Albin Gambit', None),
-                    'Birds': ('Bird\'s Attack', None),
-                    'Other': ('Other', None)
-                }),
-                'Other': ('Other', None)
-            }),
-            'Two-K': ('Two Knights Defense', None),
-            'Knight-A': ('Fried Liver Attack', {
-                'Polerio': ('Polerio Defense', None),
-                'Fritz': ('Fritz Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Scotch': ('Scotch Transpositions', None),
-            'Traxler': ('Traxler Counterattack', None),
-            'Other': ('Other', None)
-        }
-    },
-    'C60-C99': {
-        'displayName': 'Ruy Lopez Opening',
-        'lines': {
-            'Berlin': ('Berlin Defense', {
-                'Improved-S': ('Improved Steinitz Defense', {
-                    'Hedge': ('Hedgehog Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Rio-': ('Rio Gambit', None),
-                'lHerm': ('l\'Hermet Variation', {
-                    'Wall': ('Berlin Wall Defense', None),
-                    'Showalter': ('Showalter Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Bever': ('Beverwijk Variation', None),
-                'Kaufmann': ('Kaufmann Variation', None),
-                'Mortimer': ('Mortimer Variation', None),
-                'Nyholm': ('Nyholm Attack', None),
-                'Other': ('Other', None)
-            }),
-            'Morphy': ('Morphy Defense', {
-                'Open-': ('Open Variation', None),
-                'Close': ('Closed Variation', None),
-                'Modern-S': ('Modern Steinitz Defense', None),
-                'Anderssen': ('Anderssen Variation', None),
-                'Anti-M': ('Anti-Marshall Variation', None),
-                'Exchange': ('Exchange Variation', None),
-                'Caro': ('Caro Variation', None),
-                'Cozio': ('Cozio Defense', None),
-                'Deferred-Cl': ('Deferred Classical Defense', None),
-                'Deferred-Sc': ('Deferred Schliemann Defense', None),
-                'Deferred-Fi': ('Deferred Fianchetto Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Old-Stein': ('Old Steinitz Defense', None),
-            'Classic': ('Classical Defense', None),
-            'Marshall': ('Marshall Attack', None),
-            'Jaenisch': ('Schliemann Defense', None),
-            'Cozio': ('Cozio Defense', None),
-            'Fianchetto': ('Fianchetto Defense', None),
-            'Other': ('Other', None)
-        }
-    },
-    'D06-D69': {
-        'displayName': 'Queen\'s Gambit',
-        'lines': {
-            'Accept': ('Accepted', {
-                'Central': ('Central Variation', {
-                    'Alekhine': ('Alekhine System', None),
-                    'Greco': ('Greco Variation', None),
-                    'Mcdonnell': ('Mcdonnell Defense', None),
-                    'Modern': ('Modern Defense', None),
-                    'Other': ('Other', None)
-                }),
-                'Old': ('Old Variation', None),
-                'Alekhine': ('Alekhine Variation', None),
-                'Showalter': ('Showalter Variation', None),
-                'Classic': ('Classical Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Slav': ('Slav Defense', {
-                'Modern': ('Modern Variation', {
-                    'Quiet': ('Quiet Variation', None),
-                    'Two-K': ('Two Knights Attack', None),
-                    'Three-K': ('Three Knights Variation', None),
-                    'Alapin': ('Alapin Variation', None),
-                    'Triangle': ('Triangle System', None),
-                    'Chameleon': ('Chameleon Variation', None),
-                    'Suchting': ('Suchting Variation', None),
-                    'Other': ('Other', None)
-                }),
-                'Semi-S': ('Semi-Slav Defense', None),
-                'Exchange': ('Exchange Variation', None),
-                'v-Gambit': ('Slav Gambit', None),
-                'Other': ('Other', None)
-            }),
-            'Catalan': ('Catalan Opening', None),
-            'Tarrasch': ('Tarrasch Defense', {
-                'Semi-T': ('Semi-Tarrasch Defense', {
-                    'Main': ('Main Line', None),
-                    'Other': ('Other', None)
-                }),
-                'Two-K': ('Two Knights Variation', {
-                    'Rubin': ('Rubinstein System', None),
-                    'Other': ('Other', None)
-                }),
-                'Other': ('Other', None)
-            }),
-            'Decline': ('Declined', {
-                'Queens-K': ('Queen\'s Knight Variation', None),
-                'Three-K': ('Three Knights Variation', None),
-                'Modern': ('Modern Variation', None),
-                'Tradition': ('Traditional Variation', None),
-                'Ragozin': ('Ragozin Defense', None),
-                'Exchange': ('Exchange Variation', {
-                    'Position': ('Positional Line', None),
-                    'Other': ('Other', None)
-                }),
-                'Charou': ('Charousek Variation', None),
-                'Janowski': ('Janowski Variation', None),
-                'Albin': ('Albin Countergambit', None),
-                'Austrian': ('Austrian Variation', None),
-                'Marshall': ('Marshall Defense', None),
-                'Baltic': ('Baltic Defense', None),
-                'Chigorin': ('Chigorin Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'D70-D99': {
-        'displayName': 'Grunfeld Defense',
-        'lines': {
-            'Exchange': ('Exchange Variation', {
-                'Modern': ('Modern Variation', None),
-                'Classic': ('Classical Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Three-K': ('Three Knights Variation', None),
-            'Hungarian': ('Hungarian Attack', None),
-            'Russian': ('Russian Variation', {
-                'Prins': ('Prins Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Neo-G': ('Neo-Grunfeld Defense', None),
-            'Anti-G': ('Anti-Grunfeld Defense', None),
-            'Stockholm': ('Stockholm Variation', None),
-            'Brinck': ('Brinckmann Attack', {
-                'Capablanca': ('Capablanca Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'E00-E09': {
-        'displayName': 'Catalan Opening',
-        'lines': {
-            'g-Open': ('Open Variation', {
-                'Classic': ('Classical Variation', None),
-                'Modern': ('Modern Variation', None),
-                'Other': ('Other', None)
-            }),
-            'g-Close': ('Closed Variation', None),
-            'East-I': ('East Indian Defense', None),
-            'Other': ('Other', None)
-        }
-    },
-    'E12-E19': {
-        'displayName': 'Queen\'s Indian Defense',
-        'lines': {
-            'Kasparov': ('Kasparov Variation', None),
-            'Spassky': ('Spassky System', None),
-            'Fianchetto': ('Fianchetto Variation', {
-                'Nimzo': ('Nimzowitsch Variation', None),
-                'Capab': ('Capablanca Variation', None),
-                'Classic': ('Classical Variation', None),
-                'Tradition': ('Traditional Line', None),
-                'Main-L': ('Main Line', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'E20-E59': {
-        'displayName': 'Nimzo-Indian Defense',
-        'lines': {
-            'Three-K': ('Three Knights Variation', None),
-            'Spiel': ('Spielmann Variation', None),
-            'Samisch': ('Samisch Variation', None),
-            'Lenin': ('Leningrad Variation', None),
-            'St-P': ('St. Petersburg Variation', {
-                'Fischer': ('Fischer Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Reshev': ('Reshevsky Variation', None),
-            'Bishop': ('Bishop Attack', {
-                'Classic': ('Classical Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Hubner': ('Hubner Variation', {
-                'red-Hub': ('Deferred Hubner Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Kmoch': ('Kmoch Variation', None),
-            'Roman': ('Romanishin-Kasparov System', None),
-            'Gligor': ('Gligoric System', None),
-            'Normal': ('Normal Line', None),
-            'Classic': ('Classical Variation', {
-                'Keres': ('Keres Defense', None),
-                'Zurich': ('Zurich Variaton', None),
-                'Noa-': ('Noa Variation', None),
-                'Berlin': ('Berlin Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Other': ('Other', None)
-        }
-    },
-    'E60-E99': {
-        'displayName': 'King\'s Indian Defense',
-        'lines': {
-            'Fianchetto': ('Fianchetto Variation', None),
-            'Four-P': ('Four Pawns Attack', None),
-            'Samisch': ('Samisch Variation', {
-                'h-Gambit': ('Samisch Gambit', None),
-                'Steiner': ('Steiner Attack', None),
-                'Normal': ('Normal Defense', None),
-                'Other': ('Other', None)
-            }),
-            'Smyslov': ('Smyslov Variation', None),
-            'Kramer': ('Kramer Variation', None),
-            'Makogo': ('Makogonov Variation', None),
-            'Averbakh': ('Averbakh Variation', {
-                'Semi-A': ('Semi-Averbakh Variation', None),
-                'Benoni': ('Benoni Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Orthodox': ('Orthodox Variation', {
-                'Exchange': ('Exchange Variation', None),
-                'Other': ('Other', None)
-            }),
-            'Petros': ('Petrosian Variation', None),
-            'Bayonet': ('Bayonet Attack', None),
-            'Normal': ('Normal Variation', None),
-            'Other': ('Other', None)
+# Local cache for data fetched from chess.com
+cache_dir = os.environ.get('PREP_MATE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'prep-mate-cache'))
+os.makedirs(cache_dir, exist_ok=True)
+cache_db_path = os.path.join(cache_dir, 'cache.sqlite3')
+# Ingestion only helps workers sharing this game store, their flights are keyed by it
+game_store_id = f'{socket.gethostname()}:{os.path.realpath(cache_dir)}'
+
+# Monthly archives stop changing once their month is over; the grace period covers games finished right at the end
+archive_grace_period = timedelta(days=1)
+
+
+def open_cache_db():
+    return sqlite3.connect(cache_db_path, timeout=30)
+
+
+def init_cache_db():
+    with closing(open_cache_db()) as conn, conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS archives (
+                            url TEXT PRIMARY KEY,
+                            body BLOB NOT NULL,
+                            etag TEXT,
+                            last_modified TEXT,
+                            immutable INTEGER NOT NULL DEFAULT 0,
+                            fetched_at TEXT NOT NULL
+                        )''')
+        # Projected facts of every standard chess game ingested for a player, in archive order
+        conn.execute('''CREATE TABLE IF NOT EXISTS games (
+                            username TEXT NOT NULL,
+                            month TEXT NOT NULL,
+                            seq INTEGER NOT NULL,
+                            game_id INTEGER NOT NULL,
+                            url_prefix TEXT NOT NULL,
+                            time_class TEXT NOT NULL,
+                            color INTEGER NOT NULL,
+                            eco TEXT NOT NULL,
+                            line_name TEXT NOT NULL,
+                            win_inc REAL NOT NULL,
+                            white TEXT NOT NULL,
+                            white_rating INTEGER NOT NULL,
+                            black TEXT NOT NULL,
+                            black_rating INTEGER NOT NULL,
+                            date INTEGER NOT NULL,
+                            PRIMARY KEY (username, month, seq)
+                        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS games_by_time_class ON games (username, time_class, date)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS ingested_months (
+                            username TEXT NOT NULL,
+                            month TEXT NOT NULL,
+                            complete INTEGER NOT NULL,
+                            ingested_at TEXT NOT NULL,
+                            PRIMARY KEY (username, month)
+                        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS players (
+                            username TEXT PRIMARY KEY,
+                            archives TEXT NOT NULL,
+                            updated_at TEXT NOT NULL
+                        )''')
+        # Games and wins per (color, leaf) for each month and time class, what the window prefix sums are built from
+        conn.execute('''CREATE TABLE IF NOT EXISTS month_buckets (
+                            username TEXT NOT NULL,
+                            month TEXT NOT NULL,
+                            time_class TEXT NOT NULL,
+                            tree_version TEXT NOT NULL,
+                            games BLOB NOT NULL,
+                            wins BLOB NOT NULL,
+                            variations BLOB,
+                            first_date INTEGER,
+                            last_date INTEGER,
+                            PRIMARY KEY (username, month, time_class)
+                        )''')
+        # Buckets stored before they had variations and dates get them on their next rebuild
+        bucket_columns = {column for _, column, *_ in conn.execute('PRAGMA table_info(month_buckets)')}
+        for column, column_type in (('variations', 'BLOB'), ('first_date', 'INTEGER'), ('last_date', 'INTEGER')):
+            if column not in bucket_columns:
+                conn.execute(f'ALTER TABLE month_buckets ADD COLUMN {column} {column_type}')
+        # Superseded by the games table
+        conn.execute('DROP TABLE IF EXISTS user_aggregates')
+        # Final archives are only kept until their month is stored, see store_month_facts
+        conn.execute('DELETE FROM archives WHERE immutable')
+
+
+if not in_classify_worker:
+    init_cache_db()
+
+# Maximum number of requests to chess.com in flight at once for a single analysis
+ingest_max_in_flight = int(os.environ.get('INGEST_MAX_IN_FLIGHT', 10))
+# Final months are read from the response this many bytes at a time
+archive_stream_chunk_size = 1 << 16
+# Game store reads and writes and the work on fetched months run on these threads. Each analysis runs its own event
+# loop, whose default executor would be started and shut down again with it
+ingest_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('INGEST_WORKERS', 8)),
+                                     thread_name_prefix='ingest')
+
+
+def archive_month_end(archive_url):
+    year, month = map(int, archive_url.rstrip('/').split('/')[-2:])
+    if month == 12:
+        return datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    return datetime(year, month + 1, 1, tzinfo=timezone.utc)
+
+
+def archive_is_final(archive_url):
+    return datetime.now(timezone.utc) >= archive_month_end(archive_url) + archive_grace_period
+
+
+def get_cached_archive(archive_url):
+    with closing(open_cache_db()) as conn:
+        row = conn.execute('SELECT body, etag, last_modified FROM archives WHERE url = ?', (archive_url,)).fetchone()
+    if row is None:
+        return None
+    return {'body': row[0], 'etag': row[1], 'last_modified': row[2]}
+
+
+def archive_request_headers(headers, cached):
+    request_headers = dict(headers)
+    if cached:
+        # Revalidate instead of downloading the whole month again
+        if cached['etag']:
+            request_headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            request_headers['If-Modified-Since'] = cached['last_modified']
+    return request_headers
+
+
+def resolve_archive_response(archive_url, status, response_headers, body, cached):
+    # Returns the body and whether it is final, only a fresh answer fetched after the month ended is
+    now = datetime.now(timezone.utc)
+    immutable = archive_is_final(archive_url)
+
+    # A final body isn't cached, its month is stored complete and never fetched again, see store_month_facts
+    if status == 304 and cached:
+        body = cached['body']
+        if not immutable:
+            with closing(open_cache_db()) as conn, conn:
+                conn.execute('UPDATE archives SET fetched_at = ? WHERE url = ?', (now.isoformat(), archive_url))
+    elif status == 200:
+        if not immutable:
+            with closing(open_cache_db()) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO archives (url, body, etag, last_modified, immutable, fetched_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (archive_url, body, response_headers.get('ETag'), response_headers.get('Last-Modified'),
+                              False, now.isoformat()))
+    elif cached:
+        # Fall back to the stale copy if chess.com is having trouble
+        return cached['body'], False
+    else:
+        return body, False
+
+    return body, immutable
+
+
+async def fetch_json(client, url, headers):
+    # None if chess.com doesn't know the url, any other failure raises aiohttp.ClientResponseError
+    async with client.get(url, headers=headers) as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+async def fetch_archive(client, archive_url, headers, raw=False):
+    # Only open months are in the archive cache, a cached copy is revalidated
+    # The archive cache is read and written on the ingest executor, never on the loop itself
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(ingest_executor, get_cached_archive, archive_url)
+    async with client.get(archive_url, headers=archive_request_headers(headers, cached)) as response:
+        status, response_headers = response.status, response.headers
+        body = await response.read()
+    body, final = await loop.run_in_executor(ingest_executor, resolve_archive_response, archive_url, status,
+                                             response_headers, body, cached)
+    return (body if raw else json.loads(body)), final
+
+
+async def ingest_archives(client, archives, headers, consume, fetch=None):
+    # Fetches run concurrently while a single consumer classifies each month as it arrives,
+    # fetch replaces the plain fetch of a month when its classification happens elsewhere
+    # At most INGEST_MAX_IN_FLIGHT months are being fetched, queued or consumed at once, a month's slot is only
+    # freed once it is consumed so fetched bodies can't pile up behind a slow consumer
+    slots = asyncio.Semaphore(ingest_max_in_flight)
+    queue = asyncio.Queue(maxsize=ingest_max_in_flight)
+
+    async def produce(month):
+        await slots.acquire()
+        try:
+            result = await (fetch(month) if fetch else fetch_archive(client, month, headers))
+        except BaseException:
+            slots.release()
+            raise
+        await queue.put((month, result))
+
+    async def consume_all():
+        # consume writes to the game store, it runs on the ingest executor so the fetches keep going meanwhile
+        loop = asyncio.get_running_loop()
+        for _ in archives:
+            month, games = await queue.get()
+            try:
+                await loop.run_in_executor(ingest_executor, consume, month, games)
+            finally:
+                slots.release()
+
+    await asyncio.gather(consume_all(), *(produce(month) for month in archives))
+
+
+class GameTable:
+    # Columnar store of the games behind the variations, variations refer to games by row index
+    __slots__ = ('strings', 'string_ids', 'game_ids', 'url_prefixes', 'time_classes', 'white_names',
+                 'white_ratings', 'black_names', 'black_ratings', 'white_scores', 'dates')
+
+    string_columns = ('url_prefixes', 'time_classes', 'white_names', 'black_names')
+    columns = {'game_ids': 'q', 'url_prefixes': 'I', 'time_classes': 'I', 'white_names': 'I', 'white_ratings': 'H',
+               'black_names': 'I', 'black_ratings': 'H', 'white_scores': 'B', 'dates': 'I'}
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        for column, typecode in self.columns.items():
+            setattr(self, column, array(typecode))
+
+    def __len__(self):
+        return len(self.game_ids)
+
+    def intern(self, value):
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(sys.intern(value))
+        return string_id
+
+    def append(self, fact):
+        white_win_inc = fact.win_inc if fact.color == 0 else 1 - fact.win_inc
+        row = (fact.game_id, self.intern(fact.url_prefix), self.intern(fact.time_class),
+               self.intern(fact.white), fact.white_rating, self.intern(fact.black), fact.black_rating,
+               int(white_win_inc * 2),  # 0, 1 or 2 half points
+               fact.date)
+
+        # Columns are only touched once every field is known, so a bad row can't leave them uneven
+        for column, value in zip(self.columns, row):
+            getattr(self, column).append(value)
+        return len(self) - 1
+
+    def extend(self, other):
+        # Appends the rows of another table and returns the index of the first one
+        offset = len(self)
+        string_ids = [self.intern(value) for value in other.strings]
+        for column in self.columns:
+            if column in self.string_columns:
+                getattr(self, column).extend(string_ids[string_id] for string_id in getattr(other, column))
+            else:
+                getattr(self, column).extend(getattr(other, column))
+        return offset
+
+    def take(self, rows):
+        # A table of just the given rows, in that order
+        table = GameTable()
+        for column in self.columns:
+            values = getattr(self, column)
+            if column in self.string_columns:
+                getattr(table, column).extend(table.intern(self.strings[values[row]]) for row in rows)
+            else:
+                getattr(table, column).extend(values[row] for row in rows)
+        return table
+
+    def row(self, idx):
+        # The shape the templates expect for a single game
+        white_score = self.white_scores[idx]
+        white_win_inc = white_score // 2 if white_score % 2 == 0 else white_score / 2
+        return {
+            'url': f'{self.strings[self.url_prefixes[idx]]}/{self.game_ids[idx]}',
+            'time_class': self.strings[self.time_classes[idx]],
+            'white': {'username': self.strings[self.white_names[idx]], 'rating': self.white_ratings[idx],
+                      'win_inc': white_win_inc},
+            'black': {'username': self.strings[self.black_names[idx]], 'rating': self.black_ratings[idx],
+                      'win_inc': 1 - white_win_inc},
+            'date': datetime.fromordinal(self.dates[idx]).strftime('%Y.%m.%d') if self.dates[idx] else None
         }
-    }
-}
-
-
-def create_aliases(d):
-    # Bird's Opening
-    for num in range(2, 4):
-        d[f'A0{num}'] = d['A02-A03']
-
-    # Reti Opening
-    for num in range(4, 7):
-        d[f'A0{num}'] = d['A04-A06, A09']
-    d['A09'] = d['A04-A06, A09']
-
-    # King's Indian Attack
-    for num in range(7, 9):
-        d[f'A0{num}'] = d['A07-A08']
-
-    # English Opening
-    for num in range(10, 40):
-        d[f'A{num}'] = d['A10-A39']
-
-    # Uncommon Queen's Pawn
-    # Unusual d4 Openings
-    for num in range(40, 80):
-        d[f'A{num}'] = d['d4']
-    # Uncommon d4-d5 Openings
-    for num in range(0, 6):
-        d[f'D0{num}'] = d['d4']
-    # Unusual d4-Nf6 Openings
-    for num in range(10, 12):
-        d[f'E{num}'] = d['d4']
-
-    # Dutch Defense
-    for num in range(80, 100):
-        d[f'A{num}'] = d['A80-A99']
-
-    # Alekhine's Defense
-    for num in range(2, 6):
-        d[f'B0{num}'] = d['B02-B05']
-
-    # Pirc Defense
-    for num in range(7, 10):
-        d[f'B0{num}'] = d['B07-B09']
-
-    # Caro-Kann Defense
-    for num in range(10, 20):
-        d[f'B{num}'] = d['B10-B19']
-
-    # Sicilian Defense
-    for num in range(20, 100):
-        d[f'B{num}'] = d['B20-B99']
-
-    # French Defense
-    for num in range(0, 10):
-        d[f'C0{num}'] = d['C00-C19']
-    for num in range(10, 20):
-        d[f'C{num}'] = d['C00-C19']
-
-    # Uncommon King's Pawn Opening
-    # Unusual e4 Openings
-    d['B00'] = d['e4']
-    # Uncommon e4-e5 Openings
-    for num in range(20, 23):
-        d[f'C{num}'] = d['e4']
-
-    # Vienna Game
-    for num in range(23, 30):
-        d[f'C{num}'] = d['C23-C29']
-
-    # King's Gambit
-    for num in range(30, 40):
-        d[f'C{num}'] = d['C30-C39']
-
-    # Philidor Defense
-    for num in range(40, 42):
-        d[f'C{num}'] = d['C40-C41']
-
-    # Petrov's Defense
-    for num in range(42, 44):
-        d[f'C{num}'] = d['C42-C43']
-
-    # Four Knights Opening
-    for num in range(47, 50):
-        d[f'C{num}'] = d['C47-C49']
-
-    # Italian Game
-    for num in range(50, 60):
-        d[f'C{num}'] = d['C50-C59']
-
-    # Ruy Lopez Opening
-    for num in range(60, 100):
-        d[f'C{num}'] = d['C60-C99']
-
-    # Queen's Gambit
-    for num in range(6, 10):
-        d[f'D0{num}'] = d['D06-D69']
-    for num in range(10, 70):
-        d[f'D{num}'] = d['D06-D69']
-
-    # Grunfeld Defense
-    for num in range(70, 100):
-        d[f'D{num}'] = d['D70-D99']
-
-    # Catalan Opening
-    for num in range(0, 10):
-        d[f'E0{num}'] = d['E00-E09']
-
-    # Queen's Indian Defense
-    for num in range(12, 20):
-        d[f'E{num}'] = d['E12-E19']
-
-    # Nimzo-Indian Defense
-    for num in range(20, 60):
-        d[f'E{num}'] = d['E20-E59']
-
-    # King's Indian Defense
-    for num in range(60, 99):
-        d[f'E{num}'] = d['E60-E99']
-
-
-def create_line_dict(display_name, sub_lines=None):
-    line_dict = {
-        'displayName': display_name,
-        'numGames': 0,
-        'numWins': 0,
-        'urls': {}
-    }
-    if sub_lines:
-        line_dict['lines'] = {sub_line: create_line_dict(sub_line_name, sub_sub_lines)
-                              for sub_line, (sub_line_name, sub_sub_lines) in sub_lines.items()}
-    return line_dict
-
-
-def create_eco_dict(display_name, lines):
-    return {
-        'displayName': display_name,
-        'numGames': 0,
-        'numWins': 0,
-        'urls': {},
-        'lines': {line: create_line_dict(line_name, sub_lines) for line, (line_name, sub_lines) in lines.items()}
-    }
-
-
-def process_games(d, username, num_months, time_classes):
-    api_url = f"https://api.chess.com/pub/player/{username}/games/archives"
+
+    def to_dict(self):
+        data = {column: getattr(self, column).tolist() for column in self.columns}
+        data['strings'] = self.strings
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        table = cls()
+        for value in data['strings']:
+            table.intern(value)
+        for column, typecode in cls.columns.items():
+            setattr(table, column, array(typecode, data[column]))
+        return table
+
+
+def classify_games(facts):
+    # Games are classified into a partial aggregate of their own, nothing shared is touched until the merge
+    # One (color, leaf, win increment) row per game, colors index opening_colors
+    partial = {'colors': [], 'leaves': [], 'wins': [], 'urls': ({}, {}), 'games': GameTable()}
+    for fact in facts:
+        update_stats(partial, fact)
+
+    partial['colors'] = np.array(partial['colors'], dtype=np.intp)
+    partial['leaves'] = np.array(partial['leaves'], dtype=np.intp)
+    partial['wins'] = np.array(partial['wins'], dtype=np.float64)
+    return partial
+
+
+def merge_partial(d, partial, count=True):
+    # Games and wins per (color, leaf) in one pass, the tree totals are only rolled up when needed
+    if count:
+        node_count = len(opening_node_names)
+        cells = partial['colors'] * node_count + partial['leaves']
+        d['numGames'] += np.bincount(cells, minlength=2 * node_count).reshape(2, node_count)
+        d['numWins'] += np.bincount(cells, weights=partial['wins'], minlength=2 * node_count).reshape(2, node_count)
+
+    offset = d['games'].extend(partial['games'])
+    for color_urls, color_partial in zip(d['urls'], partial['urls']):
+        for leaf, variations in color_partial.items():
+            for line_name, entry in variations.items():
+                add_variation(color_urls.setdefault(leaf, {}), line_name, entry['numGames'], entry['numWins'],
+                              [row + offset for row in entry['games']])
+
+
+def rollup_counts(counts):
+    totals = counts.copy()
+    for level_nodes, level_parents in opening_rollup_levels:
+        np.add.at(totals, (slice(None), level_parents), totals[:, level_nodes])
+    return totals
+
+
+opening_colors = ('white', 'black')
+
+
+def new_opening_stats():
+    # Per (color, node) counters of the games classified at each node, variations only for leaves with games
+    return {'numGames': np.zeros((2, len(opening_node_names)), dtype=np.int64),
+            'numWins': np.zeros((2, len(opening_node_names))),
+            'urls': ({}, {}),
+            'games': GameTable()}
+
+
+def archive_month(archive_url):
+    return '/'.join(archive_url.rstrip('/').split('/')[-2:])
+
+
+def save_player_archives(username, archives):
+    with closing(open_cache_db()) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO players (username, archives, updated_at) VALUES (?, ?, ?)',
+                     (username.lower(), json.dumps(archives), datetime.now(timezone.utc).isoformat()))
+
+
+def load_player_archives(username):
+    with closing(open_cache_db()) as conn:
+        row = conn.execute('SELECT archives FROM players WHERE username = ?', (username.lower(),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def load_ingested_months(username, complete_only=False):
+    query = 'SELECT month FROM ingested_months WHERE username = ?'
+    if complete_only:
+        query += ' AND complete'
+    with closing(open_cache_db()) as conn:
+        return {month for (month,) in conn.execute(query, (username.lower(),))}
+
+
+def store_month_facts(username, archive_url, facts, buckets=None, complete=False):
+    # A month is replaced as a whole, complete marks a body fetched after its month ended, those are final
+    if buckets is None:
+        buckets = month_bucket_counts(facts)
+    month = archive_month(archive_url)
+    now = datetime.now(timezone.utc)
+    with closing(open_cache_db()) as conn, conn:
+        conn.execute('DELETE FROM games WHERE username = ? AND month = ?', (username.lower(), month))
+        conn.executemany(f'INSERT INTO games (username, month, seq, {", ".join(GameFacts._fields)}) '
+                         f'VALUES ({", ".join("?" * (len(GameFacts._fields) + 3))})',
+                         ((username.lower(), month, seq, *fact) for seq, fact in enumerate(facts)))
+        store_month_buckets(conn, username, month, buckets)
+        conn.execute('INSERT OR REPLACE INTO ingested_months (username, month, complete, ingested_at) '
+                     'VALUES (?, ?, ?, ?)', (username.lower(), month, complete, now.isoformat()))
+        if complete:
+            # A complete month is never fetched again, its games table rows are all that's needed from now on
+            conn.execute('DELETE FROM archives WHERE url = ?', (archive_url,))
+
+
+month_variations_encoder = msgspec.msgpack.Encoder()
+month_variations_decoder = msgspec.msgpack.Decoder()
+
+
+def store_month_buckets(conn, username, month, buckets):
+    conn.execute('DELETE FROM month_buckets WHERE username = ? AND month = ?', (username.lower(), month))
+    conn.executemany('INSERT INTO month_buckets (username, month, time_class, tree_version, games, wins, variations, '
+                     'first_date, last_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     ((username.lower(), month, time_class, opening_tree_version, bucket.games, bucket.wins,
+                       month_variations_encoder.encode(bucket.variations), bucket.first_date, bucket.last_date)
+                      for time_class, bucket in buckets.items()))
+
+
+def rebuild_month_buckets(conn, username):
+    # Buckets written under another opening tree point at the wrong nodes, the stored facts still hold
+    rows = conn.execute(f'SELECT month, {", ".join(GameFacts._fields)} FROM games WHERE username = ? '
+                        'ORDER BY month, seq', (username.lower(),))
+    for month, month_rows in groupby(rows, key=lambda row: row[0]):
+        store_month_buckets(conn, username, month,
+                            month_bucket_counts([GameFacts._make(row[1:]) for row in month_rows]))
+    conn.execute('DELETE FROM month_buckets WHERE username = ? AND tree_version != ?',
+                 (username.lower(), opening_tree_version))
+
+
+def refresh_month_buckets(conn, username):
+    # Buckets of another opening tree, or stored before they had variations, are rebuilt before they are read
+    if conn.execute('SELECT 1 FROM month_buckets WHERE username = ? AND (tree_version != ? OR variations IS NULL) '
+                    'LIMIT 1', (username.lower(), opening_tree_version)).fetchone():
+        rebuild_month_buckets(conn, username)
+
+
+# The buckets of a player's stored months over some time classes. Row i of the games and wins prefix sums holds the
+# counts of every month before months[i], the variations and dates are those of months[i] itself
+MonthSums = namedtuple('MonthSums', ['months', 'games', 'wins', 'variations', 'first_dates', 'last_dates'])
+
+# (username, time classes) -> (ingestion stamp, MonthSums)
+month_prefix_cache = LRUCache(maxsize=int(os.environ.get('MONTH_PREFIX_CACHE_SIZE', 32)))
+month_prefix_cache_lock = threading.Lock()
+
+
+def load_month_prefix_sums(username, time_classes):
+    username = username.lower()
+    selected = None if len(time_classes) == 4 else frozenset(time_classes)
+    key = (username, selected)
+    with closing(open_cache_db()) as conn, conn:
+        stamp = conn.execute('SELECT COUNT(*), MAX(ingested_at) FROM ingested_months WHERE username = ?',
+                             (username,)).fetchone()
+        with month_prefix_cache_lock:
+            cached = month_prefix_cache.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+        refresh_month_buckets(conn, username)
+        months = [month for (month,) in conn.execute('SELECT month FROM ingested_months WHERE username = ? '
+                                                     'ORDER BY month', (username,))]
+        buckets = conn.execute('SELECT month, time_class, games, wins, variations, first_date, last_date '
+                               'FROM month_buckets WHERE username = ?', (username,)).fetchall()
+
+    node_count = len(opening_node_names)
+    positions = {month: idx + 1 for idx, month in enumerate(months)}
+    games = np.zeros((len(months) + 1, 2, node_count), dtype=np.int64)
+    wins = np.zeros((len(months) + 1, 2, node_count))
+    variations = [[] for _ in months]
+    first_dates = [None] * len(months)
+    last_dates = [None] * len(months)
+    for month, time_class, month_games, month_wins, month_variations, first_date, last_date in buckets:
+        if month in positions and (selected is None or time_class in selected):
+            idx = positions[month]
+            games[idx] += np.frombuffer(month_games, dtype=np.int32).reshape(2, node_count)
+            wins[idx] += np.frombuffer(month_wins, dtype=np.float32).reshape(2, node_count)
+            variations[idx - 1].extend(month_variations_decoder.decode(month_variations))
+            first_dates[idx - 1] = first_date if first_dates[idx - 1] is None else min(first_dates[idx - 1], first_date)
+            last_dates[idx - 1] = last_date if last_dates[idx - 1] is None else max(last_dates[idx - 1], last_date)
+    np.cumsum(games, axis=0, out=games)
+    np.cumsum(wins, axis=0, out=wins)
+
+    sums = MonthSums(months, games, wins, variations, first_dates, last_dates)
+    with month_prefix_cache_lock:
+        month_prefix_cache[key] = (stamp, sums)
+    return sums
+
+
+def window_counts(username, time_classes, first_month=None, last_month=None):
+    # Games and wins per (color, leaf) over a month window are the difference of two prefix rows
+    sums = load_month_prefix_sums(username, time_classes)
+    lo = bisect.bisect_left(sums.months, first_month) if first_month else 0
+    hi = bisect.bisect_right(sums.months, last_month) if last_month else len(sums.months)
+    return sums.games[hi] - sums.games[lo], sums.wins[hi] - sums.wins[lo]
+
+
+def add_bucket(d, bucket):
+    # Adds a month's counts and variations to stats built without their games
+    node_count = len(opening_node_names)
+    d['numGames'] += np.frombuffer(bucket.games, dtype=np.int32).reshape(2, node_count)
+    d['numWins'] += np.frombuffer(bucket.wins, dtype=np.float32).reshape(2, node_count)
+    add_bucket_variations(d, bucket.variations)
+
+
+def add_bucket_variations(d, variations):
+    for color, leaf, line_name, num_games, num_wins in variations:
+        add_variation(d['urls'][color].setdefault(leaf, {}), line_name, num_games, num_wins, ())
+
+
+def month_within_dates(first_date, last_date, start_date=None, end_date=None):
+    # True if all of a month's games are within the dates, False if only some may be, None if none are
+    # Daily games can start well before the month they end in, so the dates of its games decide and not the month
+    if first_date is None or (start_date and last_date < start_date) or (end_date and first_date > end_date):
+        return None
+    return not ((start_date and first_date < start_date) or (end_date and last_date > end_date))
+
+
+def add_cut_months(d, username, time_classes, months, start_date=None, end_date=None):
+    # Counts the games of months only partly within the dates from the games that are
+    conditions = ['username = ?', f'month IN ({", ".join("?" * len(months))})']
+    params = [username.lower(), *months]
+    if len(time_classes) != 4:
+        conditions.append(f'time_class IN ({", ".join("?" * len(time_classes))})')
+        params.extend(time_classes)
+    if start_date:
+        conditions.append('date >= ?')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date <= ?')
+        params.append(end_date)
+
+    with closing(open_cache_db()) as conn:
+        rows = conn.execute(f'SELECT {", ".join(GameFacts._fields)} FROM games WHERE {" AND ".join(conditions)} '
+                            'ORDER BY month, seq', params)
+        for bucket in month_bucket_counts(map(GameFacts._make, rows)).values():
+            add_bucket(d, bucket)
+
+
+def add_month_counts(d, username, time_classes, months, start_date=None, end_date=None):
+    # Adds just these stored months to stats built without their games, so a running total only reads what's new
+    selected = None if len(time_classes) == 4 else frozenset(time_classes)
+    with closing(open_cache_db()) as conn, conn:
+        refresh_month_buckets(conn, username)
+        rows = conn.execute('SELECT month, time_class, games, wins, variations, first_date, last_date '
+                            'FROM month_buckets '
+                            f'WHERE username = ? AND month IN ({", ".join("?" * len(months))}) ORDER BY month',
+                            (username.lower(), *months)).fetchall()
+
+    cut = []
+    for month, month_rows in groupby(rows, key=lambda row: row[0]):
+        buckets = [MonthBucket(games, wins, month_variations_decoder.decode(variations), first_date, last_date)
+                   for _, time_class, games, wins, variations, first_date, last_date in month_rows
+                   if selected is None or time_class in selected]
+        if not buckets:
+            continue
+        within = month_within_dates(min(bucket.first_date for bucket in buckets),
+                                    max(bucket.last_date for bucket in buckets), start_date, end_date)
+        if within:
+            for bucket in buckets:
+                add_bucket(d, bucket)
+        elif within is not None:
+            cut.append(month)
+
+    if cut:
+        add_cut_months(d, username, time_classes, cut, start_date, end_date)
+    return d
+
+
+def query_opening_stats(username, time_classes, first_month=None, start_date=None, end_date=None, games=True):
+    # Re-aggregates the opening tree straight from the local game store
+    # Without games the variations only carry their counts, then no game is read unless its month is cut by the dates
+    if not games:
+        return query_opening_counts(new_opening_stats(), username, time_classes, first_month, start_date, end_date)
+
+    conditions = ['username = ?']
+    params = [username.lower()]
+    if len(time_classes) != 4:
+        conditions.append(f'time_class IN ({", ".join("?" * len(time_classes))})')
+        params.extend(time_classes)
+    if first_month:
+        conditions.append('month >= ?')
+        params.append(first_month)
+    if start_date:
+        conditions.append('date >= ?')
+        params.append(start_date)
+    if end_date:
+        conditions.append('date <= ?')
+        params.append(end_date)
+
+    d = new_opening_stats()
+    # Whole month windows are counted from the prefix sums, day ranges need the games themselves
+    by_month = not start_date and not end_date
+    if by_month:
+        d['numGames'], d['numWins'] = window_counts(username, time_classes, first_month)
+    with closing(open_cache_db()) as conn:
+        rows = conn.execute(f'SELECT {", ".join(GameFacts._fields)} FROM games WHERE {" AND ".join(conditions)} '
+                            'ORDER BY month, seq', params)
+        merge_partial(d, classify_games(map(GameFacts._make, rows)), count=not by_month)
+    return d
+
+
+def query_opening_counts(d, username, time_classes, first_month, start_date, end_date):
+    # Months whose games are all within the dates are added from their buckets, consecutive ones as a difference of
+    # prefix rows, the months the dates cut into from their games
+    sums = load_month_prefix_sums(username, time_classes)
+    whole, cut = [], []
+    for idx in range(bisect.bisect_left(sums.months, first_month) if first_month else 0, len(sums.months)):
+        within = month_within_dates(sums.first_dates[idx], sums.last_dates[idx], start_date, end_date)
+        if within:
+            whole.append(idx)
+        elif within is not None:
+            cut.append(sums.months[idx])
+
+    for _, run in groupby(enumerate(whole), key=lambda item: item[1] - item[0]):
+        run = [idx for _, idx in run]
+        d['numGames'] += sums.games[run[-1] + 1] - sums.games[run[0]]
+        d['numWins'] += sums.wins[run[-1] + 1] - sums.wins[run[0]]
+        for idx in run:
+            add_bucket_variations(d, sums.variations[idx])
+
+    if cut:
+        add_cut_months(d, username, time_classes, cut, start_date, end_date)
+    return d
+
+
+def select_archives(archives, num_months=None, start_date=None, end_date=None):
+    if start_date or end_date:
+        first_month = start_date.strftime('%Y/%m') if start_date else ''
+        last_month = end_date.strftime('%Y/%m') if end_date else '9999/99'
+        return [archive_url for archive_url in archives if first_month <= archive_month(archive_url) <= last_month]
+    return archives[-num_months:] if num_months is not None else archives
+
+
+def opening_stats_key(username, archives, time_classes, start_date=None, end_date=None):
+    # Identifies an analysis by its player, options and the games stored for its window, colors share one analysis
+    first_month = archive_month(archives[0]) if archives else None
+    with closing(open_cache_db()) as conn:
+        game_state = conn.execute('SELECT month, COUNT(*), MAX(game_id) FROM games WHERE username = ? AND month >= ? '
+                                  'GROUP BY month ORDER BY month', (username.lower(), first_month or '')).fetchall()
+    options = [opening_tree_version, session_stats_format, username.lower(),
+               None if len(time_classes) == 4 else sorted(time_classes), first_month,
+               start_date and start_date.toordinal(), end_date and end_date.toordinal(), game_state]
+    return hashlib.sha256(json.dumps(options).encode()).hexdigest()[:32]
+
+
+def process_games(username, archives, time_classes, start_date=None, end_date=None):
+    # Returns the analysis key, a function building the stats when they have to be stored and the overview of both
+    # colors. The overview is counted from the month buckets, the games are only read to store the analysis
+    analysis_key = opening_stats_key(username, archives, time_classes, start_date, end_date)
+
+    def full_stats():
+        opening_stats = query_selected_stats(username, archives, time_classes, start_date, end_date)
+        stats = {color: prettify_stats(opening_stats, color)[0] for color in opening_colors}
+        stats['games'] = opening_stats['games']
+        return stats
+
+    def analyze():
+        analysis = load_analysis(analysis_key)
+        if analysis is not None:
+            return None, load_session_blob(analysis['stats_url'])
+
+        opening_counts = query_selected_stats(username, archives, time_classes, start_date, end_date, games=False)
+        return full_stats, {color: summarize_lines(prettify_stats(opening_counts, color)[0])
+                            for color in opening_colors}
+
+    # The game store is local to the host, only its storing is coalesced across workers
+    build_stats, overview = single_flight(f'analysis:{analysis_key}', analyze, across_workers=False)
+    return analysis_key, build_stats, overview
+
+
+def query_selected_stats(username, archives, time_classes, start_date=None, end_date=None, games=True):
+    if not archives:
+        return new_opening_stats()
+    return query_opening_stats(username, time_classes, first_month=archive_month(archives[0]),
+                               start_date=start_date and start_date.toordinal(),
+                               end_date=end_date and end_date.toordinal(), games=games)
+
+
+def game_store_client():
+    # One keep-alive pool per update, every request of the update goes through it
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ingest_max_in_flight))
+
+
+async def update_game_store(username, archives, progress=None):
+    # Brings the local game store up to date for the given months,
+    # progress is called with the months stored, the months requested and the games stored so far
     headers = {'User-Agent': 'Chess Prepper'}
-    months = requests.get(api_url, headers=headers).json()
-
-    if num_months is None:
-        num_months = len(months['archives'])
-
-    # Use FuturesSession for concurrent requests
-    futures = []
-    for month in months['archives'][-num_months:]:
-        futures.append(futures_session.get(month, headers=headers))
-
-    for future in as_completed(futures):
-        response = future.result()
-        games = response.json()
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            game_futures = [executor.submit(update_stats, d, game, username, time_classes) for game in games['games']]
-            for game_future in as_completed(game_futures):
-                game_future.result()
-
-
-def update_stats(d, game, username, time_classes):
-    def update_line(d, game_id, game_data, line_name, win_inc):
-        d['numGames'] += 1
-        d['numWins'] += win_inc
-        for line, value in d['lines'].items():
-            if line in line_name:
-                if 'lines' in d['lines'][line]:
-                    update_line(d['lines'][line], game_id, game_data, line_name, win_inc)
-                else:
-                    d['lines'][line]['numGames'] += 1
-                    d['lines'][line]['numWins'] += win_inc
-                    if line_name in d['lines'][line]['urls']:
-                        d['lines'][line]['urls'][line_name]['numGames'] += 1
-                        d['lines'][line]['urls'][line_name]['numWins'] += win_inc
-                        d['lines'][line]['urls'][line_name]['games'][game_id] = game_data
-                    else:
-                        d['lines'][line]['urls'][line_name] = {'numGames': 1, 'numWins': win_inc,
-                                                               'games': {game_id: game_data}}
-                return
-        d['lines']['Other']['numGames'] += 1
-        d['lines']['Other']['numWins'] += win_inc
-        if line_name in d['lines']['Other']['urls']:
-            d['lines']['Other']['urls'][line_name]['numGames'] += 1
-            d['lines']['Other']['urls'][line_name]['numWins'] += win_inc
-            d['lines']['Other']['urls'][line_name]['games'][game_id] = game_data
-        else:
-            d['lines']['Other']['urls'][line_name] = {'numGames': 1, 'numWins': win_inc, 'games': {game_id: game_data}}
+    async with game_store_client() as client:
+        await ingest_games(client, username, archives, headers, progress)
+    return archives
 
-    try:
-        if game['rules'] == 'chess' and (len(time_classes) == 4 or game['time_class'] in time_classes):
-            eco = None
-            eco_url = None
-            date = None
-            for info in game['pgn'].split('\n'):
-                if info.startswith('[ECO '):
-                    eco = info.split('"')[1]
-                elif info.startswith('[ECOUrl'):
-                    eco_url = info.split('"')[1]
-                elif info.startswith('[UTCD'):
-                    date = info.split('"')[1]
-
-            if eco and eco_url:
-                opening_specific = eco_url[31:]
-                game_data = {
-                    'url': game['url'],
-                    'time_class': game['time_class'],
-                    'time_control': game['time_control'],
-                    'white': game['white'],
-                    'black': game['black'],
-                    'date': date
-                }
-                game_id = game['url'].split('/')[-1]
-                win_i = 0
-
-                if game['white']['username'].lower() == username.lower():
-                    if game['white']['result'] == 'win':
-                        win_i = 1
-                    elif game['black']['result'] != 'win':
-                        win_i = .5
-                    game_data['white']['win_inc'] = win_i
-                    game_data['black']['win_inc'] = 1 - win_i
-                    update_line(d['white'][eco], game_id, game_data, opening_specific, win_i)
-                else:
-                    if game['black']['result'] == 'win':
-                        win_i = 1
-                    elif game['white']['result'] != 'win':
-                        win_i = .5
-                    game_data['black']['win_inc'] = win_i
-                    game_data['white']['win_inc'] = 1 - win_i
-                    update_line(d['black'][eco], game_id, game_data, opening_specific, win_i)
-    except KeyError:
-        pass
+
+async def update_player(username, num_months=None, start_date=None, end_date=None, progress=None, found=None):
+    # Starts a new analysis, the profile, the ratings and the archive list are requested together and the months
+    # then reuse their connections. found is called with the profile and stats before any month is fetched
+    headers = {'User-Agent': 'Chess Prepper'}
+    async with game_store_client() as client:
+        (profile_info, stats_info), archives = await asyncio.gather(
+            fetch_player_info(client, username, headers),
+            fetch_player_archives(client, username, headers, num_months, start_date, end_date))
+        if profile_info is None or archives is None:
+            raise LookupError(f"User \"{username}\" not found.")
+
+        if found:
+            found(profile_info, stats_info)
+        await ingest_games(client, username, archives, headers, progress)
+    return profile_info, stats_info, archives
+
+
+# Profiles and ratings change slowly, repeated analyses of a player within PLAYER_INFO_TTL seconds reuse them
+player_info_cache = TTLCache(maxsize=4096, ttl=int(os.environ.get('PLAYER_INFO_TTL', 300)))
+player_info_cache_lock = threading.Lock()
+
+
+async def fetch_player_info(client, username, headers):
+    # The profile and stats of a player, both None if chess.com doesn't know them
+    # Only answers chess.com gave in full are cached, a failed request raises instead
+    with player_info_cache_lock:
+        cached = player_info_cache.get(username.lower())
+    if cached is not None:
+        return cached
+
+    profile_info, stats_info = await asyncio.gather(
+        fetch_json(client, f"https://api.chess.com/pub/player/{username}", headers),
+        fetch_json(client, f"https://api.chess.com/pub/player/{username}/stats", headers))
+    if profile_info is None:
+        return None, None
+    if stats_info is None:
+        # Ratings show as N/A, the next analysis asks again
+        return profile_info, {}
+
+    with player_info_cache_lock:
+        player_info_cache[username.lower()] = profile_info, stats_info
+    return profile_info, stats_info
+
+
+async def fetch_player_archives(client, username, headers, num_months=None, start_date=None, end_date=None):
+    # The archive urls of the requested months, None if chess.com doesn't know the player
+    api_url = f"https://api.chess.com/pub/player/{username}/games/archives"
+    months = await fetch_json(client, api_url, headers)
+    if months is None:
+        return None
+    await asyncio.get_running_loop().run_in_executor(ingest_executor, save_player_archives, username,
+                                                     months['archives'])
+    return select_archives(months['archives'], num_months, start_date, end_date)
+
+
+async def ingest_games(client, username, archives, headers, progress=None):
+    # Months that were complete when ingested never change, every other month is fetched and replaced
+    # Newest months are fetched first, they are what a partial result shows
+    loop = asyncio.get_running_loop()
+    complete = await loop.run_in_executor(ingest_executor, lambda: load_ingested_months(username, complete_only=True))
+    pending = [archive_url for archive_url in reversed(archives) if archive_month(archive_url) not in complete]
+    stored = {archive_url for archive_url in archives if archive_month(archive_url) in complete}
+    games_stored = [0]
+
+    def store_month(archive_url, final, facts, buckets=None):
+        store_month_facts(username, archive_url, facts, buckets, complete=final)
+        stored.add(archive_url)
+        games_stored[0] += len(facts)
+        if progress:
+            progress(stored, archives, games_stored[0])
+
+    # Months are classified as they are fetched, in the classify pool if there is one
+
+    async def classify_archive(archive_url):
+        if not archive_is_final(archive_url):
+            # An open month is buffered, it is cached and revalidated next time
+            body, final = await fetch_archive(client, archive_url, headers, raw=True)
+            return (final, *await loop.run_in_executor(classify_executor, classify_month, body, username))
+
+        # A final month isn't cached, its games are split out of the response as it arrives and projected a chunk
+        # at a time, so the month is never held whole
+        splitter = ArchiveGameSplitter()
+        projected = []
+        async with client.get(archive_url, headers=headers) as response:
+            if response.status != 200:
+                # A copy cached while the month was still open stands in if chess.com is having trouble
+                cached = await loop.run_in_executor(ingest_executor, get_cached_archive, archive_url)
+                if cached is None:
+                    response.raise_for_status()
+                return (False, *await loop.run_in_executor(classify_executor, classify_month, cached['body'], username))
+            async for chunk in response.content.iter_chunked(archive_stream_chunk_size):
+                games = await loop.run_in_executor(ingest_executor, splitter.feed, chunk)
+                if games:
+                    projected.append(loop.run_in_executor(classify_executor, project_archive_games, games, username))
+        splitter.close()
+        facts = [fact for batch in await asyncio.gather(*projected) for fact in batch]
+        return True, facts, await loop.run_in_executor(ingest_executor, month_bucket_counts, facts)
+
+    await ingest_archives(client, pending, headers, lambda archive_url, result: store_month(archive_url, *result),
+                          fetch=classify_archive)
+
+
+# CLASSIFY_WORKERS > 0 parses and classifies months in that many processes, only raw archives or games go out and
+# only facts and bucket counts come back. Workers come from a forkserver that has only imported the openings module,
+# forking this process would copy its threads' locks and its gRPC state mid-flight
+classify_workers = int(os.environ.get('CLASSIFY_WORKERS', 0))
+classify_pool = None
+classify_executor = ingest_executor
+if classify_workers and not in_classify_worker:
+    classify_context = multiprocessing.get_context('forkserver')
+    classify_context.set_forkserver_preload(['openings'])
+    classify_pool = ProcessPoolExecutor(max_workers=classify_workers, mp_context=classify_context)
+    classify_executor = classify_pool
+
+
+def add_variation(variations, line_name, num_games, num_wins, games):
+    if line_name in variations:
+        variations[line_name]['numGames'] += num_games
+        variations[line_name]['numWins'] += num_wins
+        variations[line_name]['games'].extend(games)
+    else:
+        variations[line_name] = {'numGames': num_games, 'numWins': num_wins, 'games': list(games)}
+
+
+def update_stats(partial, fact):
+    # Facts stored under an older taxonomy may name an ECO code that is no longer classified
+    if fact.eco not in opening_roots:
+        return
+
+    leaf = classify_opening(opening_roots[fact.eco], fact.line_name)
+    row = partial['games'].append(fact)
+    partial['colors'].append(fact.color)
+    partial['leaves'].append(leaf)
+    partial['wins'].append(fact.win_inc)
+
+    variations = partial['urls'][fact.color].setdefault(leaf, {})
+    entry = variations.get(fact.line_name)
+    if entry is None:
+        entry = variations[fact.line_name] = {'numGames': 0, 'numWins': 0, 'games': []}
+    entry['numGames'] += 1
+    entry['numWins'] += fact.win_inc
+    entry['games'].append(row)
 
 
 @app.route('/', methods=['GET'])
@@ -1164,48 +1618,237 @@ def home():
     return render_template('index.html')
 
 
+all_time_classes = ['bullet', 'blitz', 'rapid', 'daily']
+
+
+def parse_time_frame(form):
+    # An explicit date range takes precedence over the month window
+    start_date = parse_form_date(form, 'start-date')
+    end_date = parse_form_date(form, 'end-date')
+    if start_date or end_date:
+        time_frame_str = (f"{start_date.strftime('%Y.%m.%d') if start_date else 'first game'} to "
+                          f"{end_date.strftime('%Y.%m.%d') if end_date else 'today'}")
+        return None, start_date, end_date, time_frame_str
+
+    if form.get('allGames') == 'on':
+        return None, None, None, 'all games'
+
+    time_frame = form['num-months']
+    months_or_years = form['monthsOrYears']
+    if months_or_years == 'months':
+        num_months = int(time_frame)
+    else:
+        num_months = int(time_frame) * 12
+    if int(time_frame) == 1:
+        time_frame_str = f"last {months_or_years[:-1]}"
+    else:
+        time_frame_str = f"last {time_frame} {months_or_years}"
+    return num_months, None, None, time_frame_str
+
+
+def parse_form_date(form, field):
+    value = form.get(field)
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+# Analyses run as jobs on a local pool, the request only returns the job id. Progress and completion are
+# emitted to a Socket.IO room named after the job, the result page is served from the session once it is stored
+analysis_job_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('ANALYSIS_JOB_WORKERS', 4)))
+analysis_job_ttl = int(os.environ.get('ANALYSIS_JOB_TTL', 3600))
+analysis_jobs = TTLCache(maxsize=10000, ttl=analysis_job_ttl)
+analysis_jobs_lock = threading.Lock()
+analysis_job_events = {'done': 'job_done', 'failed': 'job_failed'}
+
+# A job runs on the worker that accepted it, with ANALYSIS_JOB_REDIS_URL its state is also kept in Redis so any
+# worker can report it. A Redis SOCKETIO_MESSAGE_QUEUE is used when it isn't set
+analysis_job_redis_url = os.environ.get('ANALYSIS_JOB_REDIS_URL') or \
+    (socketio_message_queue if socketio_message_queue and socketio_message_queue.startswith('redis') else None)
+analysis_job_redis = redis.Redis.from_url(analysis_job_redis_url) if analysis_job_redis_url else None
+
+
 @app.route('/process_games', methods=['POST'])
 def process_games_api():
-    username = request.form['username']
-    color = request.form['color']
-    all_games = request.form.get('allGames') == 'on'
-    time_classes = request.form.getlist('time-classes')
-    num_months = None
+    form = request.form.copy()
+    return submit_analysis_job(lambda progress, partial: analyze_player(form, progress, partial))
+
+
+def submit_analysis_job(analyze):
+    # analyze is called with the job's progress and partial callbacks and returns the session id, player info and
+    # overview of the analysis. The job runs in a copy of this request's context, its result page links to the app
+    job_id = str(uuid.uuid4())
+    save_analysis_job({'job_id': job_id, 'state': 'queued'})
+    analysis_job_executor.submit(copy_current_request_context(run_analysis_job), job_id, analyze)
+    return {'job_id': job_id}, 202
+
+
+def save_analysis_job(job):
+    with analysis_jobs_lock:
+        analysis_jobs[job['job_id']] = job
+    if analysis_job_redis is not None:
+        try:
+            analysis_job_redis.set(f"job:{job['job_id']}", json.dumps(job), px=analysis_job_ttl * 1000)
+        except redis.RedisError as e:
+            print(f"Failed to share job {job['job_id']}: {e}")
+
+
+def load_analysis_job(job_id):
+    # None if neither this worker nor the shared job state knows the job
+    with analysis_jobs_lock:
+        job = analysis_jobs.get(job_id)
+    if job is None and analysis_job_redis is not None:
+        try:
+            shared = analysis_job_redis.get(f'job:{job_id}')
+        except redis.RedisError as e:
+            print(f"Failed to load job {job_id}: {e}")
+            shared = None
+        job = json.loads(shared) if shared else None
+    return job
+
+
+def update_analysis_job(job_id, page=None, **fields):
+    # Only the worker running a job updates it, a rendered page goes out with the update but isn't kept in the job
+    with analysis_jobs_lock:
+        job = {**analysis_jobs.get(job_id, {}), **fields}
+    save_analysis_job(job)
+    socketio.emit(analysis_job_events.get(job['state'], 'job_progress'), {**job, 'page': page} if page else job,
+                  to=job_id)
+
+
+def run_analysis_job(job_id, analyze):
+    def progress(months_done, months_total, games):
+        update_analysis_job(job_id, months_done=months_done, months_total=months_total, games=games)
+
+    def partial(player_info, lines):
+        # Snapshots go out as rendered pages without sorting or details, they have no session behind them
+        # They are rendered on the ingest's own threads, outside the job's request context
+        with app.app_context():
+            page = render_template('process_games.html', stats=lines, playerinfo=player_info, gamesort='checked',
+                                   winsort='', asc='', desc='checked', session_id=None, str=str)
+        socketio.emit('job_partial', {'job_id': job_id, 'page': page}, to=job_id)
+
+    update_analysis_job(job_id, state='running')
+    try:
+        session_id, player_info, overview = analyze(progress, partial)
+        page = render_overview(session_id, player_info, overview)
+    except LookupError as e:
+        update_analysis_job(job_id, state='failed', message=str(e), status=404)
+        return
+    except aiohttp.ClientResponseError as e:
+        print(f"Analysis job {job_id} failed: {e}")
+        update_analysis_job(job_id, state='failed', message=f"chess.com answered {e.status}, try again later",
+                            status=502)
+        return
+    except Exception as e:
+        print(f"Analysis job {job_id} failed: {e}")
+        update_analysis_job(job_id, state='failed', message="Analysis failed", status=500)
+        return
+
+    # The result page goes out while the session is still being written behind it, reads of the session wait for
+    # the write on whichever worker they land
+    update_analysis_job(job_id, page=page, state='done', session_id=session_id)
+
+
+@socketio.on('watch_job')
+def watch_job(job_id):
+    # The current state is sent on joining, a job may have moved on or finished before its client got here
+    # Nothing is sent for a job this worker can't see, its own worker's updates still reach the room
+    join_room(job_id)
+    job = load_analysis_job(job_id)
+    if job is not None:
+        emit(analysis_job_events.get(job['state'], 'job_progress'), job)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def analysis_job_api(job_id):
+    job = load_analysis_job(job_id)
+    if job is None:
+        return "Job not found", 404
+    return job
+
+
+@app.route('/analysis/<session_id>', methods=['GET'])
+def analysis_api(session_id):
+    data = get_session_data(session_id)
 
-    headers = {'User-Agent': 'Chess Prepper'}
-    profile_api_url = f"https://api.chess.com/pub/player/{username}"
-    profile_info = requests.get(profile_api_url, headers=headers).json()
+    if not data:
+        return "Session expired or invalid", 400
 
-    if 'code' in profile_info and profile_info['code'] == 0:
-        return f"User \"{username}\" not found.", 404
+    return render_session(session_id, data, 'num_games', True)
 
-    stats_api_url = f"https://api.chess.com/pub/player/{username}/stats"
-    stats_info = requests.get(stats_api_url, headers=headers).json()
-    rating_info = {}
 
-    if not all_games:
-        time_frame = request.form['num-months']
-        months_or_years = request.form['monthsOrYears']
-        if months_or_years == 'months':
-            num_months = int(time_frame)
-        else:
-            num_months = int(time_frame) * 12
-        if int(time_frame) == 1:
-            time_frame_str = f"last {months_or_years[:-1]}"
-        else:
-            time_frame_str = f"last {time_frame} {months_or_years}"
-    else:
-        time_frame_str = 'all games'
+# Seconds between partial results while months are still being ingested, 0 turns them off
+partial_result_interval = float(os.environ.get('PARTIAL_RESULT_INTERVAL', 1))
+
+
+def newest_stored_months(archives, stored):
+    # The newest months that are all stored, a snapshot of just them is exact for that window
+    count = 0
+    for archive_url in reversed(archives):
+        if archive_url not in stored:
+            break
+        count += 1
+    return archives[len(archives) - count:]
 
-    if color == 'white':
-        not_color = 'black'
-    else:
-        not_color = 'white'
+
+def analyze_player(form, progress=None, partial=None):
+    # Runs the whole analysis for a submitted form and returns the id of its session, its player info and overview,
+    # partial is called with snapshots of the newest months while older ones are still coming in
+    username = form['username']
+    color = form['color']
+    time_classes = form.getlist('time-classes')
+    num_months, start_date, end_date, time_frame_str = parse_time_frame(form)
 
     if not time_classes:
-        time_classes = ['bullet', 'blitz', 'rapid', 'daily']
+        time_classes = all_time_classes
+
+    player_info = {'username': username.lower()}
+
+    def found_player(profile_info, stats_info):
+        player_info.update(display_name=profile_info['url'][29:], all_ratings=player_ratings(stats_info))
+
+    # Snapshots keep a running count of the newest months, each one only adds the months stored since the last
+    last_partial = {'at': None, 'months': 0, 'counts': new_opening_stats()}
+
+    def ingest_progress(stored, archives, games):
+        if progress:
+            progress(len(stored), len(archives), games)
+        if not partial or not partial_result_interval:
+            return
+
+        recent = newest_stored_months(archives, stored)
+        if not last_partial['months'] < len(recent) < len(archives):
+            return
+        if last_partial['at'] is not None and time.monotonic() - last_partial['at'] < partial_result_interval:
+            return
+        added = recent[:len(recent) - last_partial['months']]
+        last_partial['months'] = len(recent)
+
+        add_month_counts(last_partial['counts'], username, time_classes, [archive_month(month) for month in added],
+                         start_date and start_date.toordinal(), end_date and end_date.toordinal())
+        lines, total_games = prettify_stats(last_partial['counts'], color)
+        partial(display_player_info(player_info, color, time_classes,
+                                    f"{time_frame_str}, newest {len(recent)} of {len(archives)} months so far",
+                                    {color: total_games}),
+                summarize_lines(lines, variations=False))
+        last_partial['at'] = time.monotonic()
+
+    # Process games and update stats, requests for the same player and window share one update
+    flight_key = json.dumps(['ingest', game_store_id, username.lower(), num_months,
+                             start_date and start_date.toordinal(), end_date and end_date.toordinal()])
+    profile_info, stats_info, archives = single_flight(
+        flight_key, lambda: asyncio.run(update_player(username, num_months, start_date, end_date,
+                                                      progress=ingest_progress, found=found_player)))
+    found_player(profile_info, stats_info)
+
+    return create_analysis_session(username, archives, player_info, color, time_classes, time_frame_str,
+                                   start_date, end_date)
+
+
+def player_ratings(stats_info):
+    rating_info = {}
 
-    for time_class in time_classes:
+    # Ratings for every time class are kept so later filters don't need to ask chess.com again
+    for time_class in all_time_classes:
         chess_time_class = stats_info.get(f"chess_{time_class}", {})
         last_rating = chess_time_class.get('last', {}).get('rating', 'N/A')
         best_rating = chess_time_class.get('best', {}).get('rating', 'N/A')
@@ -1214,48 +1857,101 @@ def process_games_api():
             'current': last_rating if last_rating != 'N/A' else 'N/A',
             'peak': best_rating if best_rating != 'N/A' else 'N/A'
         }
+    return rating_info
 
-    # Initialize the opening stats dictionary
-    opening_stats_w = {eco: create_eco_dict(details['displayName'], details['lines']) for eco, details in
-                       eco_details.items()}
-    create_aliases(opening_stats_w)
-    opening_stats_b = copy.deepcopy(opening_stats_w)
 
-    opening_stats = {'white': opening_stats_w, 'black': opening_stats_b}
+@app.route('/filter_openings', methods=['POST'])
+def filter_openings_api():
+    # Re-slices an analysis that is on screen from the local game store. A window reaching months never stored
+    # fetches them in a job, like a new analysis, a grown window can mean the player's whole history
+    session_id = request.form['session_id']
+    data = get_session_data(session_id)
 
-    # Process games and update stats
-    process_games(opening_stats, username, num_months, time_classes)
+    if not data or 'username' not in data['player_info']:
+        return "No stats to filter", 400
 
-    # Prettify stats and store them in Firestore
-    stats_w, tot_games_w = prettify_stats(opening_stats['white'])
-    stats_b, tot_games_b = prettify_stats(opening_stats['black'])
-    stats = {
-        'white': stats_w,
-        'black': stats_b
-    }
+    username = data['player_info']['username']
+    archives = load_player_archives(username)
+    if archives is None:
+        return "No stats to filter", 400
 
-    player_info = {'display_name': profile_info['url'][29:], 'color': color, 'not_color': not_color,
-                   'ratings': rating_info, 'time_frame': time_frame_str,
-                   'total_games': {'white': tot_games_w, 'black': tot_games_b}}
+    color = request.form['color']
+    time_classes = request.form.getlist('time-classes') or all_time_classes
+    num_months, start_date, end_date, time_frame_str = parse_time_frame(request.form)
+    archives = select_archives(archives, num_months, start_date, end_date)
 
-    session_id = generate_session_id({
-        'player_info': player_info,
-        'stats': stats
-    })
+    player_info = {key: data['player_info'][key] for key in ('username', 'display_name', 'all_ratings')}
+    ingested = load_ingested_months(username)
+    missing = [archive_url for archive_url in archives if archive_month(archive_url) not in ingested]
+    if not missing:
+        return render_opening_stats(username, archives, player_info, color, time_classes, time_frame_str,
+                                    start_date, end_date)
+
+    def analyze(progress, partial):
+        def ingest_progress(stored, months, games):
+            progress(len(stored), len(months), games)
+
+        single_flight(json.dumps(['ingest-months', game_store_id, username, missing]),
+                      lambda: asyncio.run(update_game_store(username, missing, ingest_progress)))
+        return create_analysis_session(username, archives, player_info, color, time_classes, time_frame_str,
+                                       start_date, end_date)
+
+    return submit_analysis_job(analyze)
 
-    metric = 'num_games'
-    direction = 'True'
 
-    stats[color].sort(key=lambda x: x[metric], reverse=direction)
-    recursive_sort(stats[color], metric, direction)
+def render_opening_stats(username, archives, player_info, color, time_classes, time_frame_str,
+                         start_date=None, end_date=None):
+    session_id, player_info, overview = create_analysis_session(username, archives, player_info, color, time_classes,
+                                                                time_frame_str, start_date, end_date)
 
-    if stats:
-        return render_template('process_games.html', stats=stats[color], playerinfo=player_info, gamesort='checked',
-                               winsort='', asc='', desc='checked', session_id=session_id, str=str)
+    if overview:
+        return render_overview(session_id, player_info, overview)
     else:
         return "No stats available", 400
 
 
+def render_overview(session_id, player_info, overview):
+    # Rendered from the overview in memory, the page's sort, swap and details requests read the session and wait
+    # for its write wherever they land
+    metric = 'num_games'
+    direction = True
+
+    return render_template('process_games.html',
+                           stats=sorted_lines(overview[player_info['color']], metric, direction),
+                           playerinfo=player_info, gamesort='checked', winsort='', asc='', desc='checked',
+                           session_id=session_id, str=str)
+
+
+def display_player_info(player_info, color, time_classes, time_frame_str, total_games):
+    if color == 'white':
+        not_color = 'black'
+    else:
+        not_color = 'white'
+
+    return {**player_info, 'color': color, 'not_color': not_color,
+            'ratings': {time_class: player_info['all_ratings'][time_class] for time_class in time_classes
+                        if time_class in player_info['all_ratings']},
+            'time_frame': time_frame_str,
+            'total_games': total_games}
+
+
+def create_analysis_session(username, archives, player_info, color, time_classes, time_frame_str,
+                            start_date=None, end_date=None):
+    # Returns the new session's id, its player info and the overview of both colors
+    # Identical analyses are stored once, the new session only points at it
+    analysis_key, build_stats, overview = process_games(username, archives, time_classes, start_date, end_date)
+
+    player_info = display_player_info(player_info, color, time_classes, time_frame_str,
+                                      {color: sum(line['num_games'] for line in overview[color])
+                                       for color in opening_colors})
+
+    session_id = generate_session_id({
+        'player_info': player_info,
+        'build_stats': build_stats
+    }, analysis_key)
+    return session_id, player_info, overview
+
+
 @app.route('/sort_openings', methods=['POST'])
 def sort_openings_api():
 
@@ -1265,13 +1961,12 @@ def sort_openings_api():
     if not data:
         return "No stats to sort", 400
 
-    metric = request.form['metric']
-    direction = request.form['direction'] == 'True'
-    color = data['player_info']['color']
-    stats = data['stats'][color]
-    stats.sort(key=lambda x: x[metric], reverse=direction)
+    return render_session(session_id, data, request.form['metric'], request.form['direction'] == 'True')
+
 
-    recursive_sort(stats, metric, direction)
+def render_session(session_id, data, metric, direction):
+    color = data['player_info']['color']
+    stats = sorted_lines(session_overview(data, color), metric, direction)
 
     gamesort = 'checked' if metric == 'num_games' else ''
     winsort = 'checked' if metric == 'win_rate' else ''
@@ -1282,11 +1977,12 @@ def sort_openings_api():
                            winsort=winsort, asc=asc, desc=desc, session_id=session_id, str=str)
 
 
-def recursive_sort(lines, metric, direction):
-    for line in lines:
-        if 'sub_lines' in line and line['sub_lines']:
-            line['sub_lines'].sort(key=lambda x: x[metric], reverse=direction)
-            recursive_sort(line['sub_lines'], metric, direction)
+def sorted_lines(lines, metric, direction):
+    # Sorts copies, session stats are shared through the cache and have to stay in stored order for the paths
+    lines = [{**line, 'sub_lines': sorted_lines(line['sub_lines'], metric, direction)} if line.get('sub_lines')
+             else line for line in lines]
+    lines.sort(key=lambda x: x[metric], reverse=direction)
+    return lines
 
 
 @app.route('/swap_colors', methods=['POST'])
@@ -1303,13 +1999,14 @@ def swap_colors_api():
     data['player_info']['color'] = new_color
     data['player_info']['not_color'] = old_color
 
-    db.collection('sessions').document(session_id).update({
+    session_store.update_session(session_id, {
         'player_info.color': new_color,
         'player_info.not_color': old_color
     })
 
-    return render_template('process_games.html', stats=data['stats'][new_color], playerinfo=data['player_info'],
-                           gamesort='checked', winsort='', asc='', desc='checked', session_id=session_id, str=str)
+    return render_template('process_games.html', stats=session_overview(data, new_color),
+                           playerinfo=data['player_info'], gamesort='checked', winsort='', asc='', desc='checked',
+                           session_id=session_id, str=str)
 
 
 @app.route('/opening_details')
@@ -1317,16 +2014,20 @@ def opening_details():
     current_session_id = request.args.get('current_session_id', None)
     session_info = get_session_data(current_session_id)
 
-    if not session_info or 'stats' not in session_info:
+    if not session_info or 'stats_url' not in session_info:
         return "Session expired or invalid", 400
 
-    variation = session_info['stats']
     path = request.args.get('path', None)
-    keys = path.split('.')
+    keys = [key for key in path.split('.') if key]
+
+    # The path starts with the color and the opening, only that opening's shard is loaded
+    if len(keys) < 2 or keys[0] not in opening_colors or not keys[1].isdigit():
+        return f"Invalid path: {path}", 400
+    variation, games = session_opening(session_info, keys[0], int(keys[1]))
 
     print("Initial variation type:", type(variation))
 
-    for key in keys:
+    for key in keys[2:]:
         if not key:  # Skip empty keys
             continue
 
@@ -1348,20 +2049,32 @@ def opening_details():
 
     parent = request.args.get('parent', '')
 
-    for line in variation['variations'].values():
-        line['games'] = dict(
-            sorted(line['games'].items(), key=lambda item: datetime.strptime(item[1]['date'], '%Y.%m.%d'),
-                   reverse=True))
+    # Only the games of this variation are expanded for the template, newest first
+    variations = {}
+    if games is None:
+        for line_name, line in variation['variations'].items():
+            variations[line_name] = {**line, 'games': dict(sorted(line['games'].items(),
+                                                                  key=lambda item: item[1]['date'], reverse=True))}
+    else:
+        games = GameTable.from_dict(games)
+        for line_name, line in variation['variations'].items():
+            rows = sorted(line['games'], key=lambda row: games.dates[row], reverse=True)
+            variations[line_name] = {**line, 'games': {games.game_ids[row]: games.row(row) for row in rows}}
+    variation = {**variation, 'variations': variations}
 
     return render_template('opening_details.html', variation=variation, parent=parent,
                            playerinfo=session_info['player_info'])
 
 
-def prettify_stats(stats_dict):
-    def recursive_build(details, current_id=0):
-        num_games = details['numGames']
-        num_wins = details['numWins']
-        win_rate = int(round((num_wins / num_games * 100), 0)) if num_games > 0 else 0  # Calculate and round win rate
+def prettify_stats(stats_dict, color):
+    color_idx = opening_colors.index(color)
+    num_games = rollup_counts(stats_dict['numGames'])[color_idx].tolist()
+    num_wins = rollup_counts(stats_dict['numWins'])[color_idx].tolist()
+    urls = stats_dict['urls'][color_idx]
+
+    def recursive_build(node, current_id=0):
+        # Calculate and round win rate
+        win_rate = int(round((num_wins[node] / num_games[node] * 100), 0)) if num_games[node] > 0 else 0
 
         # Calculate win rate for each variation
         variations = {
@@ -1371,58 +2084,40 @@ def prettify_stats(stats_dict):
                 'winRate': int(round((value['numWins'] / value['numGames'] * 100), 0)) if value['numGames'] > 0 else 0,
                 'games': value['games']
             }
-            for key, value in details.get('urls', {}).items()
+            for key, value in urls.get(node, {}).items()
         }
 
         result = {
             'id': current_id,  # Use current_id as the unique identifier
-            'display_name': details['displayName'],
-            'num_games': num_games,
+            'display_name': opening_node_names[node],
+            'num_games': num_games[node],
             'win_rate': win_rate,  # Store win rate as an integer
             'variations': variations,
             'sub_lines': []
         }
 
-        if 'lines' in details:
-            newer_idx = 0
-            for key, sub_details in details['lines'].items():
-                if sub_details and sub_details['numGames'] > 0:  # Ensuring there is data to process
-                    result['sub_lines'].append(recursive_build(sub_details, newer_idx))
-                    newer_idx += 1
+        newer_idx = 0
+        for line, sub_node in opening_node_lines[node]:
+            # Promoted lines are listed as openings of their own
+            if opening_node_parents[sub_node] == node and num_games[sub_node] > 0:
+                result['sub_lines'].append(recursive_build(sub_node, newer_idx))
+                newer_idx += 1
 
         return result
 
-    def move_opening(new_eco_name, old_eco, old_name):
-        stats_dict[new_eco_name] = stats_dict[old_eco]['lines'][old_name]
-        del stats_dict[old_eco]['lines'][old_name]
-        stats_dict[old_eco]['numGames'] -= stats_dict[new_eco_name]['numGames']
-        stats_dict[old_eco]['numWins'] -= stats_dict[new_eco_name]['numWins']
-
-    move_opening('london', 'd4', 'London')
-    move_opening('indian', 'd4', 'Indian')
-    move_opening('benoni', 'd4', 'Benoni')
-    move_opening('trompowsky', 'd4', 'Tromp')
-
-    move_opening('nimzo-def', 'e4', 'Nimzo')
-    move_opening('ponziani', 'e4', 'Ponzi')
-
-    move_opening('grob', 'A00', 'Grob')
-    move_opening('kings-fianchetto', 'A00', 'Kings-F')
-    move_opening('polish', 'A00', 'Polish')
-
     results = []
     seen = set()
     new_idx = 0
     total_games = 0
-    for eco_code, details in stats_dict.items():
-        if details['displayName'] not in seen and details['numGames'] > 0:
-            results.append(recursive_build(details, new_idx))
+    for node in opening_display_roots:
+        if opening_node_names[node] not in seen and num_games[node] > 0:
+            results.append(recursive_build(node, new_idx))
             new_idx += 1
-            total_games += details['numGames']
-            seen.add(details['displayName'])
+            total_games += num_games[node]
+            seen.add(opening_node_names[node])
 
     return results, total_games
 
 
 if __name__ == '__main__':
-    app.run(debug=False)
+    socketio.run(app, debug=False)
@@ -0,0 +1,1187 @@
+# The opening taxonomy and the classification of archive games into it
+# Importing this module has no side effects beyond building the tables, the classify pool's processes load it
+# without the app
+import hashlib
+import json
+import msgspec
+import numpy as np
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+
+# Grouping openings by ECO and name
+eco_details = {
+    'A00': {
+        'displayName': 'Uncommon Openings',
+        'lines': {
+            'Grob': ('Grob Opening', {
+                'Grob-Gambit': ('Grob Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Kings-F': ('King\'s Fianchetto Opening', {
+                'Symmetrical': ('Symmetrical Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Polish': ('Polish Opening', {
+                'Kuchark': ('Kucharkowski-Meybohm Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'A01': {
+        'displayName': 'Nimzowitsch-Larsen Attack',
+        'lines': {
+            'Classical': ('Classical Variation', None),
+            'English': ('English Variation', None),
+            'Indian': ('Indian Variation', None),
+            'Modern': ('Modern Variation', None),
+            'Symmetrical': ('Symmetrical Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'A02-A03': {
+        'displayName': 'Bird\'s Opening',
+        'lines': {
+            'Froms': ('From\'s Gambit', None),
+            'Dutch': ('Dutch Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'A04-A06, A09': {
+        'displayName': 'Reti Opening',
+        'lines': {
+            'Dutch': ('Dutch Variation', None),
+            'Kingside': ('Kingside Fianchetto Variation', None),
+            'Queenside': ('Queenside Fianchetto Variation', None),
+            'Quiet': ('Quiet System', None),
+            'Nimzo': ('Nimzo-Larsen Variations', None),
+            'Kings-Indian': ('King\'s Indian Attack Variations', None),
+            'Reti-Gambit': ('Reti Gambit', {
+                'Accept': ('Accepted', None),
+                'Decline': ('Declined', None),
+                'Other': ('Other', None)
+            }),
+            'Tennison': ('Tennison Gambit', None),
+            'Sicilian': ('Sicilian Invitation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'A07-A08': {
+        'displayName': 'King\'s Indian Attack',
+        'lines': {
+            'Double': ('Double Fianchetto Variation', None),
+            'French': ('French Variation', None),
+            'Sicilian': ('Sicilian Variation', None),
+            'Yugoslav': ('Yugoslav Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'A10-A39': {
+        'displayName': 'English Opening',
+        'lines': {
+            'Great-S': ('Great Snake Variation', None),
+            'Caro': ('Caro-Kann Defensive System', None),
+            'Anglo-Indian': ('Anglo-Indian Variation', None),
+            'Anglo-Scandi': ('Anglo-Scandinavian Variation', None),
+            'Agincourt': ('Agincourt Defense', None),
+            'Kings-Eng': ('King\'s English Variation', None),
+            'Reversed-S': ('Reversed Sicilian Variation', None),
+            'Carls-B': ('Carls-Bremen System', None),
+            'Mikenas': ('Mikenas-Carls Variation', None),
+            'Symmetrical': ('Symmetrical Variation', None),
+            'ning-Four-K': ('Four Knights Variation', None),
+            'ning-Two-K': ('Two Knights Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'd4': {
+        'displayName': 'Uncommon d4 Openings',
+        'lines': {
+            'Englund': ('Englund Gambit', {
+                'Decline': ('Declined', None),
+                'Other': ('Other', None)
+            }),
+            'Modern-D': ('Modern Defense (1. d4)', {
+                'Ptero': ('Pterodactyl Defense', None),
+                'Averbak': ('Averbakh-Kotov Variation', None),
+                'Other': ('Other', None)
+            }),
+            'English': ('English Defense', None),
+            'Tartakower': ('Tartakower Variation', None),
+            'Benoni': ('Benoni Defense', {
+                'Old-B': ('Old Benoni Defense', None),
+                'Modern': ('Modern Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Budapest': ('Budapest Gambit', None),
+            'Benko': ('Benko Gambit', {
+                'Decline': ('Declined', None),
+                'Half': ('Half-Accepted', None),
+                'Full': ('Fully-Accepted', None),
+                'Other': ('Other', None)
+            }),
+            'Tromp': ('Trompowsky Attack', {
+                'Classical': ('Classical Variation', None),
+                'Poison': ('Poisoned-Pawn Variation', None),
+                'Other': ('Other', None)
+            }),
+            'ti-Nimzo': ('Anti-Nimzo-Indian Variation', None),
+            'Blumen': ('Blumenfeld Countergambit', None),
+            'Torre': ('Torre Attack', None),
+            'London': ('London System', {
+                'Accel': ('Accelerated London System', {
+                    'Steinitz': ('Steinitz Countergambit', None),
+                    'Other': ('Other', None)
+                }),
+                'Indian': ('Indian Game Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Indian': ('Indian Game', {
+                'East-I': ('East Indian Variation', None),
+                'Old-I': ('Old Indian Defense', None),
+                'Bogo-I': ('Bogo-Indian Defense', {
+                    'Exchange': ('Exchange Variation', None),
+                    'Grunfeld': ('Grunfeld Variation', None),
+                    'Nimzo': ('Nimzowitsch Variation', None),
+                    'Vitolins': ('Vitolins Variation', None),
+                    'Wade-S': ('Wade-Smyslov Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Polish': ('Polish Variation', None),
+                'Spielmann': ('Spielmann Indian Variation', None),
+                'Yusupov': ('Yusupov-Rubinstein System', None),
+                'Accel': ('Accelerated Variation', None),
+                'Knights': ('Knights Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Rossolimo': ('Rossolimo Variation', None),
+            'Horwitz': ('Horwitz Defense', None),
+            'Zuker': ('Zukertort Variation', None),
+            'Chigorin': ('Chigorin Variation', None),
+            'Levitsky': ('Levitsky Attack', None),
+            'Stonewall': ('Stonewall Attack', None),
+            'Blackmar': ('Blackmar Gambit', None),
+            'Colle': ('Colle System', None),
+            'Symmetrical': ('Symmetrical Variation', None),
+            'Krause': ('Krause Variation', None),
+            'Pseudo': ('Pseudo Catalan Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'A80-A99': {
+        'displayName': 'Dutch Defense',
+        'lines': {
+            'Fianchetto': ('Fianchetto Variation', {
+                'Lenin': ('Leningrad Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Staunton': ('Staunton Gambit', {
+                'Accept': ('Accepted', None),
+                'Other': ('Other', None)
+            }),
+            'Lenin': ('Leningrad Variation', None),
+            'Classic': ('Classical Variation', None),
+            'Normal': ('Normal Variation', None),
+            'Queen': ('Queen\'s Knight Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'e4': {
+        'displayName': 'Uncommon e4 Openings',
+        'lines': {
+            'Nimzo': ('Nimzowitsch Defense', {
+                'Decline': ('Declined', None),
+                'Kennedy': ('Kennedy Variation', None),
+                'Scandi': ('Scandinavian Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Ponzi': ('Ponziani Opening', {
+                'Jaenisch': ('Jaenisch Counterattack', None),
+                'Steinitz': ('Steinitz Variation', None),
+                'Counter': ('Ponziani Countergambit', None),
+                'Spanish': ('Spanish Variation', None),
+                'Kings-P': ('Weird Anti-Ponziani Lines', None),
+                'Other': ('Other', None)
+            }),
+            'Owen': ('Owen\'s Defense', None),
+            'Wayward': ('Wayward Queen Attack', None),
+            'Center': ('Center Game', None),
+            'Danish': ('Danish Gambit', None),
+            'Kings-K': ('King\'s Knight Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B01': {
+        'displayName': 'Scandinavian Defense',
+        'lines': {
+            'Mieses': ('Mieses-Kotrc Variation', {
+                'Main-L': ('Main Line', None),
+                'Gubinsky': ('Gubinsky-Melts Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Closed': ('Closed Variation', None),
+            'Modern': ('Modern Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B02-B05': {
+        'displayName': 'Alekhine\'s Defense',
+        'lines': {
+            'Two-P': ('Two Pawns Attack', {
+                'Lasker': ('Lasker Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Scandi': ('Scandinavian Variation', None),
+            'Four-P': ('Four Pawns Attack', None),
+            'Modern': ('Modern Variation', None),
+            'Normal': ('Normal Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B06': {
+        'displayName': 'Modern Defense',
+        'lines': {
+            'Standard': ('Standard Line', {
+                'Ptero': ('Pterodactyl Variation', None),
+                'Two-K': ('Two Knights Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Ptero': ('Pterodactyl Variations', None),
+            'Mongred': ('Mongredien Defense', None),
+            'Three-P': ('Three Pawns Attack', None),
+            'Gurgen': ('Gurgenidze Variation', None),
+            'Bishop-A': ('Bishop Attack', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B07-B09': {
+        'displayName': 'Pirc Defense',
+        'lines': {
+            'Main': ('Main Line', {
+                'Austrian': ('Austrian Attack', None),
+                'Other': ('Other', None)
+            }),
+            'Geller': ('Geller System', None),
+            'Classic': ('Classical Variations', None),
+            'Czech': ('Czech Defense', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B10-B19': {
+        'displayName': 'Caro-Kann Defense',
+        'lines': {
+            'Accelerated-P': ('Accelerated Panov Attack', None),
+            'Two-K': ('Two Knights Attack', {
+                'Mindeno': ('Mindeno Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Advance': ('Advance Variation', {
+                'Tal-': ('Tal Variation', None),
+                'Botvin': ('Botvinnik-Carls Defense', None),
+                'Short': ('Short Variation', None),
+                'Van-': ('Van der Wiel Attack', None),
+                'Bronst': ('Bronstein Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Exchange': ('Exchange Variation', None),
+            'se-Panov': ('Panov Attack', None),
+            'Gurgen': ('Gurgenidze System', None),
+            'Main-L': ('Main Line', None),
+            'Tartakower': ('Tartakower Variation', None),
+            'stein-L': ('Bronstein-Larsen Variation', None),
+            'Karpov': ('Karpov Variation', None),
+            'Classic': ('Classical Variation', None),
+            'Breyer': ('Breyer Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'B20-B99': {
+        'displayName': 'Sicilian Defense',
+        'lines': {
+            'Smith-Mor': ('Smith-Morra Gambit', {
+                'Accept': ('Accepted', None),
+                'Decline': ('Declined', {
+                    'Center': ('Center Formation', None),
+                    'Push': ('Push Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Morphy': ('Morphy Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Alapin': ('Alapin Variation', {
+                'Delay': ('Delayed Alapin Variation', None),
+                'Barmen': ('Barmen Defense', None),
+                'Stoltz': ('Stoltz Attack', None),
+                'Other': ('Other', None)
+            }),
+            'Closed-S': ('Closed Sicilian', {
+                'Grand-P': ('Grand Prix Attack', None),
+                'Magnus': ('Magnus Sicilian', None),
+                'Traditional': ('Traditional Variation', None),
+                'Fianchetto': ('Fianchetto Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Hyperaccel': ('Hyperaccelerated Dragon', None),
+            'OKelly': ('O\'Kelly Variation', {
+                'Maroczy': ('Maroczy Bind Variation', None),
+                'Normal': ('Normal System', None),
+                'Venice': ('Venice System', None),
+                'Yerevan': ('Yerevan System', None),
+                'Other': ('Other', None)
+            }),
+            'Open': ('Open Sicilian', {
+                'Lowenth': ('Lowenthal Variation', None),
+                'Pelikan': ('Pelikan and Sveshnikov Variations', None),
+                'Accel': ('Accelerated Dragon', {
+                    'Maroczy': ('Maroczy Bind Formation', None),
+                    'Modern': ('Modern Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'en-Classic': ('Classical Variation', None),
+                'n-Dragon': ('Dragon Variation', None),
+                'Scheven': ('Scheveningen Variation', {
+                    'Sozin': ('Sozin Attack', None),
+                    'Other': ('Other', None)
+                }),
+                'Najdorf': ('Najdorf Variation', {
+                    'Adam': ('Adam\'s Attack', None),
+                    'English': ('English Attack', None),
+                    'Freak': ('Freak Attack', None),
+                    'Lipnit': ('Lipnitsky Attack', None),
+                    'Opocensky': ('Opocensky Variation', None),
+                    'Zagreb': ('Zagreb Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Other': ('Other', None)
+            }),
+            'e-Kan': ('Kan Variation', {
+                'Maroczy': ('Maroczy Bind Formation', None),
+                'Modern': ('Modern Variation', None),
+                'Knight': ('Knight Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Chekhover': ('Chekhover Variation', None),
+            'Canal': ('Canal Attack', None),
+            'Taimanov': ('Taimanov Variation', None),
+            'Four-K': ('Four Knights Variation', None),
+            'Nimzowitsch': ('Nimzowitsch Variation', None),
+            'Nyezhmet': ('Nyezhmetdinov-Rossolimo Attack', None),
+            'Snyder': ('Snyder Variation', None),
+            'Staunton-Coch': ('Staunton-Cochrane Variation', None),
+            'Bowdler': ('Bowdler Attack', None),
+            'Lasker-D': ('Lasker-Dunne Atack', None),
+            'Wing-G': ('Wing Gambit', None),
+            'McDonn': ('McDonnell Attack', None),
+            'Mengarini': ('Mengarini Variation', None),
+            'Pin-V': ('Pin Variation', None),
+            'Tartakower': ('Tartakower Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C00-C19': {
+        'displayName': 'French Defense',
+        'lines': {
+            'Tarrasch': ('Tarrasch Variation', {
+                'Open': ('Open Variation', None),
+                'Close': ('Closed Variation', None),
+                'Guimard': ('Guimard Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Classic': ('Classical Variation', {
+                'Steinitz': ('Steinitz Variation', None),
+                'MacCutch': ('MacCutcheon Variation', None),
+                'Burn': ('Burn Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Winawer': ('Winawer Variation', {
+                'Advance': ('Advance Variation', None),
+                'Delay': ('Delayed Exchange Variation', None),
+                'Alekhine': ('Alekhine-Maroczy Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Advance': ('Advance Variation', {
+                'Paulsen': ('Paulsen Attack', None),
+                'Nimzo': ('Nimzowitsch System', None),
+                'Wade': ('Wade Variation', None),
+                'Other': ('Other', None)
+            }),
+            'e-Exchange': ('Exchange Variation', None),
+            'Rubinstein': ('Rubinstein Variation', None),
+            'Kings-I': ('King\'s Indian Attack', None),
+            'Two-K': ('Two Knights Variation', None),
+            'e-Normal': ('Normal Variation', None),
+            'Queens-K': ('Queen\'s Knight Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C23-C29': {
+        'displayName': 'Vienna Game',
+        'lines': {
+            'Max-L': ('Max Lange Defense', {
+                'Steinitz': ('Steinitz Gambit', None),
+                'Meitner': ('Meitner-Mieses Gambit', None),
+                'Paulsen': ('Paulsen Variation', None),
+                'nna-Gambit': ('Vienna Gambit', {
+                    'Knight': ('Knight Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Other': ('Other', None)
+            }),
+            'Falkbeer': ('Falkbeer Variation', {
+                'Mieses': ('Mieses Variation', None),
+                'Stanley': ('Stanley Variation', None),
+                'nna-Gambit': ('Vienna Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Main-L': ('Main Line', {
+                'Paulsen': ('Paulsen Attack', None),
+                'Other': ('Other', None)
+            }),
+            'Anderssen': ('Anderssen Defense', None),
+            'Zhura': ('Zhuravlev Countergambit', None),
+            'Bishops': ('Bishop\'s Opening', {
+                'Berlin': ('Berlin Variation', {
+                    'Spiel': ('Spielmann Attack', None),
+                    'Vienna': ('Vienna Hybrid Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'C30-C39': {
+        'displayName': 'King\'s Gambit',
+        'lines': {
+            'Traditional': ('Traditional Variation', None),
+            'Bishops': ('Bishop\'s Gambit', None),
+            'Kieser': ('Kieseritzky Gambit', None),
+            'Decline': ('Declined', {
+                'Classic': ('Classical Variation', None),
+                'Queens-K': ('Queen\'s Knight Defense', None),
+                'Falkbeer': ('Falkbeer Countergambit', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'C40-C41': {
+        'displayName': 'Philidor Defense',
+        'lines': {
+            'Exchange': ('Exchange Variation', None),
+            'Hanham': ('Hanham Variation', None),
+            'Nimzo': ('Nimzowitsch Variation', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C42-C43': {
+        'displayName': 'Petrov\'s Defense',
+        'lines': {
+            'Stafford': ('Stafford Gambit', None),
+            'Classic': ('Classical Attack', {
+                'Marshall': ('Marshall Variation', None),
+                'Cozio': ('Cozio Attack', None),
+                'Damiano': ('Damiano Variation', None),
+                'Karklin': ('Karklins-Martinovsky Variation', None),
+                'Millenni': ('Millennium Attack', None),
+                'Nimzo': ('Nimzowitsch Attack', None),
+                'Paulsen': ('Paulsen Attack', None),
+                'Other': ('Other', None)
+            }),
+            'Three-K': ('Three Knights Game', None),
+            'Steinitz': ('Steinitz Attack', None),
+            'Urusov': ('Urusov Gambit', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C45': {
+        'displayName': 'Scotch Game',
+        'lines': {
+            'Classic': ('Classical Variation', {
+                'Inter': ('Intermezzo Variation', None),
+                'Potter': ('Potter Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Schmidt': ('Schmidt Variation', {
+                'Mieses': ('Mieses Variation', None),
+                'Tarta': ('Tartakower Variation', None),
+                'Other': ('Other', None)
+            }),
+            'tch-Gambit': ('Scotch Gambit', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C46': {
+        'displayName': 'Three Knights Opening',
+        'lines': {
+            'Steinitz': ('Steinitz Defense', None),
+            'Winawer': ('Winawer Defense', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C47-C49': {
+        'displayName': 'Four Knights Game',
+        'lines': {
+            'Gunsberg': ('Gunsberg Variation', None),
+            'Italian': ('Italian Variation', None),
+            'Scotch': ('Scotch Variation', None),
+            'Spanish': ('Spanish Variation', {
+                'Classic': ('Classical Variation', None),
+                'Rubin': ('Rubinstein Countergambit', None),
+                'Double': ('Double Spanish Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'C50-C59': {
+        'displayName': 'Italian Game',
+        'lines': {
+            'Giuoco': ('Giuoco Piano Game', {
+                'Pianissimo': ('Pianissimo Variation', {
+                    'Four-K': ('Four Knights Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Evans': ('Evans Gambit', {
+                    'Bronstein': ('Bronstein Defense', None),
+                    'Pierce': ('Pierce Defense', None),
+                    'Anderssen': ('Anderssen Variation', None),
+                    'Stone': ('Stone-Ware Variation', None),
+                    'Slow': ('Slow Variation', None),
+                    'Decline': ('Declined', None),
+                    'Other': ('Other', None)
+                }),
+                'Center': ('Center Attack', None),
+                'Main': ('Main Line', {
+                    'Albin': ('Albin Gambit', None),
+                    'Birds': ('Bird\'s Attack', None),
+                    'Other': ('Other', None)
+                }),
+                'Other': ('Other', None)
+            }),
+            'Two-K': ('Two Knights Defense', None),
+            'Knight-A': ('Fried Liver Attack', {
+                'Polerio': ('Polerio Defense', None),
+                'Fritz': ('Fritz Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Scotch': ('Scotch Transpositions', None),
+            'Traxler': ('Traxler Counterattack', None),
+            'Other': ('Other', None)
+        }
+    },
+    'C60-C99': {
+        'displayName': 'Ruy Lopez Opening',
+        'lines': {
+            'Berlin': ('Berlin Defense', {
+                'Improved-S': ('Improved Steinitz Defense', {
+                    'Hedge': ('Hedgehog Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Rio-': ('Rio Gambit', None),
+                'lHerm': ('l\'Hermet Variation', {
+                    'Wall': ('Berlin Wall Defense', None),
+                    'Showalter': ('Showalter Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Bever': ('Beverwijk Variation', None),
+                'Kaufmann': ('Kaufmann Variation', None),
+                'Mortimer': ('Mortimer Variation', None),
+                'Nyholm': ('Nyholm Attack', None),
+                'Other': ('Other', None)
+            }),
+            'Morphy': ('Morphy Defense', {
+                'Open-': ('Open Variation', None),
+                'Close': ('Closed Variation', None),
+                'Modern-S': ('Modern Steinitz Defense', None),
+                'Anderssen': ('Anderssen Variation', None),
+                'Anti-M': ('Anti-Marshall Variation', None),
+                'Exchange': ('Exchange Variation', None),
+                'Caro': ('Caro Variation', None),
+                'Cozio': ('Cozio Defense', None),
+                'Deferred-Cl': ('Deferred Classical Defense', None),
+                'Deferred-Sc': ('Deferred Schliemann Defense', None),
+                'Deferred-Fi': ('Deferred Fianchetto Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Old-Stein': ('Old Steinitz Defense', None),
+            'Classic': ('Classical Defense', None),
+            'Marshall': ('Marshall Attack', None),
+            'Jaenisch': ('Schliemann Defense', None),
+            'Cozio': ('Cozio Defense', None),
+            'Fianchetto': ('Fianchetto Defense', None),
+            'Other': ('Other', None)
+        }
+    },
+    'D06-D69': {
+        'displayName': 'Queen\'s Gambit',
+        'lines': {
+            'Accept': ('Accepted', {
+                'Central': ('Central Variation', {
+                    'Alekhine': ('Alekhine System', None),
+                    'Greco': ('Greco Variation', None),
+                    'Mcdonnell': ('Mcdonnell Defense', None),
+                    'Modern': ('Modern Defense', None),
+                    'Other': ('Other', None)
+                }),
+                'Old': ('Old Variation', None),
+                'Alekhine': ('Alekhine Variation', None),
+                'Showalter': ('Showalter Variation', None),
+                'Classic': ('Classical Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Slav': ('Slav Defense', {
+                'Modern': ('Modern Variation', {
+                    'Quiet': ('Quiet Variation', None),
+                    'Two-K': ('Two Knights Attack', None),
+                    'Three-K': ('Three Knights Variation', None),
+                    'Alapin': ('Alapin Variation', None),
+                    'Triangle': ('Triangle System', None),
+                    'Chameleon': ('Chameleon Variation', None),
+                    'Suchting': ('Suchting Variation', None),
+                    'Other': ('Other', None)
+                }),
+                'Semi-S': ('Semi-Slav Defense', None),
+                'Exchange': ('Exchange Variation', None),
+                'v-Gambit': ('Slav Gambit', None),
+                'Other': ('Other', None)
+            }),
+            'Catalan': ('Catalan Opening', None),
+            'Tarrasch': ('Tarrasch Defense', {
+                'Semi-T': ('Semi-Tarrasch Defense', {
+                    'Main': ('Main Line', None),
+                    'Other': ('Other', None)
+                }),
+                'Two-K': ('Two Knights Variation', {
+                    'Rubin': ('Rubinstein System', None),
+                    'Other': ('Other', None)
+                }),
+                'Other': ('Other', None)
+            }),
+            'Decline': ('Declined', {
+                'Queens-K': ('Queen\'s Knight Variation', None),
+                'Three-K': ('Three Knights Variation', None),
+                'Modern': ('Modern Variation', None),
+                'Tradition': ('Traditional Variation', None),
+                'Ragozin': ('Ragozin Defense', None),
+                'Exchange': ('Exchange Variation', {
+                    'Position': ('Positional Line', None),
+                    'Other': ('Other', None)
+                }),
+                'Charou': ('Charousek Variation', None),
+                'Janowski': ('Janowski Variation', None),
+                'Albin': ('Albin Countergambit', None),
+                'Austrian': ('Austrian Variation', None),
+                'Marshall': ('Marshall Defense', None),
+                'Baltic': ('Baltic Defense', None),
+                'Chigorin': ('Chigorin Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'D70-D99': {
+        'displayName': 'Grunfeld Defense',
+        'lines': {
+            'Exchange': ('Exchange Variation', {
+                'Modern': ('Modern Variation', None),
+                'Classic': ('Classical Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Three-K': ('Three Knights Variation', None),
+            'Hungarian': ('Hungarian Attack', None),
+            'Russian': ('Russian Variation', {
+                'Prins': ('Prins Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Neo-G': ('Neo-Grunfeld Defense', None),
+            'Anti-G': ('Anti-Grunfeld Defense', None),
+            'Stockholm': ('Stockholm Variation', None),
+            'Brinck': ('Brinckmann Attack', {
+                'Capablanca': ('Capablanca Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'E00-E09': {
+        'displayName': 'Catalan Opening',
+        'lines': {
+            'g-Open': ('Open Variation', {
+                'Classic': ('Classical Variation', None),
+                'Modern': ('Modern Variation', None),
+                'Other': ('Other', None)
+            }),
+            'g-Close': ('Closed Variation', None),
+            'East-I': ('East Indian Defense', None),
+            'Other': ('Other', None)
+        }
+    },
+    'E12-E19': {
+        'displayName': 'Queen\'s Indian Defense',
+        'lines': {
+            'Kasparov': ('Kasparov Variation', None),
+            'Spassky': ('Spassky System', None),
+            'Fianchetto': ('Fianchetto Variation', {
+                'Nimzo': ('Nimzowitsch Variation', None),
+                'Capab': ('Capablanca Variation', None),
+                'Classic': ('Classical Variation', None),
+                'Tradition': ('Traditional Line', None),
+                'Main-L': ('Main Line', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'E20-E59': {
+        'displayName': 'Nimzo-Indian Defense',
+        'lines': {
+            'Three-K': ('Three Knights Variation', None),
+            'Spiel': ('Spielmann Variation', None),
+            'Samisch': ('Samisch Variation', None),
+            'Lenin': ('Leningrad Variation', None),
+            'St-P': ('St. Petersburg Variation', {
+                'Fischer': ('Fischer Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Reshev': ('Reshevsky Variation', None),
+            'Bishop': ('Bishop Attack', {
+                'Classic': ('Classical Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Hubner': ('Hubner Variation', {
+                'red-Hub': ('Deferred Hubner Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Kmoch': ('Kmoch Variation', None),
+            'Roman': ('Romanishin-Kasparov System', None),
+            'Gligor': ('Gligoric System', None),
+            'Normal': ('Normal Line', None),
+            'Classic': ('Classical Variation', {
+                'Keres': ('Keres Defense', None),
+                'Zurich': ('Zurich Variaton', None),
+                'Noa-': ('Noa Variation', None),
+                'Berlin': ('Berlin Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Other': ('Other', None)
+        }
+    },
+    'E60-E99': {
+        'displayName': 'King\'s Indian Defense',
+        'lines': {
+            'Fianchetto': ('Fianchetto Variation', None),
+            'Four-P': ('Four Pawns Attack', None),
+            'Samisch': ('Samisch Variation', {
+                'h-Gambit': ('Samisch Gambit', None),
+                'Steiner': ('Steiner Attack', None),
+                'Normal': ('Normal Defense', None),
+                'Other': ('Other', None)
+            }),
+            'Smyslov': ('Smyslov Variation', None),
+            'Kramer': ('Kramer Variation', None),
+            'Makogo': ('Makogonov Variation', None),
+            'Averbakh': ('Averbakh Variation', {
+                'Semi-A': ('Semi-Averbakh Variation', None),
+                'Benoni': ('Benoni Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Orthodox': ('Orthodox Variation', {
+                'Exchange': ('Exchange Variation', None),
+                'Other': ('Other', None)
+            }),
+            'Petros': ('Petrosian Variation', None),
+            'Bayonet': ('Bayonet Attack', None),
+            'Normal': ('Normal Variation', None),
+            'Other': ('Other', None)
+        }
+    }
+}
+
+
+def create_aliases(d):
+    # Bird's Opening
+    for num in range(2, 4):
+        d[f'A0{num}'] = d['A02-A03']
+
+    # Reti Opening
+    for num in range(4, 7):
+        d[f'A0{num}'] = d['A04-A06, A09']
+    d['A09'] = d['A04-A06, A09']
+
+    # King's Indian Attack
+    for num in range(7, 9):
+        d[f'A0{num}'] = d['A07-A08']
+
+    # English Opening
+    for num in range(10, 40):
+        d[f'A{num}'] = d['A10-A39']
+
+    # Uncommon Queen's Pawn
+    # Unusual d4 Openings
+    for num in range(40, 80):
+        d[f'A{num}'] = d['d4']
+    # Uncommon d4-d5 Openings
+    for num in range(0, 6):
+        d[f'D0{num}'] = d['d4']
+    # Unusual d4-Nf6 Openings
+    for num in range(10, 12):
+        d[f'E{num}'] = d['d4']
+
+    # Dutch Defense
+    for num in range(80, 100):
+        d[f'A{num}'] = d['A80-A99']
+
+    # Alekhine's Defense
+    for num in range(2, 6):
+        d[f'B0{num}'] = d['B02-B05']
+
+    # Pirc Defense
+    for num in range(7, 10):
+        d[f'B0{num}'] = d['B07-B09']
+
+    # Caro-Kann Defense
+    for num in range(10, 20):
+        d[f'B{num}'] = d['B10-B19']
+
+    # Sicilian Defense
+    for num in range(20, 100):
+        d[f'B{num}'] = d['B20-B99']
+
+    # French Defense
+    for num in range(0, 10):
+        d[f'C0{num}'] = d['C00-C19']
+    for num in range(10, 20):
+        d[f'C{num}'] = d['C00-C19']
+
+    # Uncommon King's Pawn Opening
+    # Unusual e4 Openings
+    d['B00'] = d['e4']
+    # Uncommon e4-e5 Openings
+    for num in range(20, 23):
+        d[f'C{num}'] = d['e4']
+
+    # Vienna Game
+    for num in range(23, 30):
+        d[f'C{num}'] = d['C23-C29']
+
+    # King's Gambit
+    for num in range(30, 40):
+        d[f'C{num}'] = d['C30-C39']
+
+    # Philidor Defense
+    for num in range(40, 42):
+        d[f'C{num}'] = d['C40-C41']
+
+    # Petrov's Defense
+    for num in range(42, 44):
+        d[f'C{num}'] = d['C42-C43']
+
+    # Four Knights Opening
+    for num in range(47, 50):
+        d[f'C{num}'] = d['C47-C49']
+
+    # Italian Game
+    for num in range(50, 60):
+        d[f'C{num}'] = d['C50-C59']
+
+    # Ruy Lopez Opening
+    for num in range(60, 100):
+        d[f'C{num}'] = d['C60-C99']
+
+    # Queen's Gambit
+    for num in range(6, 10):
+        d[f'D0{num}'] = d['D06-D69']
+    for num in range(10, 70):
+        d[f'D{num}'] = d['D06-D69']
+
+    # Grunfeld Defense
+    for num in range(70, 100):
+        d[f'D{num}'] = d['D70-D99']
+
+    # Catalan Opening
+    for num in range(0, 10):
+        d[f'E0{num}'] = d['E00-E09']
+
+    # Queen's Indian Defense
+    for num in range(12, 20):
+        d[f'E{num}'] = d['E12-E19']
+
+    # Nimzo-Indian Defense
+    for num in range(20, 60):
+        d[f'E{num}'] = d['E20-E59']
+
+    # King's Indian Defense
+    for num in range(60, 99):
+        d[f'E{num}'] = d['E60-E99']
+
+
+# eco_details compiled into a flat node table, node ids are assigned depth first
+opening_node_names = []
+opening_node_parents = []  # counts roll up into the parent, -1 for openings shown on their own
+opening_node_lines = []  # (line, child id) pairs in the order lines are matched
+
+
+def add_opening_node(display_name, parent, sub_lines):
+    node = len(opening_node_names)
+    opening_node_names.append(display_name)
+    opening_node_parents.append(parent)
+    opening_node_lines.append(())
+    if sub_lines:
+        opening_node_lines[node] = tuple((line, add_opening_node(line_name, node, sub_sub_lines))
+                                         for line, (line_name, sub_sub_lines) in sub_lines.items())
+    return node
+
+
+# Root node of every ECO code that can be classified, including the aliases
+opening_roots = {eco: add_opening_node(details['displayName'], -1, details['lines'])
+                 for eco, details in eco_details.items()}
+create_aliases(opening_roots)
+
+# Lines that are still classified under their ECO group but shown as openings of their own
+promoted_openings = [
+    ('d4', 'London'), ('d4', 'Indian'), ('d4', 'Benoni'), ('d4', 'Tromp'),
+    ('e4', 'Nimzo'), ('e4', 'Ponzi'),
+    ('A00', 'Grob'), ('A00', 'Kings-F'), ('A00', 'Polish')
+]
+
+opening_display_roots = [opening_roots[eco] for eco in eco_details]
+for eco, line in promoted_openings:
+    promoted_node = dict(opening_node_lines[opening_roots[eco]])[line]
+    opening_node_parents[promoted_node] = -1
+    opening_display_roots.append(promoted_node)
+
+# Nodes grouped by depth, deepest first, so counts can be rolled up one level at a time
+opening_node_depths = [0] * len(opening_node_names)
+for node, parent in enumerate(opening_node_parents):
+    if parent != -1:
+        opening_node_depths[node] = opening_node_depths[parent] + 1
+opening_rollup_levels = []
+for depth in range(max(opening_node_depths), 0, -1):
+    level_nodes = np.array([node for node, node_depth in enumerate(opening_node_depths) if node_depth == depth])
+    opening_rollup_levels.append((level_nodes, np.array([opening_node_parents[node] for node in level_nodes])))
+
+# The compiled tree is shared by every request and never changes after import
+opening_node_names = tuple(opening_node_names)
+opening_node_parents = tuple(opening_node_parents)
+opening_node_lines = tuple(opening_node_lines)
+opening_display_roots = tuple(opening_display_roots)
+
+# Node ids change with the taxonomy, so anything stored by node id is tied to this version
+opening_tree_version = hashlib.sha1(json.dumps([eco_details, promoted_openings]).encode()).hexdigest()[:12]
+
+# Opening urls repeat across games, months and players, so every classification is remembered
+opening_leaf_cache = {}
+
+
+def classify_opening(root, line_name):
+    leaf = opening_leaf_cache.get((root, line_name))
+    if leaf is None:
+        leaf = root
+        while opening_node_lines[leaf]:
+            lines = opening_node_lines[leaf]
+            leaf = next((child for line, child in lines if line in line_name), dict(lines)['Other'])
+        opening_leaf_cache[(root, line_name)] = leaf
+    return leaf
+
+
+GameFacts = namedtuple('GameFacts', ['game_id', 'url_prefix', 'time_class', 'color', 'eco', 'line_name', 'win_inc',
+                                     'white', 'white_rating', 'black', 'black_rating', 'date'])
+
+# The counts of one month and time class: games and wins per color and opening node as bytes, the
+# (color, leaf, line name, games, wins) of every variation and the first and last game date
+MonthBucket = namedtuple('MonthBucket', ['games', 'wins', 'variations', 'first_date', 'last_date'])
+
+
+def classify_month(body, username):
+    facts = (project_game(game, username) for game in iter_archive_games(body))
+    facts = [fact for fact in facts if fact]
+    return facts, month_bucket_counts(facts)
+
+
+class ArchiveGames(msgspec.Struct):
+    # Each game is kept as the raw bytes it spans in the response, decoding them is left to iter_archive_games
+    games: list[msgspec.Raw]
+
+
+archive_games_decoder = msgspec.json.Decoder(ArchiveGames)
+archive_game_decoder = msgspec.json.Decoder()
+
+
+def iter_archive_games(body):
+    # Decodes an archive one game at a time, so a month's games never exist as objects all at once and each PGN
+    # goes as soon as its game is projected. The raw games are views into the body, not copies
+    for game in archive_games_decoder.decode(body).games:
+        yield archive_game_decoder.decode(game)
+
+
+def project_archive_games(games, username):
+    # Facts of the classifiable games among raw archive games, as ArchiveGameSplitter splits them out
+    facts = (project_game(archive_game_decoder.decode(game), username) for game in games)
+    return [fact for fact in facts if fact]
+
+
+class ArchiveGameSplitter:
+    # Splits an archive into the raw bytes of its games while the response is still arriving, so a month never has
+    # to be held whole. Only the document's structure is followed: its depth, its strings and which key the array
+    # being read belongs to, each game's bytes are only checked once they are decoded
+    structure = re.compile(rb'["{}\[\]]')
+    string_end = re.compile(rb'["\\]')
+
+    def __init__(self):
+        # Unsplit bytes, kept from the start of the game or key being read
+        self.buffer = b''
+        self.offset = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = None
+        self.key = None
+        self.in_games = False
+        self.game_start = None
+
+    def feed(self, chunk):
+        # The raw bytes of every game the chunk completes
+        buffer = self.buffer + chunk
+        pos = self.offset
+        games = []
+        while True:
+            if self.in_string:
+                match = self.string_end.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                if match[0] == b'\\':
+                    if match.end() == len(buffer):
+                        # The escaped character is in the next chunk
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self.in_string = False
+                pos = match.end()
+                if self.depth == 1:
+                    self.key = buffer[self.string_start:match.start()]
+                continue
+
+            match = self.structure.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            char, pos = match[0], match.end()
+            if char == b'"':
+                self.in_string = True
+                self.string_start = pos
+            elif char in b'{[':
+                if self.depth == 1 and char == b'[':
+                    self.in_games = self.key == b'games'
+                elif self.depth == 2 and self.in_games and char == b'{':
+                    self.game_start = match.start()
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 2 and self.game_start is not None:
+                    games.append(buffer[self.game_start:pos])
+                    self.game_start = None
+
+        keep = pos
+        if self.game_start is not None:
+            keep = self.game_start
+        elif self.in_string and self.depth == 1:
+            keep = self.string_start
+        self.buffer = buffer[keep:]
+        self.offset = pos - keep
+        if self.game_start is not None:
+            self.game_start -= keep
+        if self.string_start is not None:
+            self.string_start -= keep
+        return games
+
+    def close(self):
+        if self.depth or self.in_string:
+            raise ValueError('archive ended mid document')
+
+
+def month_bucket_counts(facts):
+    # time class -> MonthBucket of the facts, as month_buckets stores them
+    node_count = len(opening_node_names)
+    by_time_class = {}
+    for fact in facts:
+        if fact.eco in opening_roots:
+            leaf = classify_opening(opening_roots[fact.eco], fact.line_name)
+            cells, wins, variations, dates = by_time_class.setdefault(fact.time_class, ([], [], {}, []))
+            cells.append(fact.color * node_count + leaf)
+            wins.append(fact.win_inc)
+            dates.append(fact.date)
+            counts = variations.setdefault((fact.color, leaf, fact.line_name), [0, 0])
+            counts[0] += 1
+            counts[1] += fact.win_inc
+
+    return {time_class: MonthBucket(
+                np.bincount(cells, minlength=2 * node_count).astype(np.int32).tobytes(),
+                np.bincount(cells, weights=wins, minlength=2 * node_count).astype(np.float32).tobytes(),
+                [(*variation, num_games, num_wins) for variation, (num_games, num_wins) in variations.items()],
+                min(dates), max(dates))
+            for time_class, (cells, wins, variations, dates) in by_time_class.items()}
+
+
+@lru_cache(maxsize=None)
+def pgn_tag_prefixes(tags):
+    return tuple((tag, f'[{tag} "', f'\n[{tag} "') for tag in tags)
+
+
+def parse_pgn_headers(pgn, tags=('ECO', 'ECOUrl', 'UTCDate')):
+    # Only the tag section is searched, it ends at the blank line before the movetext
+    end = pgn.find('\n\n')
+    if end == -1:
+        end = len(pgn)
+
+    headers = {}
+    for tag, prefix, line_prefix in pgn_tag_prefixes(tags):
+        if pgn.startswith(prefix):
+            start = len(prefix)
+        else:
+            start = pgn.find(line_prefix, 0, end)
+            if start == -1:
+                continue
+            start += len(line_prefix)
+        headers[tag] = pgn[start:pgn.find('"', start)]
+    return headers
+
+
+def project_game(game, username):
+    # The facts about a game the opening stats are built from, None if the game can't be classified
+    try:
+        if game['rules'] != 'chess':
+            return None
+
+        headers = parse_pgn_headers(game['pgn'])
+        eco = headers.get('ECO')
+        eco_url = headers.get('ECOUrl')
+        date = headers.get('UTCDate')
+        if eco not in opening_roots or not eco_url:
+            return None
+
+        win_i = 0
+        if game['white']['username'].lower() == username.lower():
+            color = 0
+            if game['white']['result'] == 'win':
+                win_i = 1
+            elif game['black']['result'] != 'win':
+                win_i = .5
+        else:
+            color = 1
+            if game['black']['result'] == 'win':
+                win_i = 1
+            elif game['white']['result'] != 'win':
+                win_i = .5
+
+        url_prefix, _, game_id = game['url'].rpartition('/')
+        return GameFacts(int(game_id), url_prefix, game['time_class'], color, eco, eco_url[31:], win_i,
+                         game['white']['username'], game['white']['rating'],
+                         game['black']['username'], game['black']['rating'],
+                         datetime(*map(int, date.split('.'))).toordinal() if date else 0)
+    except (KeyError, ValueError):
+        return None
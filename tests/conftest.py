@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+# The app reads its configuration on import, everything it stores during the tests goes under one directory
+test_root = tempfile.mkdtemp(prefix='prep-mate-tests-')
+os.environ['SESSION_STORE'] = 'local'
+os.environ['SESSION_STORE_DIR'] = os.path.join(test_root, 'sessions')
+os.environ['PREP_MATE_CACHE_DIR'] = os.path.join(test_root, 'cache')
+os.environ.setdefault('FLASK_SECRET_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openings import create_aliases, eco_details  # noqa: E402
+
+chess_com_api = 'https://api.chess.com'
+time_classes = ('bullet', 'blitz', 'rapid', 'daily')
+filler_words = ('Defense', 'Variation', 'Attack', 'Gambit', 'Line', 'Main', 'Opening', 'with', '3...Nf6', 'Accepted')
+
+
+def eco_roots():
+    # Every ECO code a game can carry, with the taxonomy entry it is classified under
+    roots = {eco: eco for eco in eco_details}
+    create_aliases(roots)
+    return roots
+
+
+def line_paths(lines, prefix=()):
+    for line, (_, sub_lines) in lines.items():
+        yield prefix + (line,)
+        if sub_lines:
+            yield from line_paths(sub_lines, prefix + (line,))
+
+
+def opening_slug(rng, root):
+    # Mostly names that walk some way down the taxonomy, some that match none of its lines
+    if rng.random() < 0.2:
+        return '-'.join(rng.choice(filler_words) for _ in range(rng.randint(1, 4)))
+    path = rng.choice(list(line_paths(eco_details[root]['lines'])))
+    words = ['X' + rng.choice(filler_words), *path, *(rng.choice(filler_words) for _ in range(rng.randint(0, 2)))]
+    return '-'.join(words).replace('-Other', '')
+
+
+def make_archives(username, seed=1, months=12, first_month=(2024, 5), games_per_month=(5, 25)):
+    # Deterministic monthly archives in chess.com's shape: both colors, every result and time class, unknown
+    # ECO codes, chess960 and games without opening tags or time class
+    rng = random.Random(seed)
+    roots = eco_roots()
+    codes = sorted(roots) + ['C44', 'Z99']
+    slugs = {}
+    archives = {}
+    game_id = 100000
+    year, month = first_month
+    for _ in range(months):
+        games = []
+        for day in sorted(rng.sample(range(1, 29), rng.randint(*games_per_month))):
+            game_id += rng.randint(1, 50)
+            eco = rng.choice(codes)
+            root = roots.get(eco, 'e4')
+            slug = slugs.setdefault((root, rng.randint(0, 12)), opening_slug(rng, root))
+            time_class = rng.choice(time_classes)
+            plays_white = rng.random() < 0.5
+            opponent = f'opponent{rng.randint(0, 40)}'
+            result = rng.choice(('win', 'lose', 'draw'))
+            mine = {'win': 'win', 'lose': 'resigned', 'draw': 'agreed'}[result]
+            theirs = {'win': 'checkmated', 'lose': 'win', 'draw': 'agreed'}[result]
+            white = {'username': username if plays_white else opponent, 'rating': rng.randint(800, 2500),
+                     'result': mine if plays_white else theirs}
+            black = {'username': opponent if plays_white else username.lower(), 'rating': rng.randint(800, 2500),
+                     'result': theirs if plays_white else mine}
+            tags = [('Event', 'Live Chess'), ('Site', 'Chess.com'), ('Date', f'{year}.{month:02d}.{day:02d}'),
+                    ('White', white['username']), ('Black', black['username'])]
+            if rng.random() > 0.03:
+                tags.append(('ECO', eco))
+            if rng.random() > 0.03:
+                tags.append(('ECOUrl', f'https://www.chess.com/openings/{slug}'))
+            tags.append(('UTCDate', f'{year}.{month:02d}.{day:02d}'))
+            pgn = '\n'.join(f'[{tag} "{value}"]' for tag, value in tags) + '\n\n1. e4 e5 2. Nf3 1-0\n'
+            kind = 'daily' if time_class == 'daily' else 'live'
+            game = {'url': f'https://www.chess.com/game/{kind}/{game_id}', 'pgn': pgn, 'time_control': '180',
+                    'time_class': time_class, 'rules': 'chess' if rng.random() > 0.05 else 'chess960',
+                    'white': white, 'black': black}
+            if rng.random() < 0.02:
+                del game['time_class']
+            games.append(game)
+        archives[f'{year}/{month:02d}'] = {'games': games}
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return archives
+
+
+def archive_url(username, month):
+    return f'{chess_com_api}/pub/player/{username}/games/{month}'
+
+
+def month_ordinal(year, month, day):
+    return date(year, month, day).toordinal()
+
+
+class ChessCom:
+    # The parts of chess.com's public API the app uses, serving players' archives and counting every request
+    def __init__(self):
+        self.players = {}
+        self.hits = Counter()
+        self.failing = set()
+        self.delay = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handler(self):
+        chess_com = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, value, status=200):
+                body = json.dumps(value).encode()
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                chess_com.hits[self.path] += 1
+                time.sleep(chess_com.delay)
+                if self.path in chess_com.failing:
+                    return self.send_json({'code': 0, 'message': 'unavailable'}, 503)
+                match = re.match(r'/pub/player/([^/]+)(/.*)?$', self.path)
+                if not match or match.group(1).lower() not in chess_com.players:
+                    return self.send_json({'code': 0, 'message': 'not found'}, 404)
+                username, rest = match.group(1).lower(), match.group(2) or ''
+                archives = chess_com.players[username]
+                if rest == '':
+                    return self.send_json({'url': f'https://www.chess.com/member/{username}', 'username': username})
+                if rest == '/stats':
+                    return self.send_json({'chess_blitz': {'last': {'rating': 1500}, 'best': {'rating': 1600}}})
+                if rest == '/games/archives':
+                    return self.send_json({'archives': [archive_url(username, month) for month in archives]})
+                month = rest.removeprefix('/games/')
+                if month in archives:
+                    return self.send_json(archives[month])
+                return self.send_json({'code': 0, 'message': 'not found'}, 404)
+
+        return Handler
+
+
+@pytest.fixture(scope='session')
+def chess_com_server():
+    chess_com = ChessCom()
+    yield chess_com
+    chess_com.server.shutdown()
+
+
+@pytest.fixture
+def chess_com(chess_com_server, monkeypatch):
+    # Requests the app makes to chess.com go to the local server instead
+    chess_com_server.players.clear()
+    chess_com_server.hits.clear()
+    chess_com_server.failing.clear()
+    chess_com_server.delay = 0
+    request = aiohttp.ClientSession._request
+
+    def local_request(session, method, url, *args, **kwargs):
+        return request(session, method, str(url).replace(chess_com_api, chess_com_server.url), *args, **kwargs)
+
+    monkeypatch.setattr(aiohttp.ClientSession, '_request', local_request)
+    return chess_com_server
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    return app
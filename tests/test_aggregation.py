@@ -0,0 +1,225 @@
+import copy
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from conftest import archive_url, make_archives
+from openings import ArchiveGameSplitter, classify_month, create_aliases, eco_details, project_archive_games
+
+username = 'Alice'
+
+
+# The aggregation as the app first did it, game by game into a nested dict per ECO code and color
+
+
+def create_line_dict(display_name, sub_lines=None):
+    line_dict = {'displayName': display_name, 'numGames': 0, 'numWins': 0, 'urls': {}}
+    if sub_lines:
+        line_dict['lines'] = {sub_line: create_line_dict(sub_line_name, sub_sub_lines)
+                              for sub_line, (sub_line_name, sub_sub_lines) in sub_lines.items()}
+    return line_dict
+
+
+def create_eco_dict(display_name, lines):
+    return {'displayName': display_name, 'numGames': 0, 'numWins': 0, 'urls': {},
+            'lines': {line: create_line_dict(line_name, sub_lines) for line, (line_name, sub_lines) in lines.items()}}
+
+
+def baseline_update_stats(d, game, time_classes):
+    def add_url(d, game_id, game_data, line_name, win_inc):
+        d['numGames'] += 1
+        d['numWins'] += win_inc
+        entry = d['urls'].setdefault(line_name, {'numGames': 0, 'numWins': 0, 'games': {}})
+        entry['numGames'] += 1
+        entry['numWins'] += win_inc
+        entry['games'][game_id] = game_data
+
+    def update_line(d, game_id, game_data, line_name, win_inc):
+        d['numGames'] += 1
+        d['numWins'] += win_inc
+        for line in d['lines']:
+            if line in line_name:
+                if 'lines' in d['lines'][line]:
+                    update_line(d['lines'][line], game_id, game_data, line_name, win_inc)
+                else:
+                    add_url(d['lines'][line], game_id, game_data, line_name, win_inc)
+                return
+        add_url(d['lines']['Other'], game_id, game_data, line_name, win_inc)
+
+    try:
+        if game['rules'] == 'chess' and (len(time_classes) == 4 or game['time_class'] in time_classes):
+            eco = eco_url = date = None
+            for info in game['pgn'].split('\n'):
+                if info.startswith('[ECO '):
+                    eco = info.split('"')[1]
+                elif info.startswith('[ECOUrl'):
+                    eco_url = info.split('"')[1]
+                elif info.startswith('[UTCD'):
+                    date = info.split('"')[1]
+
+            if eco and eco_url:
+                game_data = {'url': game['url'], 'time_class': game['time_class'], 'date': date}
+                game_id = game['url'].split('/')[-1]
+                if game['white']['username'].lower() == username.lower():
+                    color, mine, theirs = 'white', game['white'], game['black']
+                else:
+                    color, mine, theirs = 'black', game['black'], game['white']
+                win_inc = 1 if mine['result'] == 'win' else 0 if theirs['result'] == 'win' else .5
+                update_line(d[color][eco], game_id, game_data, eco_url[31:], win_inc)
+    except KeyError:
+        pass
+
+
+def baseline_prettify_stats(stats_dict):
+    def recursive_build(details, current_id=0):
+        num_games = details['numGames']
+        result = {
+            'id': current_id,
+            'display_name': details['displayName'],
+            'num_games': num_games,
+            'win_rate': int(round((details['numWins'] / num_games * 100), 0)) if num_games > 0 else 0,
+            'variations': {key: {'numGames': value['numGames'], 'numWins': value['numWins'],
+                                 'winRate': int(round((value['numWins'] / value['numGames'] * 100), 0)),
+                                 'games': value['games']}
+                           for key, value in details.get('urls', {}).items()},
+            'sub_lines': []
+        }
+        for sub_details in details.get('lines', {}).values():
+            if sub_details['numGames'] > 0:
+                result['sub_lines'].append(recursive_build(sub_details, len(result['sub_lines'])))
+        return result
+
+    def move_opening(new_eco_name, old_eco, old_name):
+        stats_dict[new_eco_name] = stats_dict[old_eco]['lines'].pop(old_name)
+        stats_dict[old_eco]['numGames'] -= stats_dict[new_eco_name]['numGames']
+        stats_dict[old_eco]['numWins'] -= stats_dict[new_eco_name]['numWins']
+
+    for moved in (('london', 'd4', 'London'), ('indian', 'd4', 'Indian'), ('benoni', 'd4', 'Benoni'),
+                  ('trompowsky', 'd4', 'Tromp'), ('nimzo-def', 'e4', 'Nimzo'), ('ponziani', 'e4', 'Ponzi'),
+                  ('grob', 'A00', 'Grob'), ('kings-fianchetto', 'A00', 'Kings-F'), ('polish', 'A00', 'Polish')):
+        move_opening(*moved)
+
+    results = []
+    seen = set()
+    total_games = 0
+    for details in stats_dict.values():
+        if details['displayName'] not in seen and details['numGames'] > 0:
+            results.append(recursive_build(details, len(results)))
+            total_games += details['numGames']
+            seen.add(details['displayName'])
+    return results, total_games
+
+
+def baseline_stats(archives, time_classes):
+    opening_stats = {eco: create_eco_dict(details['displayName'], details['lines'])
+                     for eco, details in eco_details.items()}
+    create_aliases(opening_stats)
+    d = {'white': opening_stats, 'black': copy.deepcopy(opening_stats)}
+    for archive in archives:
+        for game in archive['games']:
+            baseline_update_stats(d, game, time_classes)
+    return {color: baseline_prettify_stats(d[color]) for color in ('white', 'black')}
+
+
+def canonical(lines, game_ids):
+    # Lines in order with their counts, and every variation with its counts and the ids of its games
+    return [(line['id'], line['display_name'], line['num_games'], line['win_rate'],
+             {line_name: (variation['numGames'], variation['numWins'], variation['winRate'],
+                          game_ids(variation['games']))
+              for line_name, variation in line['variations'].items()},
+             canonical(line['sub_lines'], game_ids))
+            for line in lines]
+
+
+@pytest.fixture(scope='module')
+def archives(app_module):
+    archives = make_archives(username, seed=1, months=14)
+    for month, archive in archives.items():
+        facts, buckets = classify_month(json.dumps(archive).encode(), username)
+        app_module.store_month_facts(username, archive_url(username, month), facts, buckets, complete=True)
+    return archives
+
+
+@pytest.mark.parametrize('time_classes', [['bullet', 'blitz', 'rapid', 'daily'], ['blitz'], ['rapid', 'daily']])
+@pytest.mark.parametrize('num_months', [None, 1, 5])
+def test_matches_baseline(app_module, archives, time_classes, num_months):
+    months = list(archives)[-num_months:] if num_months else list(archives)
+    expected = baseline_stats([archives[month] for month in months], time_classes)
+
+    stats = app_module.query_opening_stats(username, time_classes, first_month=months[0])
+    counts = app_module.query_opening_stats(username, time_classes, first_month=months[0], games=False)
+    for color in ('white', 'black'):
+        expected_lines, expected_total = expected[color]
+        lines, total = app_module.prettify_stats(stats, color)
+        assert total == expected_total
+        assert canonical(lines, lambda rows: {str(stats['games'].game_ids[row]) for row in rows}) == \
+            canonical(expected_lines, set)
+
+        # The counts only path has the same lines and variations, just without their games
+        count_lines, count_total = app_module.prettify_stats(counts, color)
+        assert count_total == expected_total
+        assert canonical(count_lines, len) == canonical(expected_lines, lambda games: 0)
+
+
+def test_analysis_overview_matches_baseline(app_module, archives):
+    urls = [archive_url(username, month) for month in archives]
+    expected = baseline_stats(archives.values(), ['bullet', 'blitz', 'rapid', 'daily'])
+    _, _, overview = app_module.process_games(username, urls, ['bullet', 'blitz', 'rapid', 'daily'])
+    for color in ('white', 'black'):
+        assert [line['num_games'] for line in overview[color]] == [line['num_games'] for line in expected[color][0]]
+        assert [line['display_name'] for line in overview[color]] == \
+            [line['display_name'] for line in expected[color][0]]
+
+
+def test_classify_pool_matches_in_process():
+    # The workers are forked from a server that has only imported the openings module
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['openings'])
+    bodies = [json.dumps(archive).encode() for archive in make_archives(username, seed=2, months=4).values()]
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as pool:
+        assert list(pool.map(classify_month, bodies, [username] * len(bodies))) == \
+            [classify_month(body, username) for body in bodies]
+        assert pool.submit(eval, "'app' in __import__('sys').modules").result() is False
+
+
+def test_classify_worker_skips_startup(tmp_path):
+    # A worker of an app run with python app.py runs the file again as __mp_main__, as spawn.prepare does here.
+    # Without credentials the google session store would fail to start, and the worker would start a pool of its own
+    env = {**os.environ, 'SESSION_STORE': 'google', 'CLASSIFY_WORKERS': '2', 'PREP_MATE_CACHE_DIR': str(tmp_path)}
+    env.pop('GOOGLE_CREDENTIALS_JSON', None)
+    code = ("import runpy, threading; module = runpy.run_path('app.py', run_name='__mp_main__'); "
+            "print(threading.active_count(), module['session_store'], module['classify_pool'])")
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)), env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ['1', 'None', 'None']
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+@pytest.mark.parametrize('chunk_size', [1, 3, 64, 1 << 16])
+def test_split_archive_matches_whole_body(ensure_ascii, chunk_size):
+    archive = make_archives(username, seed=3, months=1)['2024/05']
+    # Brackets, braces and escaped quotes inside strings, and arrays of objects that aren't games
+    archive['games'][0]['white']['username'] = 'a"}]{["\\\u00e9'
+    document = {'note': '"games": [{', 'games': archive['games'], 'other': [{'games': []}]}
+    body = json.dumps(document, ensure_ascii=ensure_ascii).encode()
+
+    splitter = ArchiveGameSplitter()
+    games = []
+    for start in range(0, len(body), chunk_size):
+        games.extend(splitter.feed(body[start:start + chunk_size]))
+    splitter.close()
+    assert [json.loads(game) for game in games] == archive['games']
+    assert project_archive_games(games, username) == classify_month(json.dumps(archive).encode(), username)[0]
+
+    # A response cut short isn't taken for a whole month
+    splitter = ArchiveGameSplitter()
+    splitter.feed(body[:len(body) // 2])
+    with pytest.raises(ValueError):
+        splitter.close()
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timezone
+
+import aiohttp
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from conftest import archive_url, make_archives
+from openings import classify_month
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def run_analysis(client, **form):
+    response = client.post('/process_games', data={'color': 'white', 'allGames': 'on', **form})
+    assert response.status_code == 202
+    return wait_for_job(client, response.get_json()['job_id'])
+
+
+def wait_for_job(client, job_id):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def month_hits(chess_com, username):
+    return {path: hits for path, hits in chess_com.hits.items()
+            if path.startswith(f'/pub/player/{username}/games/') and not path.endswith('/archives')}
+
+
+def test_analysis_pages(chess_com, client):
+    chess_com.players['carol'] = make_archives('Carol', seed=4, months=6)
+    job = run_analysis(client, username='Carol')
+    assert job['state'] == 'done'
+    session_id = job['session_id']
+
+    page = client.get(f'/analysis/{session_id}')
+    assert page.status_code == 200
+    assert b'carol' in page.data
+    details = {'current_session_id': session_id, 'path': 'white.0'}
+    assert client.get('/opening_details', query_string=details).status_code == 200
+    assert client.post('/sort_openings', data={'session_id': session_id, 'metric': 'win_rate',
+                                               'direction': 'False'}).status_code == 200
+    assert client.post('/swap_colors', data={'session_id': session_id}).status_code == 200
+    details = {'current_session_id': session_id, 'path': 'black.0'}
+    assert client.get('/opening_details', query_string=details).status_code == 200
+
+    filtered = client.post('/filter_openings', data={'session_id': session_id, 'color': 'black', 'num-months': '2',
+                                                     'monthsOrYears': 'months', 'time-classes': ['blitz', 'daily']})
+    assert filtered.status_code == 200
+    filtered_session_id = re.search(r'name="session_id" id="sort_session_id" value="([^"]+)"',
+                                    filtered.data.decode()).group(1)
+    assert client.post('/sort_openings', data={'session_id': filtered_session_id, 'metric': 'num_games',
+                                               'direction': 'True'}).status_code == 200
+
+    # Every month was fetched once, the filter only re-sliced the game store
+    assert set(month_hits(chess_com, 'carol').values()) == {1}
+    assert len(month_hits(chess_com, 'carol')) == 6
+
+
+def test_filter_reaching_new_months_runs_as_job(chess_com, client):
+    chess_com.players['hank'] = make_archives('Hank', seed=9, months=5)
+    job = run_analysis(client, username='Hank', allGames='', **{'num-months': '1', 'monthsOrYears': 'months'})
+    assert len(month_hits(chess_com, 'hank')) == 1
+
+    # The older months are fetched in the background, the request only returns the job
+    response = client.post('/filter_openings', data={'session_id': job['session_id'], 'color': 'white',
+                                                     'allGames': 'on'})
+    assert response.status_code == 202
+    job = wait_for_job(client, response.get_json()['job_id'])
+    assert (job['state'], job['months_done'], job['months_total']) == ('done', 4, 4)
+    assert client.get(f'/analysis/{job["session_id"]}').status_code == 200
+    assert len(month_hits(chess_com, 'hank')) == 5
+    assert set(month_hits(chess_com, 'hank').values()) == {1}
+
+
+def test_unknown_player(chess_com, client):
+    job = run_analysis(client, username='nobody')
+    assert (job['state'], job['status']) == ('failed', 404)
+
+
+def test_repeat_analysis_reuses_complete_months(chess_com, client):
+    chess_com.players['dave'] = make_archives('Dave', seed=5, months=4)
+    assert run_analysis(client, username='Dave')['state'] == 'done'
+    chess_com.hits.clear()
+
+    assert run_analysis(client, username='Dave', color='black')['state'] == 'done'
+    # Only the archive list is asked for again, the profile and ratings are cached and the months are final
+    assert dict(chess_com.hits) == {'/pub/player/Dave/games/archives': 1}
+
+
+@pytest.mark.parametrize('username, failing', [('Ivy', '/pub/player/Ivy'), ('Jack', '/pub/player/Jack/stats')])
+def test_failed_player_info_is_not_cached(chess_com, client, username, failing):
+    chess_com.players[username.lower()] = make_archives(username, seed=10, months=2)
+    chess_com.failing.add(failing)
+    job = run_analysis(client, username=username)
+    # A chess.com failure isn't reported as an unknown player
+    assert (job['state'], job['status']) == ('failed', 502)
+
+    chess_com.failing.clear()
+    job = run_analysis(client, username=username)
+    assert job['state'] == 'done'
+    assert b'1500' in client.get(f'/analysis/{job["session_id"]}').data
+
+
+def test_concurrent_analyses_share_fetches(app_module, chess_com):
+    chess_com.players['erin'] = make_archives('Erin', seed=6, months=5)
+    chess_com.delay = 0.2
+    form = MultiDict({'username': 'Erin', 'color': 'white', 'allGames': 'on'})
+    session_ids = []
+    threads = [threading.Thread(target=lambda: session_ids.append(app_module.analyze_player(form)[0]))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(session_ids) == 4
+    # One request each for the profile, the ratings, the archive list and the five months
+    assert chess_com.hits['/pub/player/Erin/games/archives'] == 1
+    assert set(month_hits(chess_com, 'erin').values()) == {1}
+    assert sum(chess_com.hits.values()) == 8
+    assert all(app_module.wait_for_session_write(session_id) for session_id in session_ids)
+    # The sessions share one stored analysis
+    assert len({app_module.session_store.load_session(session_id)['analysis'] for session_id in session_ids}) == 1
+
+
+def test_stale_fallback_is_not_final(app_module, chess_com):
+    archives = make_archives('Frank', seed=7, months=1)
+    chess_com.players['frank'] = archives
+    url = archive_url('frank', '2024/05')
+    with closing(app_module.open_cache_db()) as conn, conn:
+        conn.execute('INSERT INTO archives (url, body, etag, last_modified, immutable, fetched_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (url, b'{"games": []}', '"stale"', None, False,
+                                                   datetime.now(timezone.utc).isoformat()))
+
+    def month_state():
+        with closing(app_module.open_cache_db()) as conn:
+            complete = conn.execute("SELECT complete FROM ingested_months WHERE username = 'frank'").fetchone()
+            kept = conn.execute('SELECT COUNT(*) FROM archives WHERE url = ?', (url,)).fetchone()[0]
+        return complete[0], kept
+
+    # chess.com failing serves the cached copy, the month is stored but fetched again next time
+    chess_com.failing.add('/pub/player/frank/games/2024/05')
+    asyncio.run(app_module.update_game_store('frank', [url]))
+    assert month_state() == (0, 1)
+
+    chess_com.failing.clear()
+    asyncio.run(app_module.update_game_store('frank', [url]))
+    # A complete month is final, its body is dropped once its games are stored
+    assert month_state() == (1, 0)
+    assert len(app_module.query_opening_stats('frank', ['bullet', 'blitz', 'rapid', 'daily'])['games']) > 0
+
+
+def test_done_job_carries_its_page(app_module, chess_com, client):
+    chess_com.players['gina'] = make_archives('Gina', seed=8, months=3)
+    chess_com.delay = 0.1
+    socket_client = app_module.socketio.test_client(app_module.app, flask_test_client=client)
+    job_id = client.post('/process_games', data={'username': 'Gina', 'color': 'black',
+                                                 'allGames': 'on'}).get_json()['job_id']
+    socket_client.emit('watch_job', job_id)
+
+    deadline = time.monotonic() + 60
+    done = None
+    while done is None and time.monotonic() < deadline:
+        done = next((event['args'][0] for event in socket_client.get_received() if event['name'] == 'job_done'), None)
+        time.sleep(0.05)
+    # The page is rendered from the analysis in memory, its forms point at the session being written
+    assert f'value="{done["session_id"]}"' in done['page']
+    assert 'page' not in client.get(f'/jobs/{job_id}').get_json()
+    assert client.get(f'/analysis/{done["session_id"]}').status_code == 200
+
+
+def test_only_open_months_are_cached(app_module, chess_com):
+    today = datetime.now(timezone.utc)
+    current = f'{today.year}/{today.month:02d}'
+    chess_com.players['kate'] = {'2024/05': {'games': []}, current: {'games': []}}
+    months = [archive_url('kate', '2024/05'), archive_url('kate', current)]
+    asyncio.run(app_module.update_game_store('kate', months))
+
+    # The closed month is final as fetched and never cached, the open one is kept for revalidation
+    with closing(app_module.open_cache_db()) as conn:
+        cached = [url for (url,) in conn.execute('SELECT url FROM archives WHERE url IN (?, ?)', months)]
+    assert cached == [months[1]]
+    assert app_module.load_ingested_months('kate', complete_only=True) == {'2024/05'}
+
+    # Not even until the month is stored
+    assert app_module.resolve_archive_response(months[0], 200, {}, b'{"games": []}', None) == (b'{"games": []}', True)
+    assert app_module.get_cached_archive(months[0]) is None
+
+
+def test_final_months_are_streamed(app_module, chess_com, monkeypatch):
+    today = datetime.now(timezone.utc)
+    current = f'{today.year}/{today.month:02d}'
+    archives = make_archives('Liam', seed=11, months=2)
+    archives[current] = make_archives('Liam', seed=12, months=1)['2024/05']
+    chess_com.players['liam'] = archives
+    months = [archive_url('liam', month) for month in archives]
+
+    # Only the open month's body is read whole, the final ones go through the splitter a few bytes at a time
+    read = []
+    response_read = aiohttp.ClientResponse.read
+
+    async def recording_read(response):
+        read.append(str(response.url).rsplit('/games/', 1)[1])
+        return await response_read(response)
+
+    monkeypatch.setattr(aiohttp.ClientResponse, 'read', recording_read)
+    monkeypatch.setattr(app_module, 'archive_stream_chunk_size', 100)
+    asyncio.run(app_module.update_game_store('liam', months))
+    assert read == [current]
+
+    stored = app_module.query_opening_stats('liam', ['bullet', 'blitz', 'rapid', 'daily'])['games']
+    expected = sum(len(classify_month(json.dumps(archive).encode(), 'liam')[0]) for archive in archives.values())
+    assert len(stored) == expected
+
+
+def test_ingest_stays_off_the_loop(app_module, chess_com, monkeypatch):
+    chess_com.players['mona'] = make_archives('Mona', seed=13, months=3)
+    executors = []
+    run_in_executor = asyncio.base_events.BaseEventLoop.run_in_executor
+
+    def recording_run_in_executor(loop, executor, function, *args):
+        executors.append(executor)
+        return run_in_executor(loop, executor, function, *args)
+
+    def running_loop():
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    loop_calls = []
+    for name in ('save_player_archives', 'load_ingested_months', 'store_month_facts'):
+        def recording(*args, name=name, function=getattr(app_module, name), **kwargs):
+            if running_loop():
+                loop_calls.append(name)
+            return function(*args, **kwargs)
+        monkeypatch.setattr(app_module, name, recording)
+    monkeypatch.setattr(asyncio.base_events.BaseEventLoop, 'run_in_executor', recording_run_in_executor)
+
+    app_module.analyze_player(MultiDict({'username': 'Mona', 'color': 'white', 'allGames': 'on'}))
+    # Every analysis shares the ingest executor, none starts a default executor of its own, and the game store is
+    # never touched from a loop's thread
+    assert executors and None not in executors
+    assert loop_calls == []
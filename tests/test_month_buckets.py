@@ -0,0 +1,119 @@
+import json
+from contextlib import closing
+
+import numpy as np
+import pytest
+
+from conftest import archive_url, make_archives, month_ordinal
+from openings import classify_month
+
+username = 'Bob'
+all_time_classes = ['bullet', 'blitz', 'rapid', 'daily']
+
+
+def counts_only(lines):
+    # What both paths agree on, everything but the games behind the variations
+    return [(line['display_name'], line['num_games'], line['win_rate'],
+             {line_name: (variation['numGames'], variation['numWins'])
+              for line_name, variation in line['variations'].items()},
+             counts_only(line['sub_lines']))
+            for line in lines]
+
+
+@pytest.fixture(scope='module')
+def archives(app_module):
+    archives = make_archives(username, seed=3, months=10, first_month=(2024, 5))
+    # A daily game started in July and finished in August is archived with August
+    spanning = archives['2024/08']['games'][0]
+    spanning['time_class'] = 'daily'
+    spanning['pgn'] = spanning['pgn'].replace('[UTCDate "2024.08.', '[UTCDate "2024.07.')
+    for month, archive in archives.items():
+        facts, buckets = classify_month(json.dumps(archive).encode(), username)
+        app_module.store_month_facts(username, archive_url(username, month), facts, buckets, complete=True)
+    return archives
+
+
+date_ranges = [
+    (None, None),
+    (month_ordinal(2024, 7, 1), None),
+    (None, month_ordinal(2024, 7, 31)),
+    (month_ordinal(2024, 6, 1), month_ordinal(2024, 9, 30)),
+    (month_ordinal(2024, 6, 10), month_ordinal(2024, 11, 20)),
+    (month_ordinal(2024, 8, 1), month_ordinal(2024, 8, 31)),
+    (month_ordinal(2025, 6, 1), None),
+]
+
+
+@pytest.mark.parametrize('time_classes', [all_time_classes, ['daily'], ['bullet', 'rapid']])
+@pytest.mark.parametrize('first_month', [None, '2024/08'])
+@pytest.mark.parametrize('start_date, end_date', date_ranges)
+def test_counts_match_full_scan(app_module, archives, time_classes, first_month, start_date, end_date):
+    stats = app_module.query_opening_stats(username, time_classes, first_month, start_date, end_date)
+    counts = app_module.query_opening_stats(username, time_classes, first_month, start_date, end_date, games=False)
+    assert np.array_equal(counts['numGames'], stats['numGames'])
+    assert np.array_equal(counts['numWins'], stats['numWins'])
+    for color in app_module.opening_colors:
+        assert counts_only(app_module.prettify_stats(counts, color)[0]) == \
+            counts_only(app_module.prettify_stats(stats, color)[0])
+
+
+@pytest.mark.parametrize('time_classes', [all_time_classes, ['blitz', 'daily']])
+def test_prefix_sums_match_full_scan(app_module, archives, time_classes):
+    for first_month in [None, *archives]:
+        games, wins = app_module.window_counts(username, time_classes, first_month)
+        # Any date bound makes the query count the games it reads instead of taking the prefix sums
+        scanned = app_module.query_opening_stats(username, time_classes, first_month, start_date=1)
+        assert np.array_equal(games, scanned['numGames'])
+        assert np.array_equal(wins, scanned['numWins'])
+
+
+def test_daily_game_counted_by_its_date(app_module, archives):
+    # Months are counted whole only if all of their games are within the dates, the daily game makes August's
+    # daily games start in July
+    facts = [fact for archive in archives.values()
+             for fact in classify_month(json.dumps(archive).encode(), username)[0] if fact.time_class == 'daily']
+    for start_date, end_date in [(month_ordinal(2024, 7, 1), month_ordinal(2024, 7, 31)),
+                                 (month_ordinal(2024, 8, 1), month_ordinal(2024, 8, 31))]:
+        counts = app_module.query_opening_stats(username, ['daily'], start_date=start_date, end_date=end_date,
+                                                games=False)
+        assert counts['numGames'].sum() == sum(1 for fact in facts if start_date <= fact.date <= end_date)
+
+    sums = app_module.load_month_prefix_sums(username, ['daily'])
+    assert sums.first_dates[sums.months.index('2024/08')] < month_ordinal(2024, 8, 1)
+
+
+@pytest.mark.parametrize('stale', ["tree_version = 'old'", 'variations = NULL'])
+def test_stale_buckets_are_rebuilt(app_module, archives, stale):
+    expected = app_module.query_opening_stats(username, all_time_classes)
+    with closing(app_module.open_cache_db()) as conn, conn:
+        conn.execute(f"UPDATE month_buckets SET {stale} WHERE username = ? AND month <= '2024/07'",
+                     (username.lower(),))
+    app_module.month_prefix_cache.clear()
+
+    counts = app_module.query_opening_stats(username, all_time_classes, games=False)
+    assert np.array_equal(counts['numGames'], expected['numGames'])
+    for color in app_module.opening_colors:
+        assert counts_only(app_module.prettify_stats(counts, color)[0]) == \
+            counts_only(app_module.prettify_stats(expected, color)[0])
+    with closing(app_module.open_cache_db()) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM month_buckets WHERE username = ? AND '
+                            '(tree_version != ? OR variations IS NULL)',
+                            (username.lower(), app_module.opening_tree_version)).fetchone()[0] == 0
+
+
+@pytest.mark.parametrize('start_date, end_date', date_ranges)
+def test_running_counts_match_window(app_module, archives, start_date, end_date):
+    # Snapshots add the newest months a few at a time, each running total is exact for its window
+    months = list(archives)
+    d = app_module.new_opening_stats()
+    added = 0
+    for step in (1, 2, 3, 4):
+        newer = months[len(months) - added - step:len(months) - added]
+        app_module.add_month_counts(d, username, ['blitz', 'daily'], newer, start_date, end_date)
+        added += step
+        window = app_module.query_opening_stats(username, ['blitz', 'daily'], months[-added], start_date, end_date,
+                                                games=False)
+        assert np.array_equal(d['numGames'], window['numGames'])
+        for color in app_module.opening_colors:
+            assert counts_only(app_module.prettify_stats(d, color)[0]) == \
+                counts_only(app_module.prettify_stats(window, color)[0])
@@ -0,0 +1,124 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def store(app_module, tmp_path):
+    return app_module.LocalSessionStore(str(tmp_path))
+
+
+def test_session_round_trip(store):
+    data = {'player_info': {'username': 'alice', 'color': 'white', 'not_color': 'black'},
+            'stats_url': 'abc_stats.msgpack', 'last_activity': '2024-05-01T00:00:00+00:00'}
+    store.save_session('s1', data)
+    assert store.load_session('s1') == data
+    assert store.load_session('missing') is None
+
+    store.update_session('s1', {'player_info.color': 'black', 'player_info.not_color': 'white'})
+    assert store.load_session('s1')['player_info'] == {'username': 'alice', 'color': 'black', 'not_color': 'white'}
+    assert store.load_session('s1')['stats_url'] == 'abc_stats.msgpack'
+
+
+def test_inactive_sessions(store):
+    now = datetime.now(timezone.utc)
+    for idx in range(5):
+        store.save_session(f's{idx}', {'player_info': {}, 'last_activity': (now - timedelta(hours=idx)).isoformat()})
+    store.touch_sessions([('s4', now.isoformat())])
+
+    cutoff = (now - timedelta(minutes=90)).isoformat()
+    first, cursor = store.inactive_sessions(cutoff, 1)
+    rest, _ = store.inactive_sessions(cutoff, 10, cursor)
+    assert sorted(session_id for session_id, _ in first + rest) == ['s2', 's3']
+
+    store.delete_sessions(['s2', 's3'])
+    assert store.load_session('s2') is None
+    assert store.inactive_sessions(cutoff, 10)[0] == []
+
+
+def test_blob_round_trip(app_module, store):
+    stats = {'white': [{'id': 0, 'display_name': 'Sicilian', 'num_games': 2, 'win_rate': 50, 'variations': True,
+                        'sub_lines': []}], 'black': []}
+    blob, size = app_module.encode_session_stats(stats)
+    ref = store.save_blob('abc_stats.msgpack', blob)
+    with store.open_blob(ref) as mapped:
+        assert app_module.decode_session_stats(mapped) == (stats, size)
+
+    store.delete_blobs([ref, 'never-written.msgpack'])
+    with pytest.raises(FileNotFoundError):
+        with store.open_blob(ref):
+            pass
+
+
+def test_legacy_json_blob(app_module, store):
+    # Sessions stored before the msgpack format hold their stats as plain JSON
+    stats = {'white': [], 'black': [{'id': 0, 'display_name': 'French', 'num_games': 1}]}
+    ref = store.save_blob('old_stats.json', json.dumps(stats).encode())
+    with store.open_blob(ref) as mapped:
+        assert app_module.decode_session_stats(mapped)[0] == stats
+
+
+def test_lease(store):
+    assert store.acquire_lease('cleanup', 'a', timedelta(minutes=5))
+    assert store.acquire_lease('cleanup', 'a', timedelta(minutes=5))
+    assert not store.acquire_lease('cleanup', 'b', timedelta(minutes=5))
+    assert store.acquire_lease('expired', 'a', timedelta(seconds=-1))
+    assert store.acquire_lease('expired', 'b', timedelta(minutes=5))
+
+
+def test_lease_has_one_holder(app_module, tmp_path):
+    # Workers starting together race for the cleanup lease, only one of them may get it
+    for trial in range(20):
+        store = app_module.LocalSessionStore(str(tmp_path / str(trial)))
+        barrier = threading.Barrier(4)
+        acquired = []
+
+        def acquire(holder):
+            barrier.wait()
+            acquired.append(store.acquire_lease('cleanup', holder, timedelta(minutes=5)))
+
+        threads = [threading.Thread(target=acquire, args=(f'worker-{idx}',)) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(acquired) == [False, False, False, True]
+
+
+def test_concurrent_updates_are_kept(store):
+    store.save_session('s1', {'player_info': {}, 'last_activity': '2024-05-01T00:00:00+00:00'})
+    barrier = threading.Barrier(8)
+
+    def update(idx):
+        barrier.wait()
+        store.update_session('s1', {f'player_info.field{idx}': idx})
+
+    threads = [threading.Thread(target=update, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.load_session('s1')['player_info'] == {f'field{idx}': idx for idx in range(8)}
+
+
+def test_read_waits_for_pending_session(app_module):
+    # Another worker stored the placeholder and is still writing the session
+    data = {'player_info': {'username': 'alice'}, 'last_activity': datetime.now(timezone.utc).isoformat()}
+    app_module.session_store.save_session('pending-session', {**data, 'pending': True})
+    writer = threading.Timer(0.3, app_module.session_store.save_session,
+                             ('pending-session', {**data, 'stats_url': 'abc_stats.msgpack'}))
+    writer.start()
+    assert app_module.get_session_data('pending-session')['stats_url'] == 'abc_stats.msgpack'
+    writer.join()
+
+
+def test_failed_write_removes_placeholder(app_module):
+    def fail():
+        raise OSError("storage unavailable")
+
+    session_id = app_module.generate_session_id({'player_info': {'username': 'alice'}, 'build_stats': fail},
+                                                'failing-analysis')
+    assert app_module.get_session_data(session_id) is None
+    assert app_module.session_store.load_session(session_id) is None